@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""Per-profile "access vectors": the portals and roles a profile has.
+
+``UserProfile.has_access()`` is called for every v1 login, get-user and
+authorize request. Instead of a query every time, every profile gets an
+access vector in the (shared) Django cache:
+
+- a bitset of the IDs of the portals the profile has access to (bit ``n`` is
+  the portal with ID ``n``),
+
+- per portal, a bitset of the IDs of the roles of the profile's effective
+  organisation roles (see ``EffectiveOrganisationRole``).
+
+Checking access is a bit test; only building a vector costs two queries.
+
+Every profile has a version number, kept like the catalog versions (see
+``catalog.py``): the signal handlers and
+``EffectiveOrganisationRoleManager.rebuild_for_profiles()`` bump it after
+every change is committed. The vector is stored under a key with the version
+in it, so a vector built from data read before a change can never be
+returned after the change. Until the commit, the transaction that made the
+change builds the profile's vector every time and doesn't store it. As with
+the role graph, all processes must share the cache, see ``checks.py``.
+
+"""
+from django.core.cache import cache
+from lizard_auth_server import catalog
+from lizard_auth_server import models
+from lizard_auth_server.conf import settings
+
+
+FORMAT = 1
+
+
+def _catalog(profile_id):
+    return "access_vector.%s" % profile_id
+
+
+def _vector_key(profile_id, version):
+    return "lizard_auth_server.access_vector.%s.%s.%s" % (FORMAT, profile_id, version)
+
+
+def _build(profile_id):
+    portals = 0
+    for portal_id in models.UserProfile.portals.through.objects.filter(
+        userprofile_id=profile_id
+    ).values_list("portal_id", flat=True):
+        portals |= 1 << portal_id
+    roles = {}
+    for portal_id, role_id in models.EffectiveOrganisationRole.objects.filter(
+        user_profile_id=profile_id
+    ).values_list("portal_id", "organisation_role__role_id"):
+        roles[portal_id] = roles.get(portal_id, 0) | (1 << role_id)
+    return portals, roles
+
+
+def get(profile_id, build=True):
+    """Return the (portals, {portal ID: roles}) bitsets of the profile.
+
+    Without ``build``, return None instead of building a vector that isn't in
+    the cache.
+
+    """
+    if _catalog(profile_id) in catalog.uncommitted():
+        return _build(profile_id) if build else None
+    key = _vector_key(profile_id, catalog.get_version(_catalog(profile_id)))
+    vector = cache.get(key)
+    if vector is None and build:
+        vector = _build(profile_id)
+        cache.set(key, vector, settings.LIZARD_AUTH_SERVER_ACCESS_VECTOR_TIMEOUT)
+    return vector
+
+
+def has_portal(profile_id, portal_id):
+    """Return whether the profile has access to the portal."""
+    portals, roles = get(profile_id)
+    return bool(portals >> portal_id & 1)
+
+
+def has_role(profile_id, portal_id, role_id):
+    """Return whether one of the profile's organisation roles has the role."""
+    portals, roles = get(profile_id)
+    return bool(roles.get(portal_id, 0) >> role_id & 1)
+
+
+def invalidate(profile_ids):
+    """Mark the access vectors of these profiles as outdated."""
+    catalog.bump_on_commit([_catalog(profile_id) for profile_id in profile_ids])
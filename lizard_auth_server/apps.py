@@ -6,5 +6,6 @@ class MyAppConfig(AppConfig):
     verbose_name = "Lizard auth server"
 
     def ready(self):
-        # Enable the signals
+        # Enable the signals and the system checks
+        from lizard_auth_server import checks  # NOQA
         from lizard_auth_server.signal_handlers import create_user_profile  # NOQA
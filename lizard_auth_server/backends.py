@@ -6,15 +6,25 @@ https://github.com/metametricsinc/django-warrant
 
 """
 from boto3.exceptions import Boto3Error
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError
 from botocore.exceptions import ClientError
-from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.contrib.auth.backends import ModelBackend
 from django.utils.six import iteritems
+from lizard_auth_server import metrics
+from lizard_auth_server import performance
+from lizard_auth_server.conf import settings
+from requests.exceptions import RequestException
 from warrant import Cognito
 
+import boto3
+import collections
+import contextlib
 import django.utils.timezone
 import logging
+import threading
+import time
 
 
 logger = logging.getLogger(__name__)
@@ -30,6 +40,221 @@ def cognito_to_dict(attr_list, mapping):
     return user_attrs
 
 
+_cognito_clients = {}
+_cognito_clients_lock = threading.Lock()
+
+# ClientError codes that mean that Cognito itself is in trouble. Other client
+# errors (wrong password, unknown user) mean that Cognito works fine.
+COGNITO_FAILURE_ERROR_CODES = (
+    "InternalErrorException",
+    "ServiceUnavailable",
+    "ThrottlingException",
+    "TooManyRequestsException",
+)
+
+
+class CognitoUnavailable(Exception):
+    """Raised instead of calling Cognito while the circuit breaker is open.
+
+    Also raised for timeouts and connection errors, see ``unavailable()``.
+
+    """
+
+
+@contextlib.contextmanager
+def unavailable():
+    """Turn Cognito timeouts and connection errors into CognitoUnavailable.
+
+    For callers that only care whether Cognito could answer, not why not.
+
+    """
+    try:
+        yield
+    except (BotoCoreError, RequestException) as e:
+        raise CognitoUnavailable("Cognito call failed: %s" % e) from e
+
+
+class CircuitBreaker(object):
+    """Stop calling Cognito when most calls fail, so that we fail fast.
+
+    The breaker starts out "closed": calls go through and we remember their
+    outcome. When at least ``LIZARD_AUTH_SERVER_COGNITO_BREAKER_MIN_CALLS``
+    calls were made in the last ``..._BREAKER_WINDOW`` seconds and the
+    fraction of failed calls reaches ``..._BREAKER_FAILURE_RATE``, the breaker
+    "opens": calls raise :class:`CognitoUnavailable` right away. After
+    ``..._BREAKER_RESET_TIMEOUT`` seconds the breaker is "half open": one
+    call is let through as a probe. If it succeeds, the breaker closes
+    again, otherwise it stays open for another timeout.
+
+    The ``counters`` are per process.
+
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self._outcomes = collections.deque()  # (time, succeeded)
+            self._opened_at = None
+            self._probing = False
+            self.counters = collections.Counter()
+
+    def is_open(self):
+        with self._lock:
+            return self.state == self.OPEN and not self._reset_timeout_passed()
+
+    def _reset_timeout_passed(self):
+        timeout = settings.LIZARD_AUTH_SERVER_COGNITO_BREAKER_RESET_TIMEOUT
+        return time.monotonic() - self._opened_at >= timeout
+
+    def _before_call(self):
+        """Return whether this call is the probe of a half open breaker."""
+        with self._lock:
+            if self.state == self.OPEN and self._reset_timeout_passed():
+                self.state = self.HALF_OPEN
+                self._probing = False
+            if self.state == self.OPEN or (
+                self.state == self.HALF_OPEN and self._probing
+            ):
+                self.counters["short_circuited"] += 1
+                metrics.COGNITO_CALLS.labels("short_circuited").inc()
+                raise CognitoUnavailable("Cognito is unavailable")
+            self.counters["calls"] += 1
+            if self.state == self.HALF_OPEN:
+                self._probing = True
+                return True
+            return False
+
+    def _after_call(self, succeeded, outcome=None):
+        if outcome is None:
+            outcome = "error" if succeeded else "failure"
+        metrics.COGNITO_CALLS.labels(outcome).inc()
+        now = time.monotonic()
+        with self._lock:
+            if not succeeded:
+                self.counters["failures"] += 1
+            if self.state == self.HALF_OPEN:
+                self._probing = False
+                if succeeded:
+                    self.state = self.CLOSED
+                    self._outcomes.clear()
+                else:
+                    self._trip(now)
+                return
+
+            window = settings.LIZARD_AUTH_SERVER_COGNITO_BREAKER_WINDOW
+            self._outcomes.append((now, succeeded))
+            while self._outcomes[0][0] < now - window:
+                self._outcomes.popleft()
+            if self.state == self.OPEN:
+                return  # Another thread tripped it in the meantime.
+            calls = len(self._outcomes)
+            failures = sum(1 for _, ok in self._outcomes if not ok)
+            if (
+                calls >= settings.LIZARD_AUTH_SERVER_COGNITO_BREAKER_MIN_CALLS
+                and failures / calls
+                >= settings.LIZARD_AUTH_SERVER_COGNITO_BREAKER_FAILURE_RATE
+            ):
+                self._trip(now)
+
+    def _trip(self, now):
+        logger.warning("Cognito circuit breaker tripped, failing fast for now")
+        self.state = self.OPEN
+        self._opened_at = now
+        self._outcomes.clear()
+        self.counters["tripped"] += 1
+
+    def call(self, func, *args, **kwargs):
+        """Call func, unless Cognito is deemed unavailable.
+
+        Raises:
+            CognitoUnavailable: when the breaker is open.
+
+        """
+        probe = self._before_call()
+        try:
+            return self._call(func, *args, **kwargs)
+        finally:
+            if probe:
+                # Without an outcome (a BaseException like a gevent timeout
+                # interrupted the call), let the next call probe instead.
+                with self._lock:
+                    if self.state == self.HALF_OPEN:
+                        self._probing = False
+
+    def _call(self, func, *args, **kwargs):
+        try:
+            with metrics.COGNITO_CALL_DURATION.time():
+                result = func(*args, **kwargs)
+        except (BotoCoreError, RequestException):
+            # Connection errors and timeouts (warrant uses requests to get the
+            # keys for verifying the tokens).
+            self._after_call(succeeded=False)
+            raise
+        except ClientError as e:
+            error = e.response.get("Error", {})
+            status = e.response.get("ResponseMetadata", {}).get("HTTPStatusCode", 0)
+            self._after_call(
+                succeeded=(
+                    status < 500
+                    and error.get("Code") not in COGNITO_FAILURE_ERROR_CODES
+                )
+            )
+            raise
+        except Exception:
+            self._after_call(succeeded=True, outcome="error")
+            raise
+        self._after_call(succeeded=True, outcome="success")
+        return result
+
+
+cognito_breaker = CircuitBreaker()
+
+
+def get_cognito_client(access_key=None, secret_key=None, region_name=None):
+    """Return a boto3 ``cognito-idp`` client, shared within the process.
+
+    Creating a client is expensive (it loads the endpoint data and sets up
+    the credential chain). boto3 clients are thread-safe, so we create one
+    per set of arguments and re-use it. boto3's default session isn't
+    thread-safe, hence the lock and the session per client.
+
+    """
+    key = (access_key, secret_key, region_name)
+    with _cognito_clients_lock:
+        client = _cognito_clients.get(key)
+        if client is None:
+            client_kwargs = {}
+            if access_key and secret_key:
+                client_kwargs["aws_access_key_id"] = access_key
+                client_kwargs["aws_secret_access_key"] = secret_key
+            if region_name:
+                client_kwargs["region_name"] = region_name
+            client_kwargs["config"] = Config(
+                connect_timeout=settings.LIZARD_AUTH_SERVER_COGNITO_CONNECT_TIMEOUT,
+                read_timeout=settings.LIZARD_AUTH_SERVER_COGNITO_READ_TIMEOUT,
+                retries={
+                    "max_attempts": settings.LIZARD_AUTH_SERVER_COGNITO_MAX_ATTEMPTS
+                },
+            )
+            client = boto3.session.Session().client("cognito-idp", **client_kwargs)
+            _cognito_clients[key] = client
+        return client
+
+
+def reset_cognito_clients():
+    """Drop the shared clients, for instance after rotating the AWS keys."""
+    with _cognito_clients_lock:
+        _cognito_clients.clear()
+
+
 class CognitoUser(Cognito):
     user_class = get_user_model()
     # Mapping of Cognito User attribute name to Django User attribute name
@@ -43,6 +268,37 @@ class CognitoUser(Cognito):
         },
     )
 
+    def __init__(
+        self,
+        user_pool_id,
+        client_id,
+        user_pool_region=None,
+        username=None,
+        id_token=None,
+        refresh_token=None,
+        access_token=None,
+        client_secret=None,
+        access_key=None,
+        secret_key=None,
+    ):
+        # Same as Cognito.__init__(), except for the shared boto3 client.
+        self.user_pool_id = user_pool_id
+        self.client_id = client_id
+        self.user_pool_region = self.user_pool_id.split("_")[0]
+        self.username = username
+        self.id_token = id_token
+        self.access_token = access_token
+        self.refresh_token = refresh_token
+        self.client_secret = client_secret
+        self.token_type = None
+        self.custom_attributes = None
+        self.base_attributes = None
+        self.client = get_cognito_client(
+            access_key=access_key,
+            secret_key=secret_key,
+            region_name=user_pool_region,
+        )
+
     @classmethod
     def from_username(cls, username):
         return cls(
@@ -76,21 +332,39 @@ class CognitoUser(Cognito):
 
         return user
 
-    def admin_set_user_password(self, password):
-        """Set the user's password"""
-        self.client.admin_set_user_password(
-            UserPoolId=self.user_pool_id,
-            Username=self.username,
-            Permanent=True,
-            Password=password,
+    def admin_authenticate(self, password):
+        return cognito_breaker.call(
+            super(CognitoUser, self).admin_authenticate, password
         )
 
+    def get_user(self, attr_map=None):
+        return cognito_breaker.call(super(CognitoUser, self).get_user, attr_map)
+
+    def admin_set_user_password(self, password):
+        """Set the user's password
+
+        Raises:
+            CognitoUnavailable: when the breaker is open or the call failed.
+
+        """
+        with performance.timed("cognito"), unavailable():
+            cognito_breaker.call(
+                self.client.admin_set_user_password,
+                UserPoolId=self.user_pool_id,
+                Username=self.username,
+                Permanent=True,
+                Password=password,
+            )
+
     def admin_user_exists(self):
         """Return whether a user with username == self.username exists"""
         try:
-            self.client.admin_get_user(
-                UserPoolId=self.user_pool_id, Username=self.username
-            )
+            with performance.timed("cognito"):
+                cognito_breaker.call(
+                    self.client.admin_get_user,
+                    UserPoolId=self.user_pool_id,
+                    Username=self.username,
+                )
         except (Boto3Error, ClientError) as e:
             error_code = e.response["Error"]["Code"]
             if error_code == CognitoBackend.USER_NOT_FOUND_ERROR_CODE:
@@ -114,16 +388,36 @@ class CognitoBackend(ModelBackend):
         :param username: Cognito username
         :param password: Cognito password
         :return: returns User instance of AUTH_USER_MODEL or None
+        """
+        try:
+            return self.check_password(username, password)
+        except CognitoUnavailable as e:
+            # Open breaker, timeouts or connection errors: fail fast, the next
+            # backend (ModelBackend) gets a try.
+            logger.warning(
+                "Cognito unavailable, not checking %s there: %s", username, e
+            )
+            return None
+
+    def check_password(self, username, password):
+        """Return the user if the password is right, None if it is wrong.
+
+        Raises:
+            CognitoUnavailable: when Cognito couldn't check the password (the
+                breaker is open, a timeout or a connection error). Unlike
+                ``authenticate()``, which returns None then.
+
         """
         cognito_user = CognitoUser.from_username(username)
         try:
-            cognito_user.admin_authenticate(password)
-            # ^^^ This uses ADMIN_NO_SRP_AUTH, but that's the old name for
-            # ADMIN_USER_PASSWORD_AUTH (which we need), so it will probably be
-            # OK.
+            with performance.timed("cognito"), unavailable():
+                cognito_user.admin_authenticate(password)
+                # ^^^ This uses ADMIN_NO_SRP_AUTH, but that's the old name for
+                # ADMIN_USER_PASSWORD_AUTH (which we need), so it will probably
+                # be OK.
+                user = cognito_user.get_user()
         except (Boto3Error, ClientError) as e:
             return self.handle_error_response(e)
-        user = cognito_user.get_user()
 
         return user
 
@@ -0,0 +1,15 @@
+# -*- coding: utf-8 -*-
+"""Benchmarks of the v1 and v2 SSO protocols.
+
+- :mod:`.fixtures` generates portals, organisations, role inheritance and
+  users with their profile memberships.
+- :mod:`.flows` drives the v1 (request token, authorize, verify) and v2
+  (check credentials, login, find user, new user) flows through the Django
+  test client.
+- :mod:`.runner` records the latency and the number of queries per endpoint
+  and compares the results with a stored baseline.
+
+Run them with ``manage.py benchmark_sso``, which uses a temporary test
+database and private local memory caches.
+
+"""
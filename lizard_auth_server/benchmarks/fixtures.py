@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""Generate a realistic data set for the benchmarks.
+
+Everything is bulk-inserted (no signals), after which the effective
+organisation roles are rebuilt in one go.
+
+"""
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from lizard_auth_server import catalog
+from lizard_auth_server import role_graph
+from lizard_auth_server import user_payloads
+from lizard_auth_server.models import EffectiveOrganisationRole
+from lizard_auth_server.models import Organisation
+from lizard_auth_server.models import OrganisationRole
+from lizard_auth_server.models import Portal
+from lizard_auth_server.models import Role
+from lizard_auth_server.models import UserProfile
+
+import random
+
+
+PASSWORD = "benchmark-password"
+USERNAME = "benchmark-user-%05d"
+
+
+class Fixtures(object):
+    """The generated portals and users.
+
+    ``access`` maps the user IDs to the portals they have access to.
+
+    """
+
+    def __init__(self, portals, users, access, password):
+        self.portals = portals
+        self.users = users
+        self.access = access
+        self.password = password
+
+
+def create_fixtures(
+    portals=3,
+    organisations=20,
+    roles_per_portal=5,
+    users=200,
+    seed=0,
+    password=PASSWORD,
+):
+    """Create the data set and return a :class:`Fixtures`.
+
+    Every portal gets ``roles_per_portal`` roles, where every role can
+    inherit from one or two of the previous roles. Every organisation gets
+    about a third of all roles, some of them for all users. Every user is a
+    member of one to three organisations, has access to one to three portals
+    and gets some of the organisation roles of their organisations.
+
+    """
+    rng = random.Random(seed)
+
+    portal_objects = []
+    for i in range(portals):
+        portal = Portal(
+            name="Benchmark portal %s" % i,
+            redirect_url="https://portal%s.example.com" % i,
+            visit_url="https://portal%s.example.com" % i,
+        )
+        portal.save()
+        portal_objects.append(portal)
+
+    Role.objects.bulk_create(
+        [
+            Role(portal=portal, code="role%s" % i, name="Role %s" % i)
+            for portal in portal_objects
+            for i in range(roles_per_portal)
+        ]
+    )
+    roles = list(
+        Role.objects.filter(portal__in=portal_objects).order_by("portal", "code")
+    )
+    inheritance = []
+    for portal in portal_objects:
+        portal_roles = [role for role in roles if role.portal_id == portal.id]
+        for i, role in enumerate(portal_roles[1:], 1):
+            for base_role in rng.sample(portal_roles[:i], min(i, rng.randint(0, 2))):
+                inheritance.append(
+                    Role.inheriting_roles.through(
+                        from_role_id=base_role.id, to_role_id=role.id
+                    )
+                )
+    Role.inheriting_roles.through.objects.bulk_create(inheritance)
+    role_graph.changed()  # Like the signal handlers.
+
+    Organisation.objects.bulk_create(
+        [
+            Organisation(name="Benchmark organisation %s" % i)
+            for i in range(organisations)
+        ]
+    )
+    organisation_objects = list(
+        Organisation.objects.filter(name__startswith="Benchmark organisation ")
+    )
+    catalog.bump(catalog.ORGANISATIONS)  # Like the signal handler.
+    OrganisationRole.objects.bulk_create(
+        [
+            OrganisationRole(
+                organisation=organisation,
+                role=role,
+                for_all_users=rng.random() < 0.2,
+            )
+            for organisation in organisation_objects
+            for role in rng.sample(roles, max(1, len(roles) // 3))
+        ]
+    )
+    organisation_roles = {}
+    for organisation_role in OrganisationRole.objects.filter(
+        organisation__in=organisation_objects, for_all_users=False
+    ):
+        organisation_roles.setdefault(organisation_role.organisation_id, []).append(
+            organisation_role.id
+        )
+
+    # Hashing the password once instead of per user saves minutes.
+    hashed_password = make_password(password)
+    usernames = [USERNAME % i for i in range(users)]
+    User.objects.bulk_create(
+        [
+            User(
+                username=username,
+                email="%s@example.com" % username,
+                first_name="Benchmark",
+                last_name=username,
+                password=hashed_password,
+            )
+            for username in usernames
+        ]
+    )
+    user_objects = list(User.objects.filter(username__in=usernames).order_by("id"))
+    # bulk_create() doesn't send the signals that invalidate the cache.
+    user_payloads.invalidate([user.id for user in user_objects])
+    UserProfile.objects.bulk_create([UserProfile(user=user) for user in user_objects])
+    profile_ids = dict(
+        UserProfile.objects.filter(user__in=user_objects).values_list("user_id", "id")
+    )
+
+    memberships = []
+    portal_access = []
+    profile_roles = []
+    access = {}
+    for user in user_objects:
+        profile_id = profile_ids[user.id]
+        for organisation in rng.sample(
+            organisation_objects, min(len(organisation_objects), rng.randint(1, 3))
+        ):
+            memberships.append(
+                UserProfile.organisations.through(
+                    userprofile_id=profile_id, organisation_id=organisation.id
+                )
+            )
+            available = organisation_roles.get(organisation.id, [])
+            for organisation_role_id in rng.sample(
+                available, min(len(available), rng.randint(0, 2))
+            ):
+                profile_roles.append(
+                    UserProfile.roles.through(
+                        userprofile_id=profile_id,
+                        organisationrole_id=organisation_role_id,
+                    )
+                )
+        access[user.id] = rng.sample(
+            portal_objects, min(len(portal_objects), rng.randint(1, 3))
+        )
+        for portal in access[user.id]:
+            portal_access.append(
+                UserProfile.portals.through(
+                    userprofile_id=profile_id, portal_id=portal.id
+                )
+            )
+    UserProfile.organisations.through.objects.bulk_create(memberships)
+    UserProfile.portals.through.objects.bulk_create(portal_access)
+    UserProfile.roles.through.objects.bulk_create(profile_roles)
+    EffectiveOrganisationRole.objects.rebuild_for_profiles(profile_ids.values())
+
+    return Fixtures(portal_objects, user_objects, access, password)
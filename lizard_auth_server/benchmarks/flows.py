@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""The v1 and v2 SSO flows, the way a portal (and its users) use them.
+
+Every flow measures its requests with ``recorder.measure(endpoint)`` and
+raises :class:`UnexpectedResponse` when a request doesn't return the status
+code a working portal would get.
+
+"""
+from django.test import Client
+from itsdangerous import URLSafeTimedSerializer
+from urllib.parse import parse_qs
+from urllib.parse import urlparse
+
+import jwt
+
+
+class UnexpectedResponse(Exception):
+    pass
+
+
+def check_status(response, endpoint, expected):
+    if response.status_code != expected:
+        raise UnexpectedResponse(
+            "%s returned %s instead of %s: %s"
+            % (endpoint, response.status_code, expected, response.content[:200])
+        )
+
+
+def v1_message(portal, **params):
+    params["key"] = portal.sso_key
+    return {
+        "key": portal.sso_key,
+        "message": URLSafeTimedSerializer(portal.sso_secret).dumps(params),
+    }
+
+
+def v2_message(portal, **payload):
+    payload["iss"] = portal.sso_key
+    message = jwt.encode(payload, portal.sso_secret).decode("ascii")
+    return {"key": portal.sso_key, "message": message}
+
+
+def v1_flow(recorder, portal, user):
+    """Request a token, let the user authorize it and verify it.
+
+    The user is logged in already and needs access to the portal.
+
+    """
+    server = Client()
+    browser = Client()
+    browser.force_login(user)
+    signer = URLSafeTimedSerializer(portal.sso_secret)
+
+    with recorder.measure("v1.request_token"):
+        response = server.get("/sso/api/request_token/", v1_message(portal))
+    check_status(response, "v1.request_token", 200)
+    request_token = signer.loads(response.content)["request_token"]
+
+    with recorder.measure("v1.authorize"):
+        response = browser.get(
+            "/sso/authorize/", v1_message(portal, request_token=request_token)
+        )
+    check_status(response, "v1.authorize", 302)
+    message = parse_qs(urlparse(response["Location"]).query)["message"][0]
+    auth_token = signer.loads(message)["auth_token"]
+
+    with recorder.measure("v1.verify"):
+        response = server.get(
+            "/sso/api/verify/", v1_message(portal, auth_token=auth_token)
+        )
+    check_status(response, "v1.verify", 200)
+
+
+def v2_flow(recorder, portal, user, password, new_username):
+    """Check credentials, log in, find the user and create a new user."""
+    server = Client()
+    browser = Client()
+    browser.force_login(user)
+
+    with recorder.measure("v2.check_credentials"):
+        response = server.post(
+            "/api2/check_credentials/",
+            v2_message(portal, username=user.username, password=password),
+        )
+    check_status(response, "v2.check_credentials", 200)
+
+    with recorder.measure("v2.login"):
+        response = browser.get(
+            "/api2/login/",
+            v2_message(portal, login_success_url=portal.visit_url),
+        )
+    check_status(response, "v2.login", 302)
+
+    with recorder.measure("v2.find_user"):
+        response = server.get("/api2/find_user/", v2_message(portal, email=user.email))
+    check_status(response, "v2.find_user", 200)
+
+    with recorder.measure("v2.new_user"):
+        response = server.post(
+            "/api2/new_user/",
+            v2_message(
+                portal,
+                username=new_username,
+                email="%s@example.com" % new_username,
+                first_name="New",
+                last_name=new_username,
+            ),
+        )
+    check_status(response, "v2.new_user", 201)
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""Run the flows, summarize the measurements and compare them to a baseline.
+
+A baseline is the JSON dump of :meth:`Recorder.summary`. The query counts
+should not change between runs, so every extra query is a regression. The
+latencies depend on the machine, so only a p95 that is more than
+``tolerance`` (a fraction) slower than the baseline is one.
+
+"""
+from collections import OrderedDict
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from lizard_auth_server.benchmarks import flows
+
+import contextlib
+import json
+import math
+import random
+import time
+
+
+NEW_USERNAME = "benchmark-new-user-%05d"
+
+
+def percentile(values, percent):
+    """Return the nearest-rank percentile of the values."""
+    ordered = sorted(values)
+    rank = max(1, int(math.ceil(percent / 100.0 * len(ordered))))
+    return ordered[rank - 1]
+
+
+class Recorder(object):
+    """The durations (ms) and query counts per endpoint."""
+
+    def __init__(self):
+        self.durations = OrderedDict()
+        self.queries = OrderedDict()
+
+    @contextlib.contextmanager
+    def measure(self, endpoint):
+        with CaptureQueriesContext(connection) as captured:
+            start = time.perf_counter()
+            yield
+            elapsed = (time.perf_counter() - start) * 1000
+        self.durations.setdefault(endpoint, []).append(elapsed)
+        self.queries.setdefault(endpoint, []).append(len(captured))
+
+    def summary(self):
+        result = OrderedDict()
+        for endpoint, durations in self.durations.items():
+            queries = self.queries[endpoint]
+            result[endpoint] = OrderedDict(
+                [
+                    ("requests", len(durations)),
+                    ("throughput", round(len(durations) / sum(durations) * 1000, 1)),
+                    ("p50_ms", round(percentile(durations, 50), 2)),
+                    ("p95_ms", round(percentile(durations, 95), 2)),
+                    ("p99_ms", round(percentile(durations, 99), 2)),
+                    ("queries", max(queries)),
+                ]
+            )
+        return result
+
+
+def run(fixtures, iterations=50, seed=0):
+    """Run both flows ``iterations`` times and return the :class:`Recorder`.
+
+    Every iteration picks a random user and one of the portals they have
+    access to.
+
+    """
+    rng = random.Random(seed)
+    recorder = Recorder()
+    for i in range(iterations):
+        user = rng.choice(fixtures.users)
+        portal = rng.choice(fixtures.access[user.id])
+        flows.v1_flow(recorder, portal, user)
+        flows.v2_flow(recorder, portal, user, fixtures.password, NEW_USERNAME % i)
+    return recorder
+
+
+def compare(summary, baseline, tolerance=0.2):
+    """Return the regressions of the summary compared with the baseline."""
+    regressions = []
+    for endpoint, expected in baseline.items():
+        if endpoint not in summary:
+            continue
+        actual = summary[endpoint]
+        if actual["queries"] > expected["queries"]:
+            regressions.append(
+                "%s: %s queries instead of %s"
+                % (endpoint, actual["queries"], expected["queries"])
+            )
+        if actual["p95_ms"] > expected["p95_ms"] * (1 + tolerance):
+            regressions.append(
+                "%s: p95 of %.2f ms instead of %.2f ms"
+                % (endpoint, actual["p95_ms"], expected["p95_ms"])
+            )
+    return regressions
+
+
+def load_baseline(path):
+    with open(path) as baseline_file:
+        return json.load(baseline_file, object_pairs_hook=OrderedDict)
+
+
+def save_baseline(path, summary):
+    with open(path, "w") as baseline_file:
+        json.dump(summary, baseline_file, indent=2)
+        baseline_file.write("\n")
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""Version numbers of the "catalogs": the organisations and the roles.
+
+Portals poll the organisation and role lists constantly, but the lists hardly
+ever change. Every catalog has a version number in the (shared) Django cache
+that the signal handlers bump on every change. The API views turn the
+version into an ``ETag`` header and answer a matching ``If-None-Match`` with
+a "304 not modified" without querying the catalog. There's no
+``Last-Modified``: the version doesn't tell when the catalog last changed.
+
+The requests are signed messages from the portals and the organisation lists
+are sent with ``Cache-Control: no-store``, so HTTP caches don't keep the
+responses. The ``ETag`` is for portals that remember it themselves and send
+it along with their next request.
+
+A version starts out as the current time in milliseconds and is incremented
+on every change, so a version is never re-used when the cache is cleared.
+
+The organisation lists are also kept as a "snapshot": the serialized JSON
+response per version and per "shape" (the v1 and the v2 API return
+different JSON), so that every process can return the current list without
+touching the database. A bumped version means a new cache key, so the next
+request builds a new snapshot.
+
+"""
+from django.core.cache import cache
+from django.db import transaction
+from django.http import HttpResponse
+from django.http import HttpResponseNotModified
+from django.utils.http import parse_etags
+from django.utils.http import quote_etag
+from lizard_auth_server.conf import settings
+
+import json
+import time
+
+
+ORGANISATIONS = "organisations"
+ROLES = "roles"
+# Not served to the portals: the version of the in-memory role graph, see
+# role_graph.py.
+ROLE_GRAPH = "role_graph"
+
+
+def _cache_key(catalog):
+    return "lizard_auth_server.catalog.%s" % catalog
+
+
+def _now_ms():
+    return int(time.time() * 1000)
+
+
+def get_version(catalog):
+    key = _cache_key(catalog)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, _now_ms(), None)
+        version = cache.get(key)
+    return version
+
+
+def get_versions(catalogs):
+    """Return {catalog: version}, like ``get_version()`` for many catalogs."""
+    keys = {catalog: _cache_key(catalog) for catalog in catalogs}
+    found = cache.get_many(keys.values())
+    versions = {}
+    for catalog, key in keys.items():
+        if key not in found:
+            cache.add(key, _now_ms(), None)
+            found[key] = cache.get(key)
+        versions[catalog] = found[key]
+    return versions
+
+
+def bump(catalog):
+    """Mark the catalog as changed.
+
+    We bump right away and again after the transaction commits. Otherwise a
+    client could get the new version with the old data in between.
+
+    """
+    _bump(catalog)
+    transaction.on_commit(lambda: _bump(catalog))
+
+
+def _bump(catalog):
+    key = _cache_key(catalog)
+    if cache.add(key, _now_ms(), None):
+        return
+    try:
+        cache.incr(key)
+    except ValueError:
+        # Expired/evicted in the meantime.
+        cache.add(key, _now_ms(), None)
+
+
+class _Bump(object):
+    """``on_commit()`` callback that bumps catalogs, see ``bump_on_commit()``."""
+
+    def __init__(self, catalogs):
+        self.catalogs = frozenset(catalogs)
+
+    def __call__(self):
+        for catalog in self.catalogs:
+            _bump(catalog)
+
+
+def bump_on_commit(catalogs):
+    """Mark the catalogs as changed once the current transaction commits.
+
+    For data that the server itself caches while working with it (the role
+    graph, the access vectors, the user data). Unlike with ``bump()``, the
+    version stays the same until the commit, so nothing built from
+    uncommitted data can end up under the new version, where it would
+    survive a rollback. Until the commit, ``uncommitted()`` tells the
+    transaction not to cache anything for these catalogs.
+
+    """
+    catalogs = set(catalogs) - uncommitted()
+    if catalogs:
+        transaction.on_commit(_Bump(catalogs))
+
+
+def uncommitted():
+    """Return the catalogs the current transaction changed, but didn't commit.
+
+    Django drops the ``on_commit()`` callbacks of a rolled back transaction
+    (or savepoint), so after a rollback the catalogs don't count anymore.
+
+    """
+    connection = transaction.get_connection()
+    if not connection.in_atomic_block:
+        return set()
+    catalogs = set()
+    for savepoint_ids, callback in connection.run_on_commit:
+        if isinstance(callback, _Bump):
+            catalogs |= callback.catalogs
+    return catalogs
+
+
+def conditional_response(request, catalog, build_response):
+    """Return a 304 if the client has the current version of the catalog.
+
+    Otherwise return the response from ``build_response()``. Both get the
+    ``ETag`` header. Unlike Django's conditional GET
+    handling, this works for (our read-only) POST requests, too.
+
+    """
+    return _conditional_response(
+        request, catalog, get_version(catalog), lambda version: build_response()
+    )
+
+
+def snapshot_response(request, catalog, shape, build_data):
+    """Return the snapshot of the catalog in this shape (or a 304).
+
+    ``build_data()`` returns the JSON-serializable data, it is only called
+    when the snapshot of the current version isn't in the cache yet.
+
+    """
+
+    def build_response(version):
+        key = "%s.snapshot.%s.%s" % (_cache_key(catalog), shape, version)
+        content = cache.get(key)
+        if content is None:
+            content = json.dumps(build_data()).encode("utf-8")
+            cache.set(
+                key, content, settings.LIZARD_AUTH_SERVER_CATALOG_SNAPSHOT_TIMEOUT
+            )
+        return HttpResponse(content, content_type="application/json")
+
+    return _conditional_response(request, catalog, get_version(catalog), build_response)
+
+
+def _conditional_response(request, catalog, version, build_response):
+    etag = quote_etag("%s-%s" % (catalog, version))
+    if etag in parse_etags(request.META.get("HTTP_IF_NONE_MATCH", "")):
+        response = HttpResponseNotModified()
+    else:
+        response = build_response(version)
+    response["ETag"] = etag
+    return response
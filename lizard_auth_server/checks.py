@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+"""System checks, registered in ``apps.py``."""
+from django.conf import settings
+from django.core.checks import Error
+from django.core.checks import register
+from django.core.checks import Warning
+
+
+LOCAL_CACHE_BACKEND = "django.core.cache.backends.locmem.LocMemCache"
+DUMMY_CACHE_BACKEND = "django.core.cache.backends.dummy.DummyCache"
+
+
+@register()
+def check_default_cache(app_configs, **kwargs):
+    """The default cache must be shared between the server processes.
+
+    The versions of the role graph, the access vectors, the cached user data
+    and the catalogs (see ``catalog.py``) are kept in the default cache. A
+    process that doesn't see the other processes' version bumps keeps using
+    outdated roles and access.
+
+    """
+    backend = settings.CACHES.get("default", {}).get("BACKEND")
+    if backend == DUMMY_CACHE_BACKEND:
+        return [
+            Error(
+                "The default cache doesn't keep anything.",
+                hint="Lizard auth server keeps version numbers in the default "
+                "cache. Use memcached or redis.",
+                id="lizard_auth_server.E001",
+            )
+        ]
+    if backend == LOCAL_CACHE_BACKEND:
+        return [
+            Warning(
+                "The default cache isn't shared between processes.",
+                hint="Lizard auth server keeps version numbers in the default "
+                "cache. With more than one server process, use memcached or "
+                "redis.",
+                id="lizard_auth_server.W001",
+            )
+        ]
+    return []
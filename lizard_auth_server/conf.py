@@ -20,3 +20,49 @@ class LizardAuthServerAppConf(AppConf):
     JWT_EXPIRATION_DELTA = timedelta(seconds=300)
     DIRTY_HARDCODED_PASSWORD = "dirtyhardcodedpassword"
     ACCOUNT_ACTIVATION_DAYS = 45  # A month of vacation + some margin
+    # In-memory portal registry, see registry.py
+    PORTAL_CACHE_TIMEOUT = 60  # seconds
+    PORTAL_CACHE_SIZE = 256
+    # v1 get_users: users per query when streaming, maximum page size
+    GET_USERS_CHUNK_SIZE = 500
+    GET_USERS_MAX_LIMIT = 1000
+    # v1 user data cache, see user_payloads.py
+    USER_PAYLOAD_TIMEOUT = 3600  # seconds
+    # Per-profile portal and role bitsets, see access_vectors.py
+    ACCESS_VECTOR_TIMEOUT = 3600  # seconds
+    # Organisation list snapshots, see catalog.py
+    CATALOG_SNAPSHOT_TIMEOUT = 24 * 3600  # seconds
+    # v2 changes feed: maximum number of change log entries per call
+    CHANGES_MAX_LIMIT = 1000
+    # Leave out the changes of the last seconds, their transactions may still
+    # be running (the IDs aren't handed out in commit order)
+    CHANGES_SETTLE_SECONDS = 10
+    # Days to keep the change log, see the cleanup_change_log command
+    CHANGES_KEEP_DAYS = 90
+    # Cognito: boto3 timeouts (seconds) and circuit breaker, see backends.py
+    COGNITO_CONNECT_TIMEOUT = 2
+    COGNITO_READ_TIMEOUT = 5
+    COGNITO_MAX_ATTEMPTS = 2
+    COGNITO_BREAKER_FAILURE_RATE = 0.5
+    COGNITO_BREAKER_MIN_CALLS = 10
+    COGNITO_BREAKER_WINDOW = 60
+    COGNITO_BREAKER_RESET_TIMEOUT = 30
+    # Email outbox, see mail.py and the send_queued_mail command
+    EMAIL_OUTBOX = False
+    EMAIL_OUTBOX_MAX_ATTEMPTS = 8
+    EMAIL_OUTBOX_RETRY_DELAY = 60  # seconds, doubled after every attempt
+    EMAIL_OUTBOX_KEEP_DAYS = 7
+    # seconds a worker has to send the mails it claimed, before another
+    # worker may take over
+    EMAIL_OUTBOX_LEASE = 900
+    # v1 SSO tokens, see token_store.py
+    TOKEN_STORE = "lizard_auth_server.token_store.DatabaseTokenStore"
+    TOKEN_STORE_CACHE = "default"
+    # v2 JWT replay cache (a cache alias, None = off), see replay_cache.py
+    JWT_REPLAY_CACHE = None
+    JWT_REPLAY_MAX_WINDOW = 300  # seconds
+    # Requests slower than this (ms) are logged by PerformanceMiddleware
+    PERFORMANCE_SLOW_REQUEST_MS = 1000
+    # Also allow "Authorization: Bearer <token>" for /metrics (otherwise it is
+    # staff only), see metrics.py
+    METRICS_TOKEN = None
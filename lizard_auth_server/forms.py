@@ -9,15 +9,17 @@ from django.forms import ValidationError
 from django.utils.translation import ugettext_lazy as _
 from itsdangerous import BadSignature
 from itsdangerous import URLSafeTimedSerializer
+from lizard_auth_server import jwt_codec
+from lizard_auth_server.backends import cognito_breaker
 from lizard_auth_server.backends import CognitoBackend
+from lizard_auth_server.backends import CognitoUnavailable
 from lizard_auth_server.backends import CognitoUser
 from lizard_auth_server.models import BILLING_ROLE
 from lizard_auth_server.models import Organisation
 from lizard_auth_server.models import Portal
 from lizard_auth_server.models import THREEDI_PORTAL
 from lizard_auth_server.models import UserProfile
-
-import jwt
+from lizard_auth_server.registry import portal_registry
 
 
 MIN_LENGTH = 8
@@ -38,7 +40,7 @@ class DecryptForm(forms.Form):
         if "key" not in data:
             raise ValidationError("No portal key")
         try:
-            self.portal = Portal.objects.get(sso_key=data["key"])
+            self.portal = portal_registry.get(data["key"])
         except Portal.DoesNotExist:
             raise ValidationError("Invalid portal key")
         try:
@@ -52,6 +54,12 @@ class DecryptForm(forms.Form):
         return new_data
 
 
+class BatchDecryptForm(DecryptForm):
+    """DecryptForm that allows the larger messages of batch requests."""
+
+    message = forms.CharField(max_length=1024 * 1024)
+
+
 class JWTDecryptForm(forms.Form):
     """Form for decoding and validating JWT messages
 
@@ -69,7 +77,10 @@ class JWTDecryptForm(forms.Form):
     message
         The JWT message containing the payload and the JWT signature.
 
-    The :meth:`.clean` method does the actual JWT decoding and validation.
+    The :meth:`.clean` method does the actual JWT decoding and validation,
+    with :func:`lizard_auth_server.jwt_codec.verify_message`.
+    Afterwards, the :term:`portal` that signed the message is available as
+    ``form.portal``, so views don't need to look it up again.
 
     """
 
@@ -105,28 +116,9 @@ class JWTDecryptForm(forms.Form):
 
         """
         original_cleaned_data = super(JWTDecryptForm, self).clean()
-        if "key" not in original_cleaned_data:
-            raise ValidationError("No SSO key")
-        try:
-            portal = Portal.objects.get(sso_key=original_cleaned_data["key"])
-        except Portal.DoesNotExist:
-            raise ValidationError("Invalid SSO key")
-        try:
-            new_cleaned_data = jwt.decode(
-                original_cleaned_data["message"],
-                portal.sso_secret,
-                issuer=original_cleaned_data["key"],
-                algorithms=[getattr(settings, "JWT_ALGORITHM", "HS256")],
-            )
-        except jwt.exceptions.DecodeError:
-            raise ValidationError("Failed to decode JWT")
-        except jwt.exceptions.ExpiredSignatureError:
-            raise ValidationError("JWT has expired")
-        except jwt.exceptions.InvalidIssuerError:
-            raise ValidationError("Public SSO key does not match signed issuer")
-        except jwt.exceptions.MissingRequiredClaimError:
-            raise ValidationError("JWT message misses 'iss' field (=SSO_KEY)")
-
+        self.portal, new_cleaned_data = jwt_codec.verify_message(
+            original_cleaned_data.get("key"), original_cleaned_data.get("message")
+        )
         return new_cleaned_data
 
 
@@ -170,7 +162,7 @@ class AuthenticateUnsignedForm(forms.Form):
         if "key" not in data:
             raise ValidationError("No portal key")
         try:
-            self.portal = Portal.objects.get(sso_key=data["key"])
+            self.portal = portal_registry.get(data["key"])
         except Portal.DoesNotExist:
             raise ValidationError("Invalid portal key")
         return data
@@ -196,9 +188,17 @@ class SetPasswordMixin:
             return super().clean_old_password()
 
         old_password = self.cleaned_data["old_password"]
-        authenticated_user = CognitoBackend().authenticate(
-            username=self.user.username, password=old_password
-        )
+        try:
+            if cognito_breaker.is_open():
+                raise CognitoUnavailable("Cognito is unavailable")
+            authenticated_user = CognitoBackend().check_password(
+                self.user.username, old_password
+            )
+        except CognitoUnavailable:
+            raise forms.ValidationError(
+                _("We can't check your password right now, please try again later."),
+                code="cognito_unavailable",
+            )
         if authenticated_user is None:
             # Copy of the error in the super() call
             raise forms.ValidationError(
@@ -212,6 +212,10 @@ class SetPasswordMixin:
         """Save the new password.
 
         This saves the new password to Cognito (if enabled).
+
+        Raises:
+            CognitoUnavailable: when Cognito can't be reached (anymore), see
+                ``views.cognito_unavailable_message()``.
         """
         # Old behaviour if AWS is not setup (local situations)
         if not getattr(settings, "AWS_ACCESS_KEY_ID", None):
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 from django.http import HttpResponse
+from django.http import StreamingHttpResponse
 
 import json
 
@@ -24,3 +25,25 @@ def JsonError(error_string):
         "error": error_string,
     }
     return JsonResponse(data)
+
+
+def JsonStreamingResponse(key, batches, already_serialized=False):
+    """Stream ``{"success": true, key: [...]}`` as JSON.
+
+    ``batches`` is an iterable of lists of items (or of JSON strings, with
+    ``already_serialized``). Only one batch is in memory at a time, so this
+    works for lists that are too big to serialize at once.
+    """
+
+    def chunks():
+        yield '{"success": true, %s: [' % json.dumps(key)
+        separator = ""
+        for batch in batches:
+            if batch:
+                if not already_serialized:
+                    batch = [json.dumps(item) for item in batch]
+                yield separator + ", ".join(batch)
+                separator = ", "
+        yield "]}"
+
+    return StreamingHttpResponse(chunks(), content_type="application/json")
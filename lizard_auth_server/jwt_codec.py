@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+"""Encoding and verifying the JWT messages exchanged with the portals.
+
+The portals sign their messages with their ``sso_secret`` (HMAC). Instead of
+going through ``jwt.decode()``/``jwt.encode()`` for every request, this
+module keeps:
+
+- per secret and algorithm a prepared HMAC object (the key schedule is done
+  once, every signature starts from a ``copy()``),
+
+- the parsed headers: a portal sends the same header segment every time,
+
+- the allowed algorithms as a set computed at import time.
+
+The checks and the exceptions (``jwt.exceptions``, with the same messages)
+are those of PyJWT's ``jwt.decode()`` for HMAC keys, without leeway.
+``verify_message()`` turns them into the ``ValidationError`` messages of
+``forms.JWTDecryptForm``, so that code can verify a message without a form.
+
+"""
+from calendar import timegm
+from datetime import datetime
+from django.core.exceptions import ValidationError
+from jwt.algorithms import get_default_algorithms
+from jwt.algorithms import HMACAlgorithm
+from jwt.exceptions import DecodeError
+from jwt.exceptions import ExpiredSignatureError
+from jwt.exceptions import ImmatureSignatureError
+from jwt.exceptions import InvalidAlgorithmError
+from jwt.exceptions import InvalidAudienceError
+from jwt.exceptions import InvalidIssuedAtError
+from jwt.exceptions import InvalidIssuerError
+from jwt.exceptions import InvalidSignatureError
+from jwt.exceptions import InvalidTokenError
+from jwt.exceptions import MissingRequiredClaimError
+from jwt.utils import base64url_decode
+from jwt.utils import base64url_encode
+from lizard_auth_server import performance
+from lizard_auth_server.conf import settings
+from lizard_auth_server.models import Portal
+from lizard_auth_server.registry import portal_registry
+
+import binascii
+import functools
+import hmac
+import json
+
+
+# Incoming messages (from the portals) and outgoing messages (to the
+# portals) have separate settings.
+INCOMING_ALGORITHMS = frozenset([getattr(settings, "JWT_ALGORITHM", "HS256")])
+OUTGOING_ALGORITHM = settings.LIZARD_AUTH_SERVER_JWT_ALGORITHM
+
+TIME_CLAIMS = ("exp", "iat", "nbf")
+
+
+@functools.lru_cache(maxsize=256)
+def _prepared_hmac(secret, algorithm):
+    algorithm_object = get_default_algorithms().get(algorithm)
+    if not isinstance(algorithm_object, HMACAlgorithm):
+        raise InvalidAlgorithmError("Algorithm not supported")
+    return hmac.new(
+        algorithm_object.prepare_key(secret), digestmod=algorithm_object.hash_alg
+    )
+
+
+def _sign(secret, algorithm, signing_input):
+    signer = _prepared_hmac(secret, algorithm).copy()
+    signer.update(signing_input)
+    return signer.digest()
+
+
+@functools.lru_cache(maxsize=64)
+def _parse_header(header_segment):
+    # Note: the returned dict is shared, don't modify it.
+    try:
+        header_data = base64url_decode(header_segment)
+    except (TypeError, binascii.Error):
+        raise DecodeError("Invalid header padding")
+    try:
+        header = json.loads(header_data.decode("utf-8"))
+    except ValueError as e:
+        raise DecodeError("Invalid header string: %s" % e)
+    if not isinstance(header, dict):
+        raise DecodeError("Invalid header string: must be a json object")
+    return header
+
+
+@functools.lru_cache(maxsize=8)
+def _header_segment(algorithm):
+    header = json.dumps({"typ": "JWT", "alg": algorithm}, separators=(",", ":"))
+    return base64url_encode(header.encode("utf-8"))
+
+
+def encode(payload, secret, algorithm=OUTGOING_ALGORITHM):
+    """Return the signed JWT (bytes, like ``jwt.encode()``) of the payload.
+
+    ``datetime`` values of the ``exp``, ``iat`` and ``nbf`` claims are
+    converted to timestamps. The payload itself isn't modified.
+
+    """
+    payload = dict(payload)
+    for claim in TIME_CLAIMS:
+        if isinstance(payload.get(claim), datetime):
+            payload[claim] = timegm(payload[claim].utctimetuple())
+    json_payload = json.dumps(payload, separators=(",", ":")).encode("utf-8")
+    signing_input = b".".join(
+        [_header_segment(algorithm), base64url_encode(json_payload)]
+    )
+    signature = _sign(secret, algorithm, signing_input)
+    return b".".join([signing_input, base64url_encode(signature)])
+
+
+def decode(token, secret, algorithms=INCOMING_ALGORITHMS, issuer=None):
+    """Verify the token and return its payload.
+
+    Args:
+        token: the JWT (str or bytes).
+        secret: the shared secret of the portal.
+        algorithms: set of the allowed algorithms.
+        issuer: when given, the ``iss`` claim must match it.
+
+    Raises:
+        jwt.exceptions.InvalidTokenError: like ``jwt.decode()`` does.
+
+    """
+    if isinstance(token, str):
+        token = token.encode("utf-8")
+    if not isinstance(token, bytes):
+        raise DecodeError("Invalid token type. Token must be a %s" % bytes)
+    try:
+        signing_input, crypto_segment = token.rsplit(b".", 1)
+        header_segment, payload_segment = signing_input.split(b".", 1)
+    except ValueError:
+        raise DecodeError("Not enough segments")
+    header = _parse_header(header_segment)
+    try:
+        payload = base64url_decode(payload_segment)
+    except (TypeError, binascii.Error):
+        raise DecodeError("Invalid payload padding")
+    try:
+        signature = base64url_decode(crypto_segment)
+    except (TypeError, binascii.Error):
+        raise DecodeError("Invalid crypto padding")
+
+    algorithm = header.get("alg")
+    if algorithm is not None and not isinstance(algorithm, str):
+        # A list or a dict isn't hashable, the set lookup would fail.
+        raise DecodeError("Invalid header string: alg must be a string")
+    if algorithm not in algorithms:
+        raise InvalidAlgorithmError("The specified alg value is not allowed")
+    if not hmac.compare_digest(signature, _sign(secret, algorithm, signing_input)):
+        raise InvalidSignatureError("Signature verification failed")
+
+    try:
+        payload = json.loads(payload.decode("utf-8"))
+    except ValueError as e:
+        raise DecodeError("Invalid payload string: %s" % e)
+    if not isinstance(payload, dict):
+        raise DecodeError("Invalid payload string: must be a json object")
+    _validate_claims(payload, issuer)
+    return payload
+
+
+def _validate_claims(payload, issuer):
+    now = timegm(datetime.utcnow().utctimetuple())
+    if "iat" in payload:
+        try:
+            int(payload["iat"])
+        except (TypeError, ValueError):
+            raise InvalidIssuedAtError("Issued At claim (iat) must be an integer.")
+    if "nbf" in payload:
+        try:
+            nbf = int(payload["nbf"])
+        except (TypeError, ValueError):
+            raise DecodeError("Not Before claim (nbf) must be an integer.")
+        if nbf > now:
+            raise ImmatureSignatureError("The token is not yet valid (nbf)")
+    if "exp" in payload:
+        try:
+            exp = int(payload["exp"])
+        except (TypeError, ValueError):
+            raise DecodeError("Expiration Time claim (exp) must be an integer.")
+        if exp < now:
+            raise ExpiredSignatureError("Signature has expired")
+    if issuer is not None:
+        if "iss" not in payload:
+            raise MissingRequiredClaimError("iss")
+        if payload["iss"] != issuer:
+            raise InvalidIssuerError("Invalid issuer")
+    if "aud" in payload:
+        # We never expect an audience in the incoming messages.
+        raise InvalidAudienceError("Invalid audience")
+
+
+def verify_message(key, message):
+    """Return the portal and the payload of a message from a portal.
+
+    ``key`` is the ``sso_key`` of the portal, which must also be the ``iss``
+    of the payload. See ``forms.JWTDecryptForm``, which uses this.
+
+    Raises:
+        ValidationError: with the same messages as ``JWTDecryptForm``.
+
+    """
+    if not key:
+        raise ValidationError("No SSO key")
+    try:
+        portal = portal_registry.get(key)
+    except Portal.DoesNotExist:
+        raise ValidationError("Invalid SSO key")
+    try:
+        with performance.timed("jwt"):
+            payload = decode(message, portal.sso_secret, issuer=key)
+    except DecodeError:
+        raise ValidationError("Failed to decode JWT")
+    except ExpiredSignatureError:
+        raise ValidationError("JWT has expired")
+    except InvalidIssuerError:
+        raise ValidationError("Public SSO key does not match signed issuer")
+    except MissingRequiredClaimError:
+        raise ValidationError("JWT message misses 'iss' field (=SSO_KEY)")
+    except InvalidTokenError:
+        # The other errors (algorithm, signature, nbf, iat, aud).
+        raise ValidationError("Failed to decode JWT")
+    return portal, payload
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+"""Sending email, optionally through the outbox.
+
+With ``LIZARD_AUTH_SERVER_EMAIL_OUTBOX = True``, :func:`send_mail` doesn't
+talk to the mail server but stores the mail as an
+:class:`lizard_auth_server.models.OutgoingEmail`. That's part of the current
+transaction, so a rolled back request doesn't send anything and a request
+doesn't wait for the mail server. The ``send_queued_mail`` management
+command does the actual sending.
+
+"""
+from django.apps import apps
+from django.core import mail
+from lizard_auth_server import metrics
+from lizard_auth_server.conf import settings
+
+
+def send_mail(subject, message, from_email, recipient_list, html_message=None):
+    """Send or queue the mail, same arguments as Django's ``send_mail()``."""
+    if not settings.LIZARD_AUTH_SERVER_EMAIL_OUTBOX:
+        metrics.EMAILS.labels("direct").inc()
+        return mail.send_mail(
+            subject, message, from_email, recipient_list, html_message=html_message
+        )
+    # Imported here as models.py uses us.
+    OutgoingEmail = apps.get_model("lizard_auth_server", "OutgoingEmail")
+    OutgoingEmail.objects.create(
+        subject=subject,
+        body=message,
+        html_body=html_message or "",
+        from_email=from_email or "",
+        recipients="\n".join(recipient_list),
+    )
+    metrics.EMAILS.labels("queued").inc()
+    return len(recipient_list)
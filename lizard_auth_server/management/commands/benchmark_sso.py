@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from django.test.runner import DiscoverRunner
+from django.test.utils import override_settings
+from django.test.utils import setup_test_environment
+from django.test.utils import teardown_test_environment
+from lizard_auth_server import role_graph
+from lizard_auth_server.benchmarks import fixtures
+from lizard_auth_server.benchmarks import runner
+from lizard_auth_server.registry import portal_registry
+
+import contextlib
+import json
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    args = ""
+    help = (
+        "Benchmark the v1 and v2 SSO flows in a temporary test database and "
+        "report the throughput, latency and queries per endpoint."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--portals", type=int, default=3)
+        parser.add_argument("--organisations", type=int, default=20)
+        parser.add_argument(
+            "--roles", type=int, default=5, help="Number of roles per portal."
+        )
+        parser.add_argument("--users", type=int, default=200)
+        parser.add_argument(
+            "--iterations",
+            type=int,
+            default=50,
+            help="Number of times both flows run (default: 50).",
+        )
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument(
+            "--baseline",
+            metavar="PATH",
+            help="Compare the results with this JSON baseline.",
+        )
+        parser.add_argument(
+            "--save-baseline",
+            action="store_true",
+            help="Write the results to the --baseline file instead.",
+        )
+        parser.add_argument(
+            "--tolerance",
+            type=float,
+            default=0.2,
+            help="Allowed p95 slowdown compared with the baseline (default: 0.2).",
+        )
+        parser.add_argument(
+            "--fast-hasher",
+            action="store_true",
+            help="Hash passwords with MD5 to leave out the password hashing.",
+        )
+
+    def handle(self, *args, **options):
+        if options["save_baseline"] and not options["baseline"]:
+            raise CommandError("--save-baseline needs --baseline")
+        setup_test_environment()
+        test_runner = DiscoverRunner(verbosity=0, interactive=False)
+        old_config = test_runner.setup_databases()
+        try:
+            with self.isolated(options):
+                summary = self.benchmark(options)
+        finally:
+            test_runner.teardown_databases(old_config)
+            teardown_test_environment()
+
+        self.stdout.write(json.dumps(summary, indent=2))
+        if not options["baseline"]:
+            return
+        if options["save_baseline"]:
+            runner.save_baseline(options["baseline"], summary)
+            self.stdout.write("Saved the baseline in %s" % options["baseline"])
+            return
+        regressions = runner.compare(
+            summary, runner.load_baseline(options["baseline"]), options["tolerance"]
+        )
+        if regressions:
+            raise CommandError("Regressions:\n%s" % "\n".join(regressions))
+        self.stdout.write("No regressions compared with %s" % options["baseline"])
+
+    @contextlib.contextmanager
+    def isolated(self, options):
+        """Keep the benchmark away from the real caches and Cognito.
+
+        The temporary database hands out the same IDs as the real one, so
+        the cached user data, access vectors and catalogs would otherwise
+        end up under the keys of the real users. Every cache gets a private
+        local memory cache instead. The process-local portal registry and
+        role graph are reset before and after.
+
+        """
+        overrides = {
+            # Don't call Cognito.
+            "AUTHENTICATION_BACKENDS": ["django.contrib.auth.backends.ModelBackend"],
+            "AWS_ACCESS_KEY_ID": None,
+            "CACHES": {
+                alias: {
+                    "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+                    "LOCATION": "benchmark_sso-%s" % alias,
+                }
+                for alias in settings.CACHES
+            },
+        }
+        if options["fast_hasher"]:
+            overrides["PASSWORD_HASHERS"] = [
+                "django.contrib.auth.hashers.MD5PasswordHasher"
+            ]
+        portal_registry.clear()
+        role_graph.reset()
+        try:
+            with override_settings(**overrides):
+                yield
+        finally:
+            portal_registry.clear()
+            role_graph.reset()
+
+    def benchmark(self, options):
+        data = fixtures.create_fixtures(
+            portals=options["portals"],
+            organisations=options["organisations"],
+            roles_per_portal=options["roles"],
+            users=options["users"],
+            seed=options["seed"],
+        )
+        logger.info("Created the fixtures, running the flows")
+        recorder = runner.run(data, options["iterations"], options["seed"])
+        return recorder.summary()
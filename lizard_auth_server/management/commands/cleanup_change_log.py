@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from lizard_auth_server.conf import settings
+from lizard_auth_server.models import ChangeLogEntry
+
+import datetime
+import time
+
+
+class Command(BaseCommand):
+    args = ""
+    help = (
+        "Remove the change log entries older than "
+        "LIZARD_AUTH_SERVER_CHANGES_KEEP_DAYS, in batches. Portals with an "
+        "older cursor have to do a full sync again."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            help="Number of entries to delete per statement (default: 1000).",
+        )
+        parser.add_argument(
+            "--sleep",
+            type=float,
+            default=0,
+            metavar="SECONDS",
+            help="Pause between the batches to give other queries room.",
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Only count the old entries.",
+        )
+
+    def handle(self, *args, **options):
+        before = timezone.now() - datetime.timedelta(
+            days=settings.LIZARD_AUTH_SERVER_CHANGES_KEEP_DAYS
+        )
+        if options["dry_run"]:
+            count = ChangeLogEntry.objects.expired(before).count()
+            self.stdout.write("%s old change log entries" % count)
+            return
+
+        start = time.monotonic()
+        total = 0
+        for deleted in ChangeLogEntry.objects.prune(
+            before, options["batch_size"], options["sleep"]
+        ):
+            total += deleted
+            if options["verbosity"] > 1:
+                self.stdout.write("Deleted %s entries" % total)
+        elapsed = time.monotonic() - start
+        self.stdout.write(
+            "Deleted %s old change log entries in %.1f seconds" % (total, elapsed)
+        )
@@ -1,23 +1,60 @@
 # -*- coding: utf-8 -*-
 # Copyright 2011 Nelen & Schuurmans
-from django.conf import settings
 from django.core.management.base import BaseCommand
-from lizard_auth_server.models import Token
+from lizard_auth_server.token_store import get_token_store
 
-import datetime
 import logging
-import pytz
+import time
 
 
 logger = logging.getLogger(__name__)
 
-TOKEN_TIMEOUT = datetime.timedelta(minutes=settings.SSO_TOKEN_TIMEOUT_MINUTES)
-
 
 class Command(BaseCommand):
     args = ""
-    help = "Clear expired SSO tokens from the database."
+    help = (
+        "Clear expired SSO tokens from the database, in batches. Not needed "
+        "with the CacheTokenStore, the cache expires them by itself."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            help="Number of tokens to delete per statement (default: 1000).",
+        )
+        parser.add_argument(
+            "--sleep",
+            type=float,
+            default=0,
+            metavar="SECONDS",
+            help="Pause between the batches to give other queries room.",
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Only count the expired tokens.",
+        )
 
     def handle(self, *args, **options):
-        max_age = datetime.datetime.now(tz=pytz.UTC) - TOKEN_TIMEOUT
-        Token.objects.filter(created__lt=max_age).delete()
+        store = get_token_store()
+        if options["dry_run"]:
+            count = store.count_expired()
+            if count is None:
+                self.stdout.write("The token store expires tokens by itself")
+            else:
+                self.stdout.write("%s expired tokens" % count)
+            return
+
+        start = time.monotonic()
+        total = 0
+        for deleted in store.cleanup(options["batch_size"], options["sleep"]):
+            total += deleted
+            if options["verbosity"] > 1:
+                self.stdout.write("Deleted %s tokens" % total)
+        elapsed = time.monotonic() - start
+        self.stdout.write(
+            "Deleted %s expired tokens in %.1f seconds (%.0f tokens/s)"
+            % (total, elapsed, total / elapsed if elapsed else 0)
+        )
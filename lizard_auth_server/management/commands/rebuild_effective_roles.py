@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from lizard_auth_server.models import EffectiveOrganisationRole
+from lizard_auth_server.models import Portal
+from lizard_auth_server.models import UserProfile
+
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = (
+        "Rebuild the effective organisation roles of all user profiles and "
+        "verify them against the explanation of all_organisation_roles()."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--no-verify",
+            action="store_false",
+            dest="verify",
+            help="Only rebuild, don't compare with the explanation.",
+        )
+
+    def handle(self, *args, **options):
+        profile_ids = list(UserProfile.objects.values_list("id", flat=True))
+        EffectiveOrganisationRole.objects.rebuild_for_profiles(profile_ids)
+        self.stdout.write(
+            "Rebuilt the organisation roles of %s user profiles" % len(profile_ids)
+        )
+        if not options["verify"]:
+            return
+
+        portals = list(Portal.objects.filter(roles__isnull=False).distinct())
+        mismatches = 0
+        for profile in UserProfile.objects.select_related("user"):
+            for portal in portals:
+                explanation = profile.all_organisation_roles(
+                    portal, return_explanation=True
+                )
+                expected = set(
+                    organisation_role.id for organisation_role in explanation["results"]
+                )
+                found = set(
+                    profile.all_organisation_roles(portal).values_list("id", flat=True)
+                )
+                if expected != found:
+                    mismatches += 1
+                    logger.error(
+                        "Organisation roles of %s for %s differ: expected %s, got %s",
+                        profile.user.username,
+                        portal,
+                        sorted(expected),
+                        sorted(found),
+                    )
+        if mismatches:
+            raise CommandError(
+                "%s (user profile, portal) combinations differ from the "
+                "explanation, see the log" % mismatches
+            )
+        self.stdout.write("Verified against the explanation")
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+from django.core.mail import get_connection
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import F
+from django.db.models import Q
+from django.utils import timezone
+from lizard_auth_server.conf import settings
+from lizard_auth_server.models import OutgoingEmail
+
+import datetime
+import logging
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = (
+        "Send the mails in the outbox (see LIZARD_AUTH_SERVER_EMAIL_OUTBOX). "
+        "Failed mails are retried with an increasing delay."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=100,
+            help="Number of mails to send over one connection (default: 100).",
+        )
+        parser.add_argument(
+            "--loop",
+            type=float,
+            metavar="SECONDS",
+            help="Keep running, checking the outbox every SECONDS seconds.",
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            sent = self.send_batch(options["batch_size"])
+            while sent == options["batch_size"]:
+                sent = self.send_batch(options["batch_size"])
+            self.remove_old_mail()
+            if not options["loop"]:
+                return
+            time.sleep(options["loop"])
+
+    def send_batch(self, batch_size):
+        """Send a batch of due mails over a single connection.
+
+        Returns the number of mails we tried to send.
+
+        The mails are claimed in a short transaction and sent outside of it,
+        so a slow mail server doesn't keep a transaction open. Every result
+        is saved right after sending, so a failure afterwards doesn't send
+        the whole batch again.
+
+        """
+        emails = self.claim(batch_size)
+        if not emails:
+            return 0
+        connection = get_connection()
+        try:
+            connection.open()
+        except Exception as e:
+            for email in emails:
+                self.failed(email, e)
+            return len(emails)
+        try:
+            for email in emails:
+                try:
+                    email.as_message(connection=connection).send()
+                except Exception as e:
+                    self.failed(email, e)
+                else:
+                    email.sent_at = timezone.now()
+                    email.save(update_fields=["sent_at"])
+        finally:
+            connection.close()
+        return len(emails)
+
+    def claim(self, batch_size):
+        """Return due mails, leased to us for ``EMAIL_OUTBOX_LEASE`` seconds.
+
+        The attempt is counted right away, so a worker that dies while
+        sending doesn't get the mail retried forever. Other workers skip the
+        locked rows and, after the commit, the leased ones: they aren't due
+        until the lease expires.
+
+        """
+        now = timezone.now()
+        max_attempts = settings.LIZARD_AUTH_SERVER_EMAIL_OUTBOX_MAX_ATTEMPTS
+        lease = now + datetime.timedelta(
+            seconds=settings.LIZARD_AUTH_SERVER_EMAIL_OUTBOX_LEASE
+        )
+        with transaction.atomic():
+            emails = list(
+                OutgoingEmail.objects.due(now, max_attempts).select_for_update(
+                    skip_locked=True
+                )[:batch_size]
+            )
+            OutgoingEmail.objects.filter(pk__in=[email.pk for email in emails]).update(
+                attempts=F("attempts") + 1, next_attempt_at=lease
+            )
+        for email in emails:
+            email.attempts += 1
+            email.next_attempt_at = lease
+        return emails
+
+    def failed(self, email, error):
+        delay = settings.LIZARD_AUTH_SERVER_EMAIL_OUTBOX_RETRY_DELAY * 2 ** (
+            email.attempts - 1
+        )
+        email.next_attempt_at = timezone.now() + datetime.timedelta(seconds=delay)
+        email.last_error = str(error)
+        email.save(update_fields=["next_attempt_at", "last_error"])
+        max_attempts = settings.LIZARD_AUTH_SERVER_EMAIL_OUTBOX_MAX_ATTEMPTS
+        if email.attempts >= max_attempts:
+            logger.error(
+                "Giving up on mail %s to %s: %s", email.pk, email.recipients, error
+            )
+        else:
+            logger.warning(
+                "Sending mail %s failed, retrying in %s seconds: %s",
+                email.pk,
+                delay,
+                error,
+            )
+
+    def remove_old_mail(self):
+        """Remove sent mails and mails we gave up on after ``KEEP_DAYS``."""
+        cutoff = timezone.now() - datetime.timedelta(
+            days=settings.LIZARD_AUTH_SERVER_EMAIL_OUTBOX_KEEP_DAYS
+        )
+        max_attempts = settings.LIZARD_AUTH_SERVER_EMAIL_OUTBOX_MAX_ATTEMPTS
+        OutgoingEmail.objects.filter(
+            Q(sent_at__lt=cutoff)
+            | Q(
+                sent_at__isnull=True,
+                attempts__gte=max_attempts,
+                next_attempt_at__lt=cutoff,
+            )
+        ).delete()
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""Prometheus metrics of the SSO flows, exposed at ``/metrics``.
+
+The metrics are kept by ``prometheus_client``. Behind gunicorn (several
+worker processes), set the ``PROMETHEUS_MULTIPROC_DIR`` environment variable
+to an empty directory before the server starts: every process then keeps its
+metrics in mmap-ed files in that directory and ``/metrics`` adds them up. Also
+call ``prometheus_client.multiprocess.mark_process_dead(worker.pid)`` in
+gunicorn's ``child_exit`` hook.
+
+``/metrics`` isn't public: only staff users can read it, unless
+``LIZARD_AUTH_SERVER_METRICS_TOKEN`` is set, in which case a scraper can also
+read it with an ``Authorization: Bearer <token>`` header.
+
+"""
+from django.http import HttpResponse
+from django.http import HttpResponseForbidden
+from django.utils.crypto import constant_time_compare
+from lizard_auth_server.conf import settings
+from prometheus_client import CollectorRegistry
+from prometheus_client import CONTENT_TYPE_LATEST
+from prometheus_client import Counter
+from prometheus_client import generate_latest
+from prometheus_client import Histogram
+from prometheus_client import multiprocess
+from prometheus_client import REGISTRY
+
+import os
+
+
+LOGINS = Counter(
+    "lizard_auth_server_logins",
+    "Successful v2 logins, sent back to the portal.",
+)
+CREDENTIAL_CHECKS = Counter(
+    "lizard_auth_server_credential_checks",
+    "v2 credential checks (check_credentials) by outcome.",
+    ["outcome"],  # valid, invalid, inactive, bad_request, replay
+)
+SSO_TOKENS = Counter(
+    "lizard_auth_server_sso_tokens",
+    "v1 SSO tokens by event.",
+    ["event"],  # created, authorized, verified, timed_out
+)
+COGNITO_CALLS = Counter(
+    "lizard_auth_server_cognito_calls",
+    "Calls to Cognito by outcome.",
+    # success, error (the call was handled fine, but returned an error like
+    # "wrong password"), failure (timeouts, server errors) or short_circuited
+    # (not done because the circuit breaker is open).
+    ["outcome"],
+)
+COGNITO_CALL_DURATION = Histogram(
+    "lizard_auth_server_cognito_call_duration_seconds",
+    "Duration of the calls to Cognito.",
+)
+EMAILS = Counter(
+    "lizard_auth_server_emails",
+    "Emails sent directly or queued in the outbox.",
+    ["delivery"],  # direct, queued
+)
+
+
+def get_registry():
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return registry
+    return REGISTRY
+
+
+def _has_token(request):
+    token = settings.LIZARD_AUTH_SERVER_METRICS_TOKEN
+    return bool(token) and constant_time_compare(
+        request.META.get("HTTP_AUTHORIZATION", ""), "Bearer %s" % token
+    )
+
+
+def metrics_view(request):
+    if not (request.user.is_staff or _has_token(request)):
+        return HttpResponseForbidden("Invalid metrics token")
+    return HttpResponse(
+        generate_latest(get_registry()), content_type=CONTENT_TYPE_LATEST
+    )
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+from django.db import connections
+from lizard_auth_server import performance
+from lizard_auth_server import query_budgets
+from lizard_auth_server.conf import settings
+
+import json
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+class QueryCounter(object):
+    """Count the queries (and their time) of all database connections.
+
+    Django 1.11 has no ``connection.execute_wrapper()``, so we use the same
+    mechanism as ``CaptureQueriesContext``: force the debug cursor, which
+    logs every query with its duration (in whole milliseconds) in
+    ``connection.queries_log``. Django clears that log at the start of every
+    request.
+
+    """
+
+    def __enter__(self):
+        self.state = []
+        for connection in connections.all():
+            self.state.append(
+                (
+                    connection,
+                    connection.force_debug_cursor,
+                    len(connection.queries_log),
+                )
+            )
+            connection.force_debug_cursor = True
+        self.queries = 0
+        self.time_ms = 0.0
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        for connection, force_debug_cursor, start in self.state:
+            connection.force_debug_cursor = force_debug_cursor
+            queries = list(connection.queries_log)[start:]
+            self.queries += len(queries)
+            self.time_ms += sum(float(query["time"]) for query in queries) * 1000
+
+
+class PerformanceMiddleware(object):
+    """Measure every request, see ``performance.py``.
+
+    Requests that take longer than
+    ``LIZARD_AUTH_SERVER_PERFORMANCE_SLOW_REQUEST_MS`` or that do more queries
+    than their (cold) budget in ``query_budgets.py`` are logged as one JSON
+    line.
+    Put this middleware at the top of ``MIDDLEWARE`` to include the time
+    spent in the other middleware.
+
+    Note: the content of streaming responses is generated after the
+    middleware is done, so that part isn't measured.
+
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        timer = performance.start_request()
+        try:
+            with QueryCounter() as query_counter:
+                response = self.get_response(request)
+        finally:
+            performance.end_request()
+
+        resolver_match = getattr(request, "resolver_match", None)
+        url_name = (resolver_match and resolver_match.view_name) or (
+            performance.UNRESOLVED
+        )
+        measurements = {
+            "wall_ms": timer.elapsed_ms(),
+            "db_ms": query_counter.time_ms,
+            "queries": query_counter.queries,
+        }
+        for section, time_ms in timer.sections.items():
+            measurements["%s_ms" % section] = time_ms
+        performance.stats.observe(url_name, measurements)
+
+        threshold = settings.LIZARD_AUTH_SERVER_PERFORMANCE_SLOW_REQUEST_MS
+        if threshold is not None and measurements["wall_ms"] >= threshold:
+            self.log("slow_request", request, response, url_name, measurements)
+        budget = query_budgets.get_budget(url_name)
+        if budget is not None and measurements["queries"] > budget:
+            self.log(
+                "query_budget_exceeded",
+                request,
+                response,
+                url_name,
+                measurements,
+                budget=budget,
+            )
+        return response
+
+    def log(self, event, request, response, url_name, measurements, **extra):
+        log_line = {
+            "event": event,
+            "url_name": url_name,
+            "method": request.method,
+            "path": request.path,
+            "status": response.status_code,
+        }
+        log_line.update((name, round(value, 1)) for name, value in measurements.items())
+        log_line.update(extra)
+        logger.warning(json.dumps(log_line, sort_keys=True))
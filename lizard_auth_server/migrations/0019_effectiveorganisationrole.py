@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 00:39
+from __future__ import unicode_literals
+
+from django.db import migrations
+from django.db import models
+
+import collections
+import django.db.models.deletion
+
+
+def fill_effective_roles(apps, schema_editor):
+    """Fill the table for the existing user profiles.
+
+    This uses the historical models, so it repeats the rules of
+    models.compute_organisation_roles() instead of calling it.
+
+    """
+    db_alias = schema_editor.connection.alias
+    Role = apps.get_model("lizard_auth_server", "Role")
+    OrganisationRole = apps.get_model("lizard_auth_server", "OrganisationRole")
+    UserProfile = apps.get_model("lizard_auth_server", "UserProfile")
+    EffectiveOrganisationRole = apps.get_model(
+        "lizard_auth_server", "EffectiveOrganisationRole"
+    )
+
+    inheriting = collections.defaultdict(set)
+    inheritance = Role.inheriting_roles.through.objects.using(db_alias).values_list(
+        "from_role_id", "to_role_id"
+    )
+    for base_role_id, role_id in inheritance:
+        inheriting[base_role_id].add(role_id)
+    descendants = {}
+
+    def descendants_of(role_id):
+        # Inheritance is transitive and may contain cycles.
+        if role_id not in descendants:
+            found = set()
+            todo = [role_id]
+            while todo:
+                for inheriting_role_id in inheriting[todo.pop()]:
+                    if inheriting_role_id not in found:
+                        found.add(inheriting_role_id)
+                        todo.append(inheriting_role_id)
+            descendants[role_id] = found
+        return descendants[role_id]
+
+    # organisation role ID -> (organisation ID, role ID, portal ID)
+    details = {}
+    # (organisation ID, role ID) -> organisation role ID
+    by_organisation_and_role = {}
+    for_all_users = collections.defaultdict(set)
+    organisation_roles = OrganisationRole.objects.using(db_alias).values_list(
+        "id", "organisation_id", "role_id", "role__portal_id", "for_all_users"
+    )
+    for row in organisation_roles:
+        organisation_role_id, organisation_id, role_id, portal_id, for_all = row
+        details[organisation_role_id] = (organisation_id, role_id, portal_id)
+        by_organisation_and_role[(organisation_id, role_id)] = organisation_role_id
+        if for_all:
+            for_all_users[organisation_id].add(organisation_role_id)
+
+    accessible = collections.defaultdict(set)
+    direct_access = UserProfile.roles.through.objects.using(db_alias).values_list(
+        "userprofile_id", "organisationrole_id"
+    )
+    for profile_id, organisation_role_id in direct_access:
+        accessible[profile_id].add(organisation_role_id)
+    memberships = UserProfile.organisations.through.objects.using(db_alias).values_list(
+        "userprofile_id", "organisation_id"
+    )
+    for profile_id, organisation_id in memberships:
+        accessible[profile_id].update(for_all_users[organisation_id])
+
+    rows = []
+    for profile_id, organisation_role_ids in accessible.items():
+        effective = set(organisation_role_ids)
+        for organisation_role_id in organisation_role_ids:
+            organisation_id, role_id, _ = details[organisation_role_id]
+            for inheriting_role_id in descendants_of(role_id):
+                key = (organisation_id, inheriting_role_id)
+                if key in by_organisation_and_role:
+                    effective.add(by_organisation_and_role[key])
+        rows.extend(
+            EffectiveOrganisationRole(
+                user_profile_id=profile_id,
+                organisation_role_id=organisation_role_id,
+                portal_id=details[organisation_role_id][2],
+            )
+            for organisation_role_id in effective
+        )
+    EffectiveOrganisationRole.objects.using(db_alias).bulk_create(rows, batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("lizard_auth_server", "0018_userprofile_migrated_at"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="EffectiveOrganisationRole",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "organisation_role",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="effective_roles",
+                        to="lizard_auth_server.OrganisationRole",
+                        verbose_name="organisation role",
+                    ),
+                ),
+                (
+                    "portal",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="+",
+                        to="lizard_auth_server.Portal",
+                        verbose_name="portal",
+                    ),
+                ),
+                (
+                    "user_profile",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="effective_roles",
+                        to="lizard_auth_server.UserProfile",
+                        verbose_name="user profile",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "(effective organisation role)",
+                "verbose_name_plural": "(effective organisation roles)",
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name="effectiveorganisationrole",
+            unique_together=set([("user_profile", "organisation_role")]),
+        ),
+        migrations.AlterIndexTogether(
+            name="effectiveorganisationrole",
+            index_together=set([("user_profile", "portal")]),
+        ),
+        migrations.RunPython(fill_effective_roles, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 00:45
+from __future__ import unicode_literals
+
+from django.db import migrations
+from django.db import models
+
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("lizard_auth_server", "0019_effectiveorganisationrole"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ChangeLogEntry",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "created",
+                    models.DateTimeField(auto_now_add=True, verbose_name="created on"),
+                ),
+                (
+                    "object_type",
+                    models.CharField(
+                        choices=[
+                            ("user", "user"),
+                            ("organisation", "organisation"),
+                            ("role", "role"),
+                            ("organisation_role", "organisation role"),
+                        ],
+                        max_length=32,
+                        verbose_name="object type",
+                    ),
+                ),
+                (
+                    "object_id",
+                    models.CharField(
+                        help_text="username for users, unique id for organisations and roles, ID for organisation roles",
+                        max_length=255,
+                        verbose_name="object id",
+                    ),
+                ),
+                ("deleted", models.BooleanField(default=False, verbose_name="deleted")),
+                (
+                    "portal",
+                    models.ForeignKey(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="+",
+                        to="lizard_auth_server.Portal",
+                        verbose_name="portal",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "(change log entry)",
+                "verbose_name_plural": "(change log entries)",
+                "ordering": ("id",),
+            },
+        ),
+    ]
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 00:50
+from __future__ import unicode_literals
+
+from django.db import migrations
+from django.db import models
+
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("lizard_auth_server", "0020_changelogentry"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="OutgoingEmail",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "created_at",
+                    models.DateTimeField(auto_now_add=True, verbose_name="created at"),
+                ),
+                ("subject", models.CharField(max_length=255, verbose_name="subject")),
+                ("body", models.TextField(verbose_name="body")),
+                ("html_body", models.TextField(blank=True, verbose_name="html body")),
+                (
+                    "from_email",
+                    models.CharField(
+                        blank=True,
+                        help_text="empty means DEFAULT_FROM_EMAIL",
+                        max_length=255,
+                        verbose_name="from",
+                    ),
+                ),
+                (
+                    "recipients",
+                    models.TextField(
+                        help_text="one address per line", verbose_name="recipients"
+                    ),
+                ),
+                (
+                    "sent_at",
+                    models.DateTimeField(blank=True, null=True, verbose_name="sent at"),
+                ),
+                (
+                    "attempts",
+                    models.PositiveIntegerField(default=0, verbose_name="attempts"),
+                ),
+                (
+                    "next_attempt_at",
+                    models.DateTimeField(
+                        db_index=True,
+                        default=django.utils.timezone.now,
+                        verbose_name="next attempt at",
+                    ),
+                ),
+                ("last_error", models.TextField(blank=True, verbose_name="last error")),
+            ],
+            options={
+                "verbose_name": "(outgoing email)",
+                "verbose_name_plural": "(outgoing emails)",
+                "ordering": ("id",),
+            },
+        ),
+    ]
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 00:56
+from __future__ import unicode_literals
+
+from django.db import migrations
+from django.db import models
+
+import lizard_auth_server.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("lizard_auth_server", "0021_outgoingemail"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="token",
+            name="created",
+            field=models.DateTimeField(
+                db_index=True,
+                default=lizard_auth_server.models.token_creation_date,
+                verbose_name="created at",
+            ),
+        ),
+    ]
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+from django.db import migrations
+
+
+# Django 1.11 can't declare expression indexes, so we create them ourselves.
+# They're used by models.users_by_username() and models.users_by_email().
+INDEXES = [
+    ("lizard_auth_server_user_username_lower", "username"),
+    ("lizard_auth_server_user_email_lower", "email"),
+]
+VENDORS = ("postgresql", "sqlite")
+
+
+def create_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor not in VENDORS:
+        return
+    quote_name = schema_editor.quote_name
+    table = apps.get_model("auth", "User")._meta.db_table
+    for name, column in INDEXES:
+        schema_editor.execute(
+            "CREATE INDEX %s ON %s (LOWER(%s))"
+            % (quote_name(name), quote_name(table), quote_name(column))
+        )
+
+
+def drop_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor not in VENDORS:
+        return
+    for name, column in INDEXES:
+        schema_editor.execute(
+            "DROP INDEX IF EXISTS %s" % schema_editor.quote_name(name)
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("auth", "0001_initial"),
+        ("lizard_auth_server", "0022_token_created_index"),
+    ]
+
+    operations = [
+        migrations.RunPython(create_indexes, drop_indexes),
+    ]
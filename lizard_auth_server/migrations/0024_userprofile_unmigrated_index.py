@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+from django.db import migrations
+
+
+# A partial index on the profiles that haven't been migrated to Cognito yet.
+# Django 1.11 can't declare partial indexes, so we create it ourselves. It
+# makes the lookups of models.unmigrated_users_by_username() index-only on
+# the profile side, and it shrinks as the migration progresses.
+INDEX = "lizard_auth_server_userprofile_unmigrated"
+VENDORS = ("postgresql", "sqlite")
+
+
+def create_index(apps, schema_editor):
+    if schema_editor.connection.vendor not in VENDORS:
+        return
+    quote_name = schema_editor.quote_name
+    table = apps.get_model("lizard_auth_server", "UserProfile")._meta.db_table
+    schema_editor.execute(
+        "CREATE INDEX %s ON %s (%s) WHERE %s IS NULL"
+        % (
+            quote_name(INDEX),
+            quote_name(table),
+            quote_name("user_id"),
+            quote_name("migrated_at"),
+        )
+    )
+
+
+def drop_index(apps, schema_editor):
+    if schema_editor.connection.vendor not in VENDORS:
+        return
+    schema_editor.execute("DROP INDEX IF EXISTS %s" % schema_editor.quote_name(INDEX))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("lizard_auth_server", "0023_user_lower_indexes"),
+    ]
+
+    operations = [
+        migrations.RunPython(create_index, drop_index),
+    ]
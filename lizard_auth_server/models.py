@@ -1,37 +1,69 @@
 # -*- coding: utf-8 -*-
-from django.apps import apps
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.core.exceptions import ValidationError
-from django.core.mail import send_mail
+from django.core.mail import EmailMultiAlternatives
+from django.db import IntegrityError
 from django.db import models
 from django.db import transaction
-from django.db.models import F
+from django.db.models import Exists
+from django.db.models import OuterRef
+from django.db.models import Value
+from django.db.models.functions import Lower
 from django.db.models.query_utils import Q
 from django.template.loader import render_to_string
+from django.utils import timezone
 from django.utils import translation
 from django.utils.deconstruct import deconstructible
 from django.utils.translation import ugettext_lazy as _
+from lizard_auth_server import access_vectors
+from lizard_auth_server import role_graph
+from lizard_auth_server.mail import send_mail
 from lizard_auth_server.utils import gen_secret_key
 
+import collections
 import datetime
 import logging
 import pytz
+import time
 import uuid
 
 
 BILLING_ROLE = "billing"
 THREEDI_PORTAL = "3Di"
+# Keys are unique by virtue of their randomness, the unique constraints in
+# the database are the safety net. Retry an insert a few times on a collision.
+KEY_ATTEMPTS = 3
 
 
 logger = logging.getLogger(__name__)
 
 
+def save_with_new_keys(set_keys, save):
+    """Call ``set_keys()`` and ``save()``, retrying if a key is already taken.
+
+    The keys are 64 random characters, so a collision is practically
+    impossible. We don't check for one beforehand, we let the unique
+    constraint catch it.
+
+    """
+    for attempt in range(1, KEY_ATTEMPTS + 1):
+        set_keys()
+        try:
+            with transaction.atomic():
+                return save()
+        except IntegrityError:
+            if attempt == KEY_ATTEMPTS:
+                raise
+            logger.warning("Generated key collides with an existing one, retrying")
+
+
 @deconstructible
 class GenKey(object):
     """
-    Helper function to give a unique default value to the selected
-    field in a model.
+    Helper function to give a random default value to the selected
+    field in a model. The field should be unique: see
+    ``save_with_new_keys()``.
 
     Note: Field.default needs to be serializable (a change since Django 1.7).
     Here we use the deconstruct method described in:
@@ -44,16 +76,7 @@ class GenKey(object):
         self.field = field
 
     def __call__(self):
-        if isinstance(self.model, str):
-            ModelClass = apps.get_app_config("lizard_auth_server").get_model(self.model)
-            if not ModelClass:
-                raise Exception("Unknown model {}".format(self.model))
-        else:
-            ModelClass = self.model
-        key = gen_secret_key(64)
-        while ModelClass.objects.filter(**{self.field: key}).exists():
-            key = gen_secret_key(64)
-        return key
+        return gen_secret_key(64)
 
     def __eq__(self, other):
         return all([self.model == other.model, self.field == other.field])
@@ -116,9 +139,11 @@ class Portal(models.Model):
         return self.name
 
     def rotate_keys(self):
-        self.sso_secret = GenKey(Portal, "sso_secret")()
-        self.sso_key = GenKey(Portal, "sso_key")()
-        self.save()
+        def set_keys():
+            self.sso_secret = GenKey(Portal, "sso_secret")()
+            self.sso_key = GenKey(Portal, "sso_key")()
+
+        save_with_new_keys(set_keys, self.save)
 
     class Meta:
         ordering = ("name",)
@@ -131,19 +156,19 @@ class TokenManager(models.Manager):
         """
         Create a new token for a portal object.
         """
-        request_token = gen_secret_key(64)
-        auth_token = gen_secret_key(64)
-        # check unique constraints
-        while self.filter(
-            Q(request_token=request_token) | Q(auth_token=auth_token)
-        ).exists():
-            request_token = gen_secret_key(64)
-            auth_token = gen_secret_key(64)
-        return self.create(
-            portal=portal,
-            request_token=request_token,
-            auth_token=auth_token,
-        )
+        token = self.model(portal=portal)
+
+        def set_keys():
+            # One draw of random bytes for both keys.
+            keys = gen_secret_key(128)
+            token.request_token = keys[:64]
+            token.auth_token = keys[64:]
+
+        def save():
+            token.save(force_insert=True)
+            return token
+
+        return save_with_new_keys(set_keys, save)
 
 
 def token_creation_date():
@@ -173,7 +198,7 @@ class Token(models.Model):
         on_delete=models.CASCADE,
     )
     created = models.DateTimeField(
-        verbose_name=_("created at"), default=token_creation_date
+        verbose_name=_("created at"), default=token_creation_date, db_index=True
     )
 
     objects = TokenManager()
@@ -184,12 +209,108 @@ class Token(models.Model):
         ordering = ("-created",)
 
 
+def users_by_username(username):
+    """Return the users with this username, ignoring case.
+
+    ``username__iexact`` becomes ``UPPER(username) = UPPER(...)`` on
+    PostgreSQL, which can't use an index. This compares ``LOWER(username)``,
+    for which migration 0023 adds an index.
+
+    """
+    return User.objects.annotate(username_lower=Lower("username")).filter(
+        username_lower=Lower(Value(username))
+    )
+
+
+def users_by_email(email):
+    """Return the users with this email address, ignoring case.
+
+    See :func:`users_by_username`.
+
+    """
+    return User.objects.annotate(email_lower=Lower("email")).filter(
+        email_lower=Lower(Value(email))
+    )
+
+
+def unmigrated_users_by_username(username):
+    """Return the active users with this username (ignoring case) that
+    haven't been migrated to Cognito yet.
+
+    ``user_profile__migrated_at=None`` would be a LEFT JOIN, which also
+    matches users without a profile and can't use an index for that. Every
+    user has a profile (see ``signal_handlers.create_user_profile``), so we
+    check for an unmigrated profile with EXISTS instead. That is an
+    index-only lookup in the partial index from migration 0024.
+
+    """
+    unmigrated_profiles = UserProfile.objects.filter(
+        user=OuterRef("pk"), migrated_at=None
+    )
+    return (
+        users_by_username(username)
+        .annotate(unmigrated=Exists(unmigrated_profiles))
+        .filter(is_active=True, unmigrated=True)
+    )
+
+
 class UserProfileManager(models.Manager):
     def fetch_for_user(self, user):
         if not user:
             raise AttributeError("Can't get UserProfile without user")
         return self.get(user=user)
 
+    def with_access(self, portal):
+        """Return the profiles with access to the portal, with their user.
+
+        Same selection as ``UserProfile.has_access()``, but done in a single
+        query instead of a few per user.
+        """
+        return (
+            self.filter(Q(portals=portal) | Q(user__is_staff=True))
+            .distinct()
+            .select_related("user")
+        )
+
+    def organisation_roles_for_usernames(self, usernames, portal):
+        """Return the organisation roles of many users at once.
+
+        This is the batch version of :meth:`UserProfile.all_organisation_roles`.
+        The number of queries doesn't depend on the number of users (apart
+        from chunking the usernames to keep the queries within database
+        limits).
+
+        Returns:
+            dict mapping username to a list of ``[organisation unique_id,
+            role unique_id]`` pairs. Unknown usernames are omitted.
+
+        """
+        usernames = sorted(set(usernames))
+        result = {}
+        chunk_size = EffectiveOrganisationRoleManager.chunk_size
+        for start in range(0, len(usernames), chunk_size):
+            end = start + chunk_size
+            chunk = usernames[start:end]
+            found = self.filter(user__username__in=chunk).values_list(
+                "user__username", flat=True
+            )
+            for username in found:
+                result[username] = []
+            rows = (
+                EffectiveOrganisationRole.objects.filter(
+                    user_profile__user__username__in=chunk, portal=portal
+                )
+                .order_by("organisation_role_id")
+                .values_list(
+                    "user_profile__user__username",
+                    "organisation_role__organisation__unique_id",
+                    "organisation_role__role__unique_id",
+                )
+            )
+            for username, organisation_unique_id, role_unique_id in rows:
+                result[username].append([organisation_unique_id, role_unique_id])
+        return result
+
 
 class UserProfile(models.Model):
     user = models.OneToOneField(
@@ -274,6 +395,10 @@ class UserProfile(models.Model):
 
         For backward compatibility. Instead of many Organisation objects, a
         user used to have a single organisation string."""
+        if "organisations" in getattr(self, "_prefetched_objects_cache", {}):
+            # Don't do a query per profile when listing many profiles.
+            organisations = sorted(self.organisations.all(), key=lambda org: org.id)
+            return organisations[0].name if organisations else None
         try:
             return self.organisations.all().order_by("id")[0:1].get().name
         except Organisation.DoesNotExist:
@@ -298,79 +423,127 @@ class UserProfile(models.Model):
         if self.user.is_staff:
             # staff can access any site
             return True
-        return self.portals.filter(pk=portal.pk).exists()
+        return access_vectors.has_portal(self.id, portal.id)
+
+    def has_role(self, portal, role):
+        """
+        Returns True when one of the organisation roles that apply to this
+        user for this portal has this role.
+        """
+        return access_vectors.has_role(self.id, portal.id, role.id)
 
     def all_organisation_roles(self, portal, return_explanation=False):
         """Return a queryset of OrganisationRoles that apply to this profile.
 
+        The organisation roles are read from the denormalized
+        :class:`EffectiveOrganisationRole` table. The explanation resolves
+        the roles per profile with the role graph (see ``role_graph.py``):
+        the ``rebuild_effective_roles`` management command checks the table
+        against its ``results``. When the cached access vector of the profile
+        (see ``access_vectors.py``) has no roles for the portal, the table
+        isn't queried at all.
+
         If ``return_explanation`` is True, return a dict with explanatory
-        results, instead.
+        results (lists of model instances), instead.
         """
-        # First grab all applicable roles.
-        relevant_roles_tied_to_the_portal = Role.objects.filter(portal=portal)
+        if not return_explanation:
+            vector = access_vectors.get(self.id, build=False)
+            if vector is not None and not vector[1].get(portal.id):
+                # No roles at all for this portal, no need to ask the database.
+                return OrganisationRole.objects.none()
+            return OrganisationRole.objects.filter(
+                effective_roles__user_profile=self, effective_roles__portal=portal
+            )
+
+        graph = role_graph.get_role_graph()
+        portal_roles = graph.portal_masks.get(portal.id, 0)
+        relevant_roles_tied_to_the_portal = list(Role.objects.filter(portal=portal))
 
-        # Two Q objects for filtering organisation roles I have access
-        # to. Either directly via my profile or via for_all_users.
-        tied_to_my_organisation_for_all_users = models.Q(
-            for_all_users=True, organisation__user_profiles=self
+        # All organisation roles I have access to: directly via my profile or
+        # via for_all_users. This does not yet take into account the
+        # organisation roles I get via the role inheritance.
+        organisation_roles_directly = list(
+            OrganisationRole.objects.filter(user_profiles=self)
         )
-        tied_to_my_user_profile = models.Q(user_profiles=self)
-        # All organisation roles I have access to. This does not yet take into
-        # account the organisation roles I get via the role inheritance
-        organisation_roles_i_can_access = OrganisationRole.objects.filter(
-            tied_to_my_organisation_for_all_users | tied_to_my_user_profile
+        organisation_roles_via_organisation = list(
+            OrganisationRole.objects.filter(
+                for_all_users=True, organisation__user_profiles=self
+            ).distinct()
         )
-
-        # Two criteria for filtering organisation roles.
+        organisation_roles_i_can_access = {
+            organisation_role.id: organisation_role
+            for organisation_role in (
+                organisation_roles_directly + organisation_roles_via_organisation
+            )
+        }
 
         # The simple case is that an organisation role is both in our access
         # list AND it points at a relevant role. Bingo.
-        relevant_role_and_direct_access = models.Q(
-            id__in=organisation_roles_i_can_access,
-            role__in=relevant_roles_tied_to_the_portal,
+        direct_results = sorted(
+            (
+                organisation_role
+                for organisation_role in organisation_roles_i_can_access.values()
+                if graph.bit(organisation_role.role_id) & portal_roles
+            ),
+            key=lambda organisation_role: organisation_role.id,
         )
 
-        # The elaborate case is that a role must of course be a relevant
-        # role. Then that same role must have a base role with an organisation
-        # role that I can access. That same organisation role must also have
-        # the same organisation as the organisation role I'm looking
-        # from. Django ensures those "the same" items are really the
-        # same.
-        relevant_role_and_indirect_access_with_matching_org = models.Q(
-            role__in=relevant_roles_tied_to_the_portal,
-            role__base_roles__organisation_roles__in=organisation_roles_i_can_access,
-            role__base_roles__organisation_roles__organisation=F("organisation"),
+        # The elaborate case is that a relevant role inherits (via any number
+        # of base roles) from a role with an organisation role that I can
+        # access, for the same organisation. Per organisation, collect the
+        # roles I can access as a bitset and compare it with the ancestors of
+        # the candidates.
+        accessible_roles = collections.defaultdict(int)
+        for organisation_role in organisation_roles_i_can_access.values():
+            accessible_roles[organisation_role.organisation_id] |= graph.bit(
+                organisation_role.role_id
+            )
+        candidates = graph.descendant_ids(
+            [
+                organisation_role.role_id
+                for organisation_role in organisation_roles_i_can_access.values()
+            ],
+            portal_id=portal.id,
         )
-
-        results = OrganisationRole.objects.filter(
-            relevant_role_and_direct_access
-            | relevant_role_and_indirect_access_with_matching_org
-        ).distinct()
-
-        if return_explanation:
-            organisation_roles_directly = OrganisationRole.objects.filter(
-                tied_to_my_user_profile
+        indirect_results = [
+            organisation_role
+            for organisation_role in OrganisationRole.objects.filter(
+                role_id__in=list(candidates),
+                organisation_id__in=list(accessible_roles),
+            ).order_by("id")
+            if graph.ancestors_of(organisation_role.role_id)
+            & accessible_roles[organisation_role.organisation_id]
+        ]
+
+        results = {
+            organisation_role.id: organisation_role
+            for organisation_role in direct_results + indirect_results
+        }
+        results = [results[key] for key in sorted(results)]
+
+        # Roles of this portal that inherit from each other in a circle.
+        inheritance_cycles = [
+            cycle
+            for cycle in graph.cycles
+            if any(graph.bit(role_id) & portal_roles for role_id in cycle)
+        ]
+        if inheritance_cycles:
+            roles = Role.objects.in_bulk(
+                [role_id for cycle in inheritance_cycles for role_id in cycle]
             )
-            organisation_roles_via_organisation = OrganisationRole.objects.filter(
-                tied_to_my_organisation_for_all_users
-            ).distinct()
-            direct_results = OrganisationRole.objects.filter(
-                relevant_role_and_direct_access
-            ).distinct()
-            indirect_results = OrganisationRole.objects.filter(
-                relevant_role_and_indirect_access_with_matching_org
-            ).distinct()
-
-            return {
-                "relevant_roles_tied_to_the_portal": relevant_roles_tied_to_the_portal,
-                "organisation_roles_directly": organisation_roles_directly,
-                "organisation_roles_via_organisation": organisation_roles_via_organisation,
-                "direct_results": direct_results,
-                "indirect_results": indirect_results,
-                "results": results,
-            }
+            inheritance_cycles = [
+                [roles[role_id] for role_id in cycle] for cycle in inheritance_cycles
+            ]
 
-        return results
+        return {
+            "relevant_roles_tied_to_the_portal": relevant_roles_tied_to_the_portal,
+            "organisation_roles_directly": organisation_roles_directly,
+            "organisation_roles_via_organisation": organisation_roles_via_organisation,
+            "direct_results": direct_results,
+            "indirect_results": indirect_results,
+            "results": results,
+            "inheritance_cycles": inheritance_cycles,
+        }
 
 
 class Invitation(models.Model):
@@ -433,12 +606,13 @@ class Invitation(models.Model):
         if self.is_activated:
             raise Exception("user is already activated")
 
-        # generate a new activation key
-        self.activation_key = GenKey(Invitation, "activation_key")()
+        def set_keys():
+            # generate a new activation key
+            self.activation_key = GenKey(Invitation, "activation_key")()
 
         # update key date so we can check for expiration
         self.activation_key_date = datetime.datetime.now(tz=pytz.UTC)
-        self.save()
+        save_with_new_keys(set_keys, self.save)
 
     def get_context(self, **extra):
         """Create the context for rendering the invitation email."""
@@ -699,3 +873,367 @@ class OrganisationRole(models.Model):
             "organisation": self.organisation.as_dict(),
             "role": self.role.as_dict(),
         }
+
+
+def compute_organisation_roles(profile_ids):
+    """Return the organisation roles that apply to the given user profiles.
+
+    This is the set-based version of the query in
+    :meth:`UserProfile.all_organisation_roles`: an organisation role applies
+    when the profile has access to it (directly or via a ``for_all_users``
+    organisation role of one of its organisations) or when the profile has
+    access to an organisation role of one of its base roles *for the same
+    organisation*. Inheritance is transitive: the base roles of the base
+    roles count as well, see ``role_graph.py``.
+
+    The number of queries doesn't depend on the number of profiles.
+
+    Returns:
+        dict mapping profile ID to a set of (organisation role ID, portal ID)
+        tuples.
+
+    """
+    profile_ids = list(profile_ids)
+    accessible = collections.defaultdict(set)
+    direct_access = UserProfile.roles.through.objects.filter(
+        userprofile_id__in=profile_ids
+    ).values_list("userprofile_id", "organisationrole_id")
+    for profile_id, organisation_role_id in direct_access:
+        accessible[profile_id].add(organisation_role_id)
+
+    members = collections.defaultdict(set)
+    memberships = UserProfile.organisations.through.objects.filter(
+        userprofile_id__in=profile_ids
+    ).values_list("userprofile_id", "organisation_id")
+    for profile_id, organisation_id in memberships:
+        members[organisation_id].add(profile_id)
+    for_all_users = OrganisationRole.objects.filter(
+        for_all_users=True, organisation_id__in=list(members)
+    ).values_list("id", "organisation_id")
+    for organisation_role_id, organisation_id in for_all_users:
+        for profile_id in members[organisation_id]:
+            accessible[profile_id].add(organisation_role_id)
+
+    result = {profile_id: set() for profile_id in profile_ids}
+    all_accessible = set().union(*accessible.values())
+    if not all_accessible:
+        return result
+
+    # organisation role ID -> (organisation ID, role ID, portal ID)
+    details = {}
+    for row in OrganisationRole.objects.filter(id__in=all_accessible).values_list(
+        "id", "organisation_id", "role_id", "role__portal_id"
+    ):
+        details[row[0]] = row[1:]
+    organisation_ids = set(row[0] for row in details.values())
+    role_ids = set(row[1] for row in details.values())
+
+    # Organisation roles of the roles that inherit from an accessible role, in
+    # the same organisations. The role graph knows the inheriting roles at any
+    # depth, so this is one query regardless of the depth of the inheritance.
+    graph = role_graph.get_role_graph()
+    inherited = list(
+        OrganisationRole.objects.filter(
+            role_id__in=list(graph.descendant_ids(role_ids)),
+            organisation_id__in=organisation_ids,
+        ).values_list("id", "organisation_id", "role_id", "role__portal_id")
+    )
+
+    for profile_id, organisation_role_ids in accessible.items():
+        # organisation ID -> bitset of the roles the profile has access to
+        accessible_roles = collections.defaultdict(int)
+        for organisation_role_id in organisation_role_ids & details.keys():
+            organisation_id, role_id, portal_id = details[organisation_role_id]
+            accessible_roles[organisation_id] |= graph.bit(role_id)
+            result[profile_id].add((organisation_role_id, portal_id))
+        for organisation_role_id, organisation_id, role_id, portal_id in inherited:
+            if graph.ancestors_of(role_id) & accessible_roles.get(organisation_id, 0):
+                result[profile_id].add((organisation_role_id, portal_id))
+    return result
+
+
+class EffectiveOrganisationRoleManager(models.Manager):
+    # Stay below sqlite's limit on the number of query parameters.
+    chunk_size = 500
+
+    def rebuild_for_profiles(self, profile_ids):
+        """Recompute the stored organisation roles of these user profiles."""
+        profile_ids = sorted(set(profile_ids))
+        for start in range(0, len(profile_ids), self.chunk_size):
+            end = start + self.chunk_size
+            chunk = profile_ids[start:end]
+            with transaction.atomic():
+                # Concurrent rebuilds of the same profile wait for each
+                # other, so the last one computes from the latest data.
+                list(
+                    UserProfile.objects.select_for_update()
+                    .filter(id__in=chunk)
+                    .order_by("id")
+                    .values_list("id", flat=True)
+                )
+                computed = compute_organisation_roles(chunk)
+                self.filter(user_profile_id__in=chunk).delete()
+                self.bulk_create(
+                    [
+                        self.model(
+                            user_profile_id=profile_id,
+                            organisation_role_id=organisation_role_id,
+                            portal_id=portal_id,
+                        )
+                        for profile_id, found in computed.items()
+                        for organisation_role_id, portal_id in found
+                    ]
+                )
+            access_vectors.invalidate(chunk)
+
+    def affected_profile_ids(self, role_ids=(), organisation_role_ids=()):
+        """Return IDs of profiles whose organisation roles might change.
+
+        Role inheritance only works within an organisation, so a change to an
+        organisation role (or to the role it points at) can only affect the
+        members of its organisation and the profiles with access to one of
+        the organisation's organisation roles.
+
+        """
+        organisation_ids = OrganisationRole.objects.filter(
+            Q(id__in=list(organisation_role_ids)) | Q(role_id__in=list(role_ids))
+        ).values("organisation_id")
+        return set(
+            UserProfile.objects.filter(
+                Q(roles__organisation__in=organisation_ids)
+                | Q(organisations__in=organisation_ids)
+            ).values_list("id", flat=True)
+        )
+
+
+class EffectiveOrganisationRole(models.Model):
+    """Denormalized: an organisation role that applies to a user profile.
+
+    This is what :meth:`UserProfile.all_organisation_roles` reads. The signal
+    handlers keep it up to date when roles, organisation memberships or role
+    inheritance change. The ``rebuild_effective_roles`` management command
+    rebuilds it from scratch.
+
+    """
+
+    user_profile = models.ForeignKey(
+        UserProfile,
+        related_name="effective_roles",
+        verbose_name=_("user profile"),
+        on_delete=models.CASCADE,
+    )
+    portal = models.ForeignKey(
+        Portal,
+        related_name="+",
+        verbose_name=_("portal"),
+        on_delete=models.CASCADE,
+    )
+    organisation_role = models.ForeignKey(
+        OrganisationRole,
+        related_name="effective_roles",
+        verbose_name=_("organisation role"),
+        on_delete=models.CASCADE,
+    )
+
+    objects = EffectiveOrganisationRoleManager()
+
+    class Meta:
+        unique_together = (("user_profile", "organisation_role"),)
+        index_together = (("user_profile", "portal"),)
+        verbose_name = _("(effective organisation role)")
+        verbose_name_plural = _("(effective organisation roles)")
+
+
+class ChangeLogEntryManager(models.Manager):
+    def log(self, object_type, object_ids, deleted=False, portal_id=None):
+        """Append an entry for every one of the object IDs."""
+        self.bulk_create(
+            [
+                self.model(
+                    object_type=object_type,
+                    object_id=object_id,
+                    deleted=deleted,
+                    portal_id=portal_id,
+                )
+                for object_id in object_ids
+            ]
+        )
+
+    def latest_cursor(self, settled_at):
+        """Return the cursor of the last entry created at or before settled_at."""
+        entries = self.filter(created__lte=settled_at)
+        return entries.aggregate(cursor=models.Max("id"))["cursor"] or 0
+
+    def oldest_cursor(self):
+        """Return the oldest cursor that the kept entries are complete for.
+
+        Older cursors may have missed entries that were pruned since.
+        """
+        oldest = self.order_by("id").values_list("id", flat=True).first()
+        return oldest - 1 if oldest else 0
+
+    def expired(self, before):
+        """Return the entries created before ``before``.
+
+        The last entry is always kept, otherwise ``oldest_cursor()`` would
+        accept every cursor once everything has been pruned.
+        """
+        last = self.order_by("-id").values_list("id", flat=True).first()
+        return self.filter(created__lt=before, id__lt=last or 0)
+
+    def prune(self, before, batch_size=1000, sleep=0):
+        """Remove the entries created before ``before`` in batches.
+
+        Every batch is a short DELETE by primary key, like
+        ``DatabaseTokenStore.cleanup()``. Yields the number of removed
+        entries per batch.
+
+        """
+        while True:
+            ids = list(
+                self.expired(before)
+                .order_by("id")
+                .values_list("id", flat=True)[:batch_size]
+            )
+            if not ids:
+                return
+            yield self.filter(id__in=ids)._raw_delete(self.db)
+            if len(ids) < batch_size:
+                return
+            if sleep:
+                time.sleep(sleep)
+
+    def since(self, cursor, portal, limit, settled_at):
+        """Return entries after ``cursor`` that are relevant for the portal.
+
+        Roles and organisation roles belong to a portal; users and
+        organisations are visible for every portal.
+
+        The IDs are handed out when the entries are inserted, but the
+        transactions can commit in another order: entry 104 can still be
+        invisible when 105 is read already. A client that got cursor 105
+        would never see 104. So we only return entries created at or before
+        ``settled_at``, which should be longer ago than the longest
+        transaction takes.
+
+        """
+        return self.filter(
+            Q(portal__isnull=True) | Q(portal=portal),
+            id__gt=cursor,
+            created__lte=settled_at,
+        ).order_by("id")[:limit]
+
+
+class ChangeLogEntry(models.Model):
+    """Append-only log of changes, the basis for the v2 changes feed.
+
+    The ID is the cursor that clients pass to get the changes since their
+    previous sync. We only store *what* changed, the feed returns the
+    current state of the objects.
+
+    """
+
+    USER = "user"
+    ORGANISATION = "organisation"
+    ROLE = "role"
+    ORGANISATION_ROLE = "organisation_role"
+    OBJECT_TYPES = (
+        (USER, _("user")),
+        (ORGANISATION, _("organisation")),
+        (ROLE, _("role")),
+        (ORGANISATION_ROLE, _("organisation role")),
+    )
+
+    created = models.DateTimeField(verbose_name=_("created on"), auto_now_add=True)
+    object_type = models.CharField(
+        verbose_name=_("object type"), max_length=32, choices=OBJECT_TYPES
+    )
+    object_id = models.CharField(
+        verbose_name=_("object id"),
+        max_length=255,
+        help_text=_(
+            "username for users, unique id for organisations and roles, ID "
+            "for organisation roles"
+        ),
+    )
+    deleted = models.BooleanField(verbose_name=_("deleted"), default=False)
+    portal = models.ForeignKey(
+        Portal,
+        related_name="+",
+        verbose_name=_("portal"),
+        null=True,
+        blank=True,
+        on_delete=models.CASCADE,
+    )
+
+    objects = ChangeLogEntryManager()
+
+    class Meta:
+        ordering = ("id",)
+        verbose_name = _("(change log entry)")
+        verbose_name_plural = _("(change log entries)")
+
+    def __str__(self):
+        return "%s %s %s" % (
+            self.object_type,
+            self.object_id,
+            "deleted" if self.deleted else "changed",
+        )
+
+
+class OutgoingEmailManager(models.Manager):
+    def due(self, now, max_attempts):
+        """Return the unsent mails that should be (re)tried now."""
+        return self.filter(
+            sent_at__isnull=True, next_attempt_at__lte=now, attempts__lt=max_attempts
+        ).order_by("id")
+
+
+class OutgoingEmail(models.Model):
+    """Mail waiting to be sent by the ``send_queued_mail`` command.
+
+    See ``mail.py``.
+
+    """
+
+    created_at = models.DateTimeField(verbose_name=_("created at"), auto_now_add=True)
+    subject = models.CharField(verbose_name=_("subject"), max_length=255)
+    body = models.TextField(verbose_name=_("body"))
+    html_body = models.TextField(verbose_name=_("html body"), blank=True)
+    from_email = models.CharField(
+        verbose_name=_("from"),
+        max_length=255,
+        blank=True,
+        help_text=_("empty means DEFAULT_FROM_EMAIL"),
+    )
+    recipients = models.TextField(
+        verbose_name=_("recipients"), help_text=_("one address per line")
+    )
+    sent_at = models.DateTimeField(verbose_name=_("sent at"), null=True, blank=True)
+    attempts = models.PositiveIntegerField(verbose_name=_("attempts"), default=0)
+    next_attempt_at = models.DateTimeField(
+        verbose_name=_("next attempt at"), default=timezone.now, db_index=True
+    )
+    last_error = models.TextField(verbose_name=_("last error"), blank=True)
+
+    objects = OutgoingEmailManager()
+
+    class Meta:
+        ordering = ("id",)
+        verbose_name = _("(outgoing email)")
+        verbose_name_plural = _("(outgoing emails)")
+
+    def __str__(self):
+        return self.subject
+
+    def as_message(self, connection=None):
+        message = EmailMultiAlternatives(
+            subject=self.subject,
+            body=self.body,
+            from_email=self.from_email or None,
+            to=self.recipients.splitlines(),
+            connection=connection,
+        )
+        if self.html_body:
+            message.attach_alternative(self.html_body, "text/html")
+        return message
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""Per-process request performance statistics.
+
+``middleware.PerformanceMiddleware`` measures every request: the wall time,
+the number of database queries and their time, and the time spent in the
+sections that the code marks with ``timed()`` ("cognito" and "jwt"). The
+measurements are aggregated per URL name into histograms, which staff
+members can see at ``/performance/``.
+
+Every server process keeps its own statistics, so the endpoint shows the
+numbers of the process that happens to handle the request.
+
+"""
+from collections import OrderedDict
+
+import bisect
+import contextlib
+import threading
+import time
+
+
+SECTIONS = ("cognito", "jwt")
+# Upper bounds of the histogram buckets, like prometheus' "le".
+TIME_BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)  # ms
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+UNRESOLVED = "<unresolved>"
+
+_local = threading.local()
+
+
+class Histogram(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # The last one is +Inf.
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative_counts(self):
+        """Return [(upper bound, number of values <= bound)], ending with +Inf."""
+        result = []
+        total = 0
+        for bound, count in zip(self.buckets + ("+Inf",), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+    def as_dict(self):
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 3),
+            "buckets": self.cumulative_counts(),
+        }
+
+
+class EndpointStats(object):
+    def __init__(self):
+        self.histograms = OrderedDict(
+            [
+                ("wall_ms", Histogram(TIME_BUCKETS)),
+                ("db_ms", Histogram(TIME_BUCKETS)),
+                ("queries", Histogram(QUERY_BUCKETS)),
+            ]
+            + [("%s_ms" % section, Histogram(TIME_BUCKETS)) for section in SECTIONS]
+        )
+
+    def observe(self, measurements):
+        for name, histogram in self.histograms.items():
+            histogram.observe(measurements.get(name, 0))
+
+    def as_dict(self):
+        return OrderedDict(
+            (name, histogram.as_dict()) for name, histogram in self.histograms.items()
+        )
+
+
+class PerformanceStats(object):
+    """The histograms per URL name of this process."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.endpoints = {}
+
+    def observe(self, url_name, measurements):
+        with self.lock:
+            if url_name not in self.endpoints:
+                self.endpoints[url_name] = EndpointStats()
+            self.endpoints[url_name].observe(measurements)
+
+    def snapshot(self):
+        with self.lock:
+            return OrderedDict(
+                (url_name, self.endpoints[url_name].as_dict())
+                for url_name in sorted(self.endpoints)
+            )
+
+    def reset(self):
+        with self.lock:
+            self.endpoints = {}
+
+
+stats = PerformanceStats()
+
+
+class RequestTimer(object):
+    """Time spent in the ``timed()`` sections during one request."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.sections = dict.fromkeys(SECTIONS, 0.0)
+        self.active = set()
+
+    def elapsed_ms(self):
+        return (time.perf_counter() - self.start) * 1000
+
+
+def start_request():
+    _local.timer = RequestTimer()
+    return _local.timer
+
+
+def end_request():
+    _local.timer = None
+
+
+@contextlib.contextmanager
+def timed(section):
+    """Add the time spent in the block to the section of the current request.
+
+    Outside of a measured request (or nested in the same section) this does
+    nothing.
+
+    """
+    timer = getattr(_local, "timer", None)
+    if timer is None or section in timer.active:
+        yield
+        return
+    timer.active.add(section)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timer.sections[section] += (time.perf_counter() - start) * 1000
+        timer.active.discard(section)
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""The maximum number of database queries per request of the hot endpoints.
+
+The number of queries of these endpoints must not grow with the number of
+users, organisations, roles or permissions. ``tests/test_query_budgets.py``
+replays every endpoint against a small and a bigger data set and fails when
+the count differs between the two or when it exceeds the budget below. When
+a change really needs an extra query, raise the budget in the same commit.
+
+``BUDGETS`` is for the steady state, with the caches (the Django cache, the
+portal registry) filled. ``COLD_BUDGETS`` is for a request right after the
+caches were emptied, which builds the cached data (user data, access
+vectors, role graph, catalog snapshots) again.
+
+With ``middleware.PerformanceMiddleware`` installed, requests that exceed
+their cold budget in production are logged as a JSON line as well. A cache
+miss isn't a reason to log a request.
+
+"""
+
+BUDGETS = {
+    # v1 API, called by the portals.
+    "lizard_auth_server.api.get_user": 2,
+    "lizard_auth_server.api.get_users": 1,
+    "lizard_auth_server.api.get_organisations": 0,
+    "lizard_auth_server.api.roles": 1,
+    "lizard_auth_server.api.user_organisation_roles": 2,
+    "lizard_auth_server.api.user_organisation_roles_batch": 2,
+    # v1 SSO.
+    "lizard_auth_server.sso.api.request_token": 3,
+    "lizard_auth_server.sso.authorize": 6,
+    "lizard_auth_server.sso.api.verify": 5,
+    # v2 API.
+    "lizard_auth_server.api_v2.check_credentials": 1,
+    "lizard_auth_server.api_v2.login": 2,
+    "lizard_auth_server.api_v2.find_user": 1,
+    "lizard_auth_server.api_v2.organisations": 0,
+    "lizard_auth_server.api_v2.changes": 6,
+}
+
+COLD_BUDGETS = {
+    # v1 API, called by the portals.
+    "lizard_auth_server.api.get_user": 7,
+    "lizard_auth_server.api.get_users": 4,
+    "lizard_auth_server.api.get_organisations": 2,
+    "lizard_auth_server.api.roles": 2,
+    "lizard_auth_server.api.user_organisation_roles": 3,
+    "lizard_auth_server.api.user_organisation_roles_batch": 3,
+    # v1 SSO.
+    "lizard_auth_server.sso.api.request_token": 4,
+    "lizard_auth_server.sso.authorize": 9,
+    "lizard_auth_server.sso.api.verify": 8,
+    # v2 API.
+    "lizard_auth_server.api_v2.check_credentials": 2,
+    "lizard_auth_server.api_v2.login": 3,
+    "lizard_auth_server.api_v2.find_user": 2,
+    "lizard_auth_server.api_v2.organisations": 2,
+    "lizard_auth_server.api_v2.changes": 7,
+}
+
+
+def get_budget(url_name):
+    """Return the most queries a request to the URL name may do, or None."""
+    return COLD_BUDGETS.get(url_name)
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""Process-local registry of portals, keyed by their ``sso_key``.
+
+Every v1 and v2 API call starts by looking up the portal that signed the
+message. The registry keeps those portals in memory so that the lookup
+normally doesn't hit the database.
+
+Entries expire after ``LIZARD_AUTH_SERVER_PORTAL_CACHE_TIMEOUT`` seconds and
+the registry never holds more than ``LIZARD_AUTH_SERVER_PORTAL_CACHE_SIZE``
+portals (the least recently used one is dropped first). Saving or deleting a
+portal removes it from the registry of the current process, see
+``signal_handlers.py``. Other processes pick up the change once their entry
+expires, so keep the timeout short.
+
+"""
+from collections import OrderedDict
+from lizard_auth_server.conf import settings
+from lizard_auth_server.models import Portal
+
+import threading
+import time
+
+
+class PortalRegistry(object):
+    def __init__(self):
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, sso_key):
+        """Return the portal identified by ``sso_key``.
+
+        Raises:
+            Portal.DoesNotExist: when there's no portal with that key.
+
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(sso_key)
+            if entry is not None:
+                expires, portal = entry
+                if expires > now:
+                    self._entries.move_to_end(sso_key)
+                    return portal
+                del self._entries[sso_key]
+
+        portal = Portal.objects.get(sso_key=sso_key)
+
+        timeout = settings.LIZARD_AUTH_SERVER_PORTAL_CACHE_TIMEOUT
+        max_size = settings.LIZARD_AUTH_SERVER_PORTAL_CACHE_SIZE
+        with self._lock:
+            self._entries[sso_key] = (now + timeout, portal)
+            self._entries.move_to_end(sso_key)
+            while len(self._entries) > max_size:
+                self._entries.popitem(last=False)
+        return portal
+
+    def invalidate(self, portal):
+        """Forget ``portal``, both under its current and its previous key.
+
+        We match on primary key as well, as :meth:`Portal.rotate_keys`
+        changes the ``sso_key`` we've stored it under.
+
+        """
+        with self._lock:
+            for sso_key, (expires, cached) in list(self._entries.items()):
+                if sso_key == portal.sso_key or cached.pk == portal.pk:
+                    del self._entries[sso_key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+portal_registry = PortalRegistry()
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""Replay cache for the JWT messages of the v2 API.
+
+A signed message stays valid until it expires (``exp``), so a portal that
+retries a request, or someone who replays one, has us do all the work again:
+for ``check-credentials`` that includes hashing the password or asking
+Cognito. With ``LIZARD_AUTH_SERVER_JWT_REPLAY_CACHE`` set to the alias of a
+Django cache (shared by all server processes, with an atomic
+``cache.add()``):
+
+- ``check-credentials`` accepts a message only once, a replay is rejected
+  before the password is checked,
+
+- ``find-user`` and ``organisations`` remember their response to a message
+  and return it again for the same message, without verifying the message
+  again.
+
+A message is identified by a hash of the SSO key, the portal's current
+``sso_secret`` and the whole message, including its signature: a copied
+signature with another payload is another message, and a new secret
+(``Portal.rotate_keys()``) means the old entries aren't found anymore.
+Entries live until the message expires, but at most
+``LIZARD_AUTH_SERVER_JWT_REPLAY_MAX_WINDOW`` seconds. A remembered response
+also stores that moment and isn't returned after it, whatever the cache
+backend does with the timeout. So a message without ``exp`` is accepted
+again after the window, and a remembered response can be that old. The cache
+backend's own limits (``MAX_ENTRIES``, memory) keep the cache bounded.
+
+"""
+from django.core.cache import caches
+from django.http import HttpResponse
+from lizard_auth_server.conf import settings
+from lizard_auth_server.models import Portal
+from lizard_auth_server.registry import portal_registry
+
+import hashlib
+import time
+
+
+# Response headers that are remembered along with the content.
+HEADERS = ("ETag",)
+
+
+def get_cache():
+    """Return the replay cache, or None when it is disabled."""
+    alias = settings.LIZARD_AUTH_SERVER_JWT_REPLAY_CACHE
+    if alias is None:
+        return None
+    return caches[alias]
+
+
+def _cache_key(data, kind):
+    key = data.get("key")
+    message = data.get("message")
+    if not key or not message:
+        return None
+    try:
+        portal = portal_registry.get(key)
+    except Portal.DoesNotExist:
+        return None
+    digest = hashlib.sha256(
+        ("%s\n%s\n%s" % (key, portal.sso_secret, message)).encode("utf-8")
+    )
+    return "lizard_auth_server.jwt_replay.%s.%s" % (kind, digest.hexdigest())
+
+
+def window(payload):
+    """Return how many seconds to remember the (verified) message."""
+    max_window = settings.LIZARD_AUTH_SERVER_JWT_REPLAY_MAX_WINDOW
+    if "exp" not in payload:
+        return max_window
+    try:
+        remaining = int(payload["exp"]) - int(time.time())
+    except (TypeError, ValueError):
+        return 0
+    return max(0, min(remaining, max_window))
+
+
+def first_use(data, payload):
+    """Return False when the message has been used before.
+
+    ``data`` are the request parameters (``key`` and ``message``), ``payload``
+    is the verified payload of the message.
+
+    """
+    cache = get_cache()
+    cache_key = _cache_key(data, "used")
+    timeout = window(payload)
+    if cache is None or cache_key is None or not timeout:
+        return True
+    return cache.add(cache_key, True, timeout)
+
+
+def get_response(data):
+    """Return the remembered response to the message, or None."""
+    cache = get_cache()
+    cache_key = _cache_key(data, "response")
+    if cache is None or cache_key is None:
+        return None
+    remembered = cache.get(cache_key)
+    if remembered is None:
+        return None
+    expires, content, content_type, headers = remembered
+    if expires <= time.time():
+        # The message has expired (or the window is over).
+        return None
+    response = HttpResponse(content, content_type=content_type)
+    for header, value in headers:
+        response[header] = value
+    return response
+
+
+def remember_response(data, payload, response):
+    """Remember a successful response to the message."""
+    cache = get_cache()
+    cache_key = _cache_key(data, "response")
+    timeout = window(payload)
+    if cache is None or cache_key is None or not timeout:
+        return
+    if response.status_code != 200 or response.streaming:
+        return
+    headers = [(header, response[header]) for header in HEADERS if header in response]
+    expires = time.time() + timeout
+    remembered = (expires, response.content, response["Content-Type"], headers)
+    cache.set(cache_key, remembered, timeout)
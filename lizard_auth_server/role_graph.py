@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+"""Process-local graph of the role inheritance.
+
+A role inherits from its base roles (``Role.base_roles``), from their base
+roles, and so on: inheritance is transitive. Roles may even inherit from each
+other in a cycle, in which case every role in the cycle inherits from all the
+others. Inheritance only applies within an organisation: see
+``models.compute_organisation_roles()``.
+
+The graph holds all roles (a base role can belong to another portal than its
+inheriting role). Every role gets an index and its ancestors and descendants
+are precomputed as bitsets (python ints, bit ``i`` is the role with index
+``i``), so that resolving inheritance is a bitwise ``and`` instead of a join
+per inheritance level.
+
+The graph is loaded in two queries and kept in memory. It belongs to a
+version in the Django cache (see ``catalog.py``) that the signal handlers
+bump after a change to the roles or their inheritance is committed, so every
+process reloads the graph after a change. That only works when all
+processes share the cache, see ``checks.py``. A transaction that changed
+roles or inheritance itself gets a fresh graph with its own changes, which
+isn't kept.
+
+"""
+from lizard_auth_server import catalog
+from lizard_auth_server import models
+
+import threading
+
+
+class RoleGraph(object):
+    def __init__(self, roles, inheritance):
+        """Build the graph.
+
+        Args:
+            roles: (role ID, portal ID) tuples.
+            inheritance: (base role ID, inheriting role ID) tuples.
+
+        """
+        self.role_ids = []
+        self.index = {}
+        self.portal_masks = {}
+        for role_id, portal_id in roles:
+            self.index[role_id] = len(self.role_ids)
+            self.portal_masks[portal_id] = self.portal_masks.get(portal_id, 0) | (
+                1 << len(self.role_ids)
+            )
+            self.role_ids.append(role_id)
+        # Per role index: the indexes of the direct base roles.
+        self.bases = [[] for role_id in self.role_ids]
+        for base_role_id, role_id in inheritance:
+            if base_role_id in self.index and role_id in self.index:
+                self.bases[self.index[role_id]].append(self.index[base_role_id])
+        self.ancestors, self.cycles = self._closure()
+        self.descendants = [0] * len(self.role_ids)
+        for i, ancestors in enumerate(self.ancestors):
+            for j in self._indexes(ancestors):
+                self.descendants[j] |= 1 << i
+
+    def _closure(self):
+        """Return the ancestors bitset per role and the cycles.
+
+        The strongly connected components (Tarjan's algorithm, without
+        recursion) are found in an order where the components a role
+        inherits from come first, so every component can add up the already
+        computed ancestors of its base roles.
+
+        """
+        count = len(self.role_ids)
+        order = [None] * count
+        lowlink = [0] * count
+        on_stack = [False] * count
+        stack = []
+        component_of = [None] * count
+        components = []
+        counter = 0
+        for start in range(count):
+            if order[start] is not None:
+                continue
+            work = [(start, 0)]
+            while work:
+                node, position = work.pop()
+                if position == 0:
+                    order[node] = lowlink[node] = counter
+                    counter += 1
+                    stack.append(node)
+                    on_stack[node] = True
+                bases = self.bases[node]
+                while position < len(bases):
+                    base = bases[position]
+                    position += 1
+                    if order[base] is None:
+                        work.append((node, position))
+                        work.append((base, 0))
+                        break
+                    if on_stack[base]:
+                        lowlink[node] = min(lowlink[node], order[base])
+                else:
+                    if lowlink[node] == order[node]:
+                        component = []
+                        while True:
+                            member = stack.pop()
+                            on_stack[member] = False
+                            component_of[member] = len(components)
+                            component.append(member)
+                            if member == node:
+                                break
+                        components.append(component)
+                    if work:
+                        parent = work[-1][0]
+                        lowlink[parent] = min(lowlink[parent], lowlink[node])
+
+        ancestors = [0] * count
+        cycles = []
+        for number, component in enumerate(components):
+            members = 0
+            for member in component:
+                members |= 1 << member
+            reachable = 0
+            cyclic = len(component) > 1
+            for member in component:
+                for base in self.bases[member]:
+                    if component_of[base] == number:
+                        cyclic = True
+                    else:
+                        reachable |= (1 << base) | ancestors[base]
+            if cyclic:
+                reachable |= members
+                cycles.append(sorted(self.role_ids[member] for member in component))
+            for member in component:
+                ancestors[member] = reachable
+        return ancestors, cycles
+
+    @staticmethod
+    def _indexes(bitset):
+        while bitset:
+            lowest = bitset & -bitset
+            yield lowest.bit_length() - 1
+            bitset ^= lowest
+
+    def _role_ids(self, bitset):
+        return set(self.role_ids[i] for i in self._indexes(bitset))
+
+    def bit(self, role_id):
+        """Return the bitset with only this role (0 for unknown roles)."""
+        if role_id not in self.index:
+            return 0
+        return 1 << self.index[role_id]
+
+    def ancestors_of(self, role_id):
+        """Return the bitset of the roles this role inherits from."""
+        if role_id not in self.index:
+            return 0
+        return self.ancestors[self.index[role_id]]
+
+    def ancestor_ids(self, role_ids):
+        """Return the IDs of the roles that these roles inherit from."""
+        bitset = 0
+        for role_id in role_ids:
+            bitset |= self.ancestors_of(role_id)
+        return self._role_ids(bitset)
+
+    def descendant_ids(self, role_ids, portal_id=None):
+        """Return the IDs of the roles that inherit from these roles.
+
+        With ``portal_id``, only return roles of that portal.
+
+        """
+        bitset = 0
+        for role_id in role_ids:
+            if role_id in self.index:
+                bitset |= self.descendants[self.index[role_id]]
+        if portal_id is not None:
+            bitset &= self.portal_masks.get(portal_id, 0)
+        return self._role_ids(bitset)
+
+
+_current = None
+_lock = threading.Lock()
+
+
+def _load():
+    return RoleGraph(
+        models.Role.objects.values_list("id", "portal_id"),
+        models.Role.inheriting_roles.through.objects.values_list(
+            "from_role_id", "to_role_id"
+        ),
+    )
+
+
+def get_role_graph():
+    """Return the current role graph, (re)loading it when needed."""
+    global _current
+    if catalog.ROLE_GRAPH in catalog.uncommitted():
+        return _load()
+    version = catalog.get_version(catalog.ROLE_GRAPH)
+    current = _current
+    if current is not None and current[0] == version:
+        return current[1]
+    with _lock:
+        # Another thread may have loaded this version while we waited.
+        current = _current
+        if current is not None and current[0] == version:
+            return current[1]
+        graph = _load()
+        _current = (version, graph)
+    return graph
+
+
+def reset():
+    """Forget the loaded graph, the next ``get_role_graph()`` loads it again."""
+    global _current
+    with _lock:
+        _current = None
+
+
+def changed():
+    """Reload the graph everywhere once the current transaction commits."""
+    catalog.bump_on_commit([catalog.ROLE_GRAPH])
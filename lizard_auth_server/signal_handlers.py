@@ -1,11 +1,27 @@
 from django.conf import settings
+from django.contrib.auth.models import Permission
 from django.contrib.auth.models import User
 from django.core.exceptions import ValidationError
+from django.db.models.signals import m2m_changed
+from django.db.models.signals import post_delete
 from django.db.models.signals import post_save
+from django.db.models.signals import pre_delete
 from django.db.models.signals import pre_save
 from django.dispatch import receiver
+from lizard_auth_server import access_vectors
+from lizard_auth_server import catalog
+from lizard_auth_server import role_graph
+from lizard_auth_server import user_payloads
+from lizard_auth_server.backends import CognitoUnavailable
 from lizard_auth_server.backends import CognitoUser
+from lizard_auth_server.models import ChangeLogEntry
+from lizard_auth_server.models import EffectiveOrganisationRole
+from lizard_auth_server.models import Organisation
+from lizard_auth_server.models import OrganisationRole
+from lizard_auth_server.models import Portal
+from lizard_auth_server.models import Role
 from lizard_auth_server.models import UserProfile
+from lizard_auth_server.registry import portal_registry
 
 
 # Have the creation of a User fail if it exists in Cognito
@@ -18,7 +34,13 @@ def check_user_exists(sender, instance, **kwargs):
         return  # do nothing if it is an update to an existing user
 
     cognito_user = CognitoUser.from_username(instance.username)
-    if cognito_user.admin_user_exists():
+    try:
+        exists = cognito_user.admin_user_exists()
+    except CognitoUnavailable:
+        raise ValidationError(
+            "We can't check whether this username is taken, try again later."
+        )
+    if exists:
         raise ValidationError("This username is already taken.")
 
 
@@ -28,3 +50,376 @@ def check_user_exists(sender, instance, **kwargs):
 def create_user_profile(sender, instance, created, **kwargs):
     if created:
         UserProfile.objects.create(user=instance)
+
+
+# Keep the in-memory portal registry in sync. Note that rotate_keys() also
+# ends up here as it saves the portal.
+@receiver(post_save, sender=Portal)
+@receiver(post_delete, sender=Portal)
+def invalidate_portal_registry(sender, instance, **kwargs):
+    portal_registry.invalidate(instance)
+
+
+# Keep the EffectiveOrganisationRole table up to date. The "pre" signals
+# stash the IDs of the profiles that might be affected on the instance, the
+# "post" signals recompute the organisation roles of those profiles.
+
+
+def _stash_profile_ids(instance, profile_ids):
+    instance._effective_roles_profile_ids = set(profile_ids)
+
+
+def _rebuild_stashed_profile_ids(instance):
+    profile_ids = instance.__dict__.pop("_effective_roles_profile_ids", ())
+    EffectiveOrganisationRole.objects.rebuild_for_profiles(profile_ids)
+
+
+@receiver(m2m_changed, sender=UserProfile.roles.through)
+@receiver(m2m_changed, sender=UserProfile.organisations.through)
+def update_effective_roles_for_profile(
+    sender, instance, action, reverse, pk_set, **kwargs
+):
+    if not reverse:
+        # profile.roles.add(...) and so on: only this profile is affected.
+        if action in ("post_add", "post_remove", "post_clear"):
+            EffectiveOrganisationRole.objects.rebuild_for_profiles([instance.pk])
+        return
+    # organisation_role.user_profiles.add(...) and so on: pk_set contains
+    # profile IDs, except for clear().
+    if action == "pre_clear":
+        _stash_profile_ids(
+            instance, instance.user_profiles.values_list("id", flat=True)
+        )
+    elif action == "post_clear":
+        _rebuild_stashed_profile_ids(instance)
+    elif action in ("post_add", "post_remove"):
+        EffectiveOrganisationRole.objects.rebuild_for_profiles(pk_set)
+
+
+# The role graph must be reloaded before the effective roles are recomputed
+# with it, so these handlers are connected first.
+@receiver(post_save, sender=Role)
+@receiver(post_delete, sender=Role)
+def bump_role_graph(sender, **kwargs):
+    role_graph.changed()
+
+
+@receiver(m2m_changed, sender=Role.inheriting_roles.through)
+def bump_role_graph_for_inheritance(sender, action, **kwargs):
+    if action.startswith("post_"):
+        role_graph.changed()
+
+
+def _inheritance_related_role_ids(role_ids):
+    # Inheritance is transitive: a change to a role's inheritance affects
+    # everything that inherits from it and everything it inherits from.
+    graph = role_graph.get_role_graph()
+    return set(role_ids) | graph.ancestor_ids(role_ids) | graph.descendant_ids(role_ids)
+
+
+@receiver(m2m_changed, sender=Role.inheriting_roles.through)
+def update_effective_roles_for_inheritance(
+    sender, instance, action, reverse, pk_set, **kwargs
+):
+    if action.startswith("pre_"):
+        role_ids = {instance.pk} | set(pk_set or ())
+        if action == "pre_clear":
+            related = instance.base_roles if reverse else instance.inheriting_roles
+            role_ids.update(related.values_list("id", flat=True))
+        role_ids = _inheritance_related_role_ids(role_ids)
+        _stash_profile_ids(
+            instance,
+            EffectiveOrganisationRole.objects.affected_profile_ids(role_ids=role_ids),
+        )
+    else:
+        _rebuild_stashed_profile_ids(instance)
+
+
+@receiver(pre_save, sender=OrganisationRole)
+@receiver(pre_delete, sender=OrganisationRole)
+def stash_effective_roles_for_organisation_role(sender, instance, **kwargs):
+    if kwargs.get("raw") or instance.pk is None:
+        return
+    _stash_profile_ids(
+        instance,
+        EffectiveOrganisationRole.objects.affected_profile_ids(
+            organisation_role_ids=[instance.pk]
+        ),
+    )
+
+
+@receiver(post_save, sender=OrganisationRole)
+def update_effective_roles_for_saved_organisation_role(sender, instance, raw, **kwargs):
+    if raw:
+        return
+    # Both the members of the old and the new organisation are affected.
+    profile_ids = instance.__dict__.pop("_effective_roles_profile_ids", set())
+    profile_ids |= EffectiveOrganisationRole.objects.affected_profile_ids(
+        organisation_role_ids=[instance.pk]
+    )
+    EffectiveOrganisationRole.objects.rebuild_for_profiles(profile_ids)
+
+
+@receiver(post_delete, sender=OrganisationRole)
+def update_effective_roles_for_deleted_organisation_role(sender, instance, **kwargs):
+    _rebuild_stashed_profile_ids(instance)
+
+
+@receiver(pre_delete, sender=Role)
+def stash_effective_roles_for_role(sender, instance, **kwargs):
+    # Deleting a role also deletes its inheritance, which can break a chain of
+    # inheritance between organisation roles of other roles.
+    _stash_profile_ids(
+        instance,
+        EffectiveOrganisationRole.objects.affected_profile_ids(
+            role_ids=_inheritance_related_role_ids([instance.pk])
+        ),
+    )
+
+
+@receiver(post_delete, sender=Role)
+def update_effective_roles_for_deleted_role(sender, instance, **kwargs):
+    _rebuild_stashed_profile_ids(instance)
+
+
+@receiver(post_save, sender=Role)
+def update_effective_roles_portal(sender, instance, created, raw, **kwargs):
+    if created or raw:
+        return
+    moved = EffectiveOrganisationRole.objects.filter(
+        organisation_role__role=instance
+    ).exclude(portal_id=instance.portal_id)
+    access_vectors.invalidate(set(moved.values_list("user_profile_id", flat=True)))
+    moved.update(portal_id=instance.portal_id)
+
+
+# Keep the access vectors in sync with the portal access. The organisation
+# roles are taken care of by EffectiveOrganisationRoleManager.
+
+
+@receiver(m2m_changed, sender=UserProfile.portals.through)
+def invalidate_access_vectors(sender, instance, action, reverse, pk_set, **kwargs):
+    if not reverse:
+        # profile.portals.add(...) and so on.
+        if action in ("post_add", "post_remove", "post_clear"):
+            access_vectors.invalidate([instance.pk])
+        return
+    # portal.user_profiles.add(...) and so on: pk_set contains profile IDs,
+    # except for clear().
+    if action == "pre_clear":
+        access_vectors.invalidate(instance.user_profiles.values_list("id", flat=True))
+    elif action in ("post_add", "post_remove"):
+        access_vectors.invalidate(pk_set)
+
+
+@receiver(post_save, sender=UserProfile)
+def invalidate_access_vector_for_new_profile(sender, instance, created, **kwargs):
+    # Don't trust a vector of an earlier profile with the same ID (after a
+    # rollback, for instance).
+    if created:
+        access_vectors.invalidate([instance.pk])
+
+
+@receiver(pre_delete, sender=Portal)
+def invalidate_access_vectors_for_portal(sender, instance, **kwargs):
+    # Deleting the portal deletes the access and the effective roles without
+    # sending signals.
+    access_vectors.invalidate(
+        set(instance.user_profiles.values_list("id", flat=True))
+        | set(
+            EffectiveOrganisationRole.objects.filter(portal=instance).values_list(
+                "user_profile_id", flat=True
+            )
+        )
+    )
+
+
+# Fill the change log for the v2 changes feed.
+
+
+def _is_login(kwargs):
+    # Logging in updates last_login, that's not a change worth syncing.
+    return kwargs.get("update_fields") == frozenset(["last_login"])
+
+
+@receiver(pre_save, sender=User)
+def log_renamed_user(sender, instance, raw, **kwargs):
+    if raw or instance.pk is None or _is_login(kwargs):
+        return
+    old_username = (
+        User.objects.filter(pk=instance.pk).values_list("username", flat=True).first()
+    )
+    if old_username is not None and old_username != instance.username:
+        # For the portals, the user with the old username is gone.
+        ChangeLogEntry.objects.log(ChangeLogEntry.USER, [old_username], deleted=True)
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def log_user_change(sender, instance, **kwargs):
+    if kwargs.get("raw") or _is_login(kwargs):
+        return
+    ChangeLogEntry.objects.log(
+        ChangeLogEntry.USER,
+        [instance.username],
+        deleted=kwargs["signal"] is post_delete,
+    )
+
+
+@receiver(post_save, sender=UserProfile)
+def log_user_profile_change(sender, instance, raw, **kwargs):
+    if raw:
+        return
+    ChangeLogEntry.objects.log(ChangeLogEntry.USER, [instance.user.username])
+
+
+@receiver(m2m_changed, sender=UserProfile.portals.through)
+@receiver(m2m_changed, sender=UserProfile.organisations.through)
+@receiver(m2m_changed, sender=UserProfile.roles.through)
+def log_user_profile_relation_change(
+    sender, instance, action, reverse, pk_set, **kwargs
+):
+    if not reverse:
+        if action in ("post_add", "post_remove", "post_clear"):
+            ChangeLogEntry.objects.log(ChangeLogEntry.USER, [instance.user.username])
+        return
+    if action == "pre_clear":
+        pk_set = instance.user_profiles.values_list("id", flat=True)
+    elif action not in ("post_add", "post_remove"):
+        return
+    usernames = User.objects.filter(user_profile__in=list(pk_set)).values_list(
+        "username", flat=True
+    )
+    ChangeLogEntry.objects.log(ChangeLogEntry.USER, usernames)
+
+
+# Deleting an organisation or an organisation role also deletes its relations
+# with the user profiles, but the cascade doesn't send m2m_changed. So we
+# find the users before they're gone.
+@receiver(pre_delete, sender=Organisation)
+@receiver(pre_delete, sender=OrganisationRole)
+def log_users_of_deleted_relation(sender, instance, **kwargs):
+    users = list(
+        User.objects.filter(
+            user_profile__in=instance.user_profiles.values("id")
+        ).values_list("id", "username")
+    )
+    ChangeLogEntry.objects.log(ChangeLogEntry.USER, [user[1] for user in users])
+    user_payloads.invalidate([user[0] for user in users])
+
+
+@receiver(post_save, sender=Organisation)
+@receiver(post_delete, sender=Organisation)
+def log_organisation_change(sender, instance, **kwargs):
+    if kwargs.get("raw"):
+        return
+    ChangeLogEntry.objects.log(
+        ChangeLogEntry.ORGANISATION,
+        [instance.unique_id],
+        deleted=kwargs["signal"] is post_delete,
+    )
+
+
+@receiver(post_save, sender=Role)
+@receiver(post_delete, sender=Role)
+def log_role_change(sender, instance, **kwargs):
+    if kwargs.get("raw"):
+        return
+    ChangeLogEntry.objects.log(
+        ChangeLogEntry.ROLE,
+        [instance.unique_id],
+        deleted=kwargs["signal"] is post_delete,
+        portal_id=instance.portal_id,
+    )
+
+
+@receiver(post_save, sender=OrganisationRole)
+@receiver(post_delete, sender=OrganisationRole)
+def log_organisation_role_change(sender, instance, **kwargs):
+    if kwargs.get("raw"):
+        return
+    ChangeLogEntry.objects.log(
+        ChangeLogEntry.ORGANISATION_ROLE,
+        [str(instance.pk)],
+        deleted=kwargs["signal"] is post_delete,
+        portal_id=instance.role.portal_id,
+    )
+
+
+# Invalidate the ETags of the organisation and role lists.
+@receiver(post_save, sender=Organisation)
+@receiver(post_delete, sender=Organisation)
+def bump_organisations_catalog(sender, **kwargs):
+    catalog.bump(catalog.ORGANISATIONS)
+
+
+@receiver(post_save, sender=Role)
+@receiver(post_delete, sender=Role)
+def bump_roles_catalog(sender, **kwargs):
+    catalog.bump(catalog.ROLES)
+
+
+# Invalidate the cached v1 user data, see user_payloads.py.
+
+
+def _invalidate_user_payloads(users):
+    user_payloads.invalidate(users.values_list("id", flat=True))
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_user_payload(sender, instance, **kwargs):
+    if _is_login(kwargs):
+        return
+    user_payloads.invalidate([instance.pk])
+
+
+@receiver(post_save, sender=UserProfile)
+def invalidate_user_payload_for_profile(sender, instance, **kwargs):
+    user_payloads.invalidate([instance.user_id])
+
+
+@receiver(m2m_changed, sender=UserProfile.organisations.through)
+def invalidate_user_payloads_for_organisations(
+    sender, instance, action, reverse, pk_set, **kwargs
+):
+    if not reverse:
+        if action in ("post_add", "post_remove", "post_clear"):
+            user_payloads.invalidate([instance.user_id])
+    elif action == "pre_clear":
+        _invalidate_user_payloads(
+            User.objects.filter(user_profile__organisations=instance)
+        )
+    elif action in ("post_add", "post_remove"):
+        _invalidate_user_payloads(User.objects.filter(user_profile__in=list(pk_set)))
+
+
+@receiver(m2m_changed, sender=User.user_permissions.through)
+def invalidate_user_payloads_for_permissions(
+    sender, instance, action, reverse, pk_set, **kwargs
+):
+    if not reverse:
+        if action in ("post_add", "post_remove", "post_clear"):
+            user_payloads.invalidate([instance.pk])
+    elif action == "pre_clear":
+        _invalidate_user_payloads(instance.user_set.all())
+    elif action in ("post_add", "post_remove"):
+        user_payloads.invalidate(pk_set)
+
+
+# Renaming an organisation or permission changes the data of its users. When
+# deleting, we need to find the users before the relations are gone: see
+# log_users_of_deleted_relation() for deleted organisations.
+@receiver(post_save, sender=Organisation)
+def invalidate_user_payloads_for_organisation(sender, instance, created, **kwargs):
+    if created:
+        return
+    _invalidate_user_payloads(User.objects.filter(user_profile__organisations=instance))
+
+
+@receiver(post_save, sender=Permission)
+@receiver(pre_delete, sender=Permission)
+def invalidate_user_payloads_for_permission(sender, instance, **kwargs):
+    if kwargs.get("created"):
+        return
+    _invalidate_user_payloads(instance.user_set.all())
@@ -0,0 +1,119 @@
+from django.core.cache import cache
+from django.db import transaction
+from django.test import TransactionTestCase
+from lizard_auth_server import models
+from lizard_auth_server.tests import factories
+
+
+class TestAccessVectors(TransactionTestCase):
+    # The versions are only bumped after a commit.
+
+    def setUp(self):
+        cache.clear()
+        self.portal = factories.PortalF.create()
+        self.role = factories.RoleF.create(portal=self.portal)
+        self.org = factories.OrganisationF.create()
+        self.orgrole = models.OrganisationRole.objects.create(
+            organisation=self.org, role=self.role
+        )
+        self.profile = factories.UserProfileF.create()
+
+    def test_has_access_cached(self):
+        self.profile.portals.add(self.portal)
+        self.assertTrue(self.profile.has_access(self.portal))
+        with self.assertNumQueries(0):
+            self.assertTrue(self.profile.has_access(self.portal))
+
+    def test_staff(self):
+        self.profile.user.is_staff = True
+        with self.assertNumQueries(0):
+            self.assertTrue(self.profile.has_access(self.portal))
+
+    def test_portals(self):
+        self.assertFalse(self.profile.has_access(self.portal))
+        self.profile.portals.add(self.portal)
+        self.assertTrue(self.profile.has_access(self.portal))
+        self.profile.portals.remove(self.portal)
+        self.assertFalse(self.profile.has_access(self.portal))
+        self.profile.portals.add(self.portal)
+        self.profile.portals.clear()
+        self.assertFalse(self.profile.has_access(self.portal))
+
+    def test_portals_reverse(self):
+        self.portal.user_profiles.add(self.profile)
+        self.assertTrue(self.profile.has_access(self.portal))
+        self.portal.user_profiles.remove(self.profile)
+        self.assertFalse(self.profile.has_access(self.portal))
+        self.portal.user_profiles.add(self.profile)
+        self.portal.user_profiles.clear()
+        self.assertFalse(self.profile.has_access(self.portal))
+
+    def test_other_portal(self):
+        other_portal = factories.PortalF.create()
+        self.profile.portals.add(self.portal)
+        self.assertFalse(self.profile.has_access(other_portal))
+
+    def test_has_role(self):
+        self.assertFalse(self.profile.has_role(self.portal, self.role))
+        self.profile.roles.add(self.orgrole)
+        self.assertTrue(self.profile.has_role(self.portal, self.role))
+        with self.assertNumQueries(0):
+            self.profile.has_role(self.portal, self.role)
+        self.orgrole.delete()
+        self.assertFalse(self.profile.has_role(self.portal, self.role))
+
+    def test_has_inherited_role(self):
+        inheriting_role = factories.RoleF.create(name="inheriting", portal=self.portal)
+        models.OrganisationRole.objects.create(
+            organisation=self.org, role=inheriting_role
+        )
+        self.profile.roles.add(self.orgrole)
+        self.assertFalse(self.profile.has_role(self.portal, inheriting_role))
+        inheriting_role.base_roles.add(self.role)
+        self.assertTrue(self.profile.has_role(self.portal, inheriting_role))
+
+    def test_role_moves_to_other_portal(self):
+        other_portal = factories.PortalF.create()
+        self.profile.roles.add(self.orgrole)
+        self.assertTrue(self.profile.has_role(self.portal, self.role))
+        self.role.portal = other_portal
+        self.role.save()
+        self.assertFalse(self.profile.has_role(self.portal, self.role))
+        self.assertTrue(self.profile.has_role(other_portal, self.role))
+
+    def test_no_organisation_roles_without_query(self):
+        self.profile.has_access(self.portal)
+        with self.assertNumQueries(0):
+            self.assertEqual(list(self.profile.all_organisation_roles(self.portal)), [])
+        self.profile.roles.add(self.orgrole)
+        self.assertEqual(
+            list(self.profile.all_organisation_roles(self.portal)), [self.orgrole]
+        )
+
+    def test_portal_deleted(self):
+        self.profile.portals.add(self.portal)
+        self.assertTrue(self.profile.has_access(self.portal))
+        portal_id = self.portal.id
+        self.portal.delete()
+        self.assertFalse(self.profile.has_access(models.Portal(id=portal_id)))
+
+    def test_uncommitted_changes(self):
+        self.assertFalse(self.profile.has_access(self.portal))
+        with transaction.atomic():
+            self.profile.portals.add(self.portal)
+            self.assertTrue(self.profile.has_access(self.portal))
+            # Not kept: built again every time.
+            with self.assertNumQueries(2):
+                self.assertTrue(self.profile.has_access(self.portal))
+        with self.assertNumQueries(2):
+            self.assertTrue(self.profile.has_access(self.portal))
+
+    def test_rollback(self):
+        self.assertFalse(self.profile.has_access(self.portal))
+        with self.assertRaises(RuntimeError):
+            with transaction.atomic():
+                self.profile.portals.add(self.portal)
+                self.assertTrue(self.profile.has_access(self.portal))
+                raise RuntimeError("Roll back")
+        with self.assertNumQueries(0):
+            self.assertFalse(self.profile.has_access(self.portal))
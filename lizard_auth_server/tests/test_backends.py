@@ -1,11 +1,18 @@
 """Mostly copied from django-warrant's tests.py."""
 
+from botocore.exceptions import ClientError
+from botocore.exceptions import ConnectTimeoutError
+from botocore.exceptions import EndpointConnectionError
+from botocore.stub import Stubber
 from django.conf import settings
 from django.test import override_settings
 from django.test import TestCase
 from lizard_auth_server import backends
+from requests.exceptions import ReadTimeout
 from unittest import mock
 
+import jwt
+
 
 def get_user(cls, *args, **kwargs):
     user = {
@@ -130,3 +137,202 @@ class TestCognitoUser(TestCase):
             "Username": "testuser",
         }
         self.assertDictEqual(expected, kwargs)
+
+
+@override_settings(
+    COGNITO_USER_POOL_ID="eu-west-1_abcdefg",
+    COGNITO_APP_ID="abcdefg",
+    AWS_ACCESS_KEY_ID="access-key",
+    AWS_SECRET_ACCESS_KEY="secret-key",
+)
+@mock.patch.dict("os.environ", {"AWS_DEFAULT_REGION": "eu-west-1"})
+class TestCognitoClients(TestCase):
+    """Run against botocore's Stubber instead of the real Cognito API."""
+
+    def setUp(self):
+        backends.reset_cognito_clients()
+        backends.cognito_breaker.reset()
+        self.addCleanup(backends.reset_cognito_clients)
+
+    def stub(self):
+        client = backends.CognitoUser.from_username("testuser").client
+        stubber = Stubber(client)
+        stubber.activate()
+        self.addCleanup(stubber.deactivate)
+        return stubber
+
+    def test_client_is_reused(self):
+        user1 = backends.CognitoUser.from_username("testuser")
+        user2 = backends.CognitoUser.from_username("otheruser")
+        self.assertIs(user1.client, user2.client)
+
+    def test_reset(self):
+        client = backends.CognitoUser.from_username("testuser").client
+        backends.reset_cognito_clients()
+        self.assertIsNot(client, backends.CognitoUser.from_username("testuser").client)
+
+    def test_other_credentials_other_client(self):
+        client = backends.CognitoUser.from_username("testuser").client
+        with self.settings(AWS_ACCESS_KEY_ID="rotated-key"):
+            other = backends.CognitoUser.from_username("testuser").client
+        self.assertIsNot(client, other)
+
+    def test_admin_user_exists(self):
+        stubber = self.stub()
+        stubber.add_response(
+            "admin_get_user",
+            {"Username": "testuser"},
+            {"UserPoolId": "eu-west-1_abcdefg", "Username": "testuser"},
+        )
+        stubber.add_client_error("admin_get_user", "UserNotFoundException")
+        cognito_user = backends.CognitoUser.from_username("testuser")
+        self.assertTrue(cognito_user.admin_user_exists())
+        self.assertFalse(cognito_user.admin_user_exists())
+        stubber.assert_no_pending_responses()
+
+    def test_authenticate_wrong_password(self):
+        stubber = self.stub()
+        stubber.add_client_error("admin_initiate_auth", "NotAuthorizedException")
+        backend = backends.CognitoBackend()
+        self.assertIsNone(backend.authenticate(username="testuser", password="x"))
+        stubber.assert_no_pending_responses()
+
+    def test_authenticate_timeout(self):
+        client = backends.CognitoUser.from_username("testuser").client
+        timeout = ConnectTimeoutError(endpoint_url="https://cognito")
+        backend = backends.CognitoBackend()
+        with mock.patch.object(client, "admin_initiate_auth", side_effect=timeout):
+            self.assertIsNone(backend.authenticate(username="testuser", password="x"))
+        self.assertEqual(backends.cognito_breaker.counters["failures"], 1)
+
+    @mock.patch("warrant.requests.get", side_effect=ReadTimeout)
+    def test_authenticate_jwks_timeout(self, requests_get):
+        client = backends.CognitoUser.from_username("testuser").client
+        id_token = jwt.encode({"token_use": "id"}, "secret", headers={"kid": "key"})
+        tokens = {"AuthenticationResult": {"IdToken": id_token.decode("ascii")}}
+        backend = backends.CognitoBackend()
+        with mock.patch.object(client, "admin_initiate_auth", return_value=tokens):
+            self.assertIsNone(backend.authenticate(username="testuser", password="x"))
+        self.assertTrue(requests_get.called)
+        self.assertEqual(backends.cognito_breaker.counters["failures"], 1)
+
+    def test_check_password_timeout(self):
+        client = backends.CognitoUser.from_username("testuser").client
+        timeout = ConnectTimeoutError(endpoint_url="https://cognito")
+        backend = backends.CognitoBackend()
+        with mock.patch.object(client, "admin_initiate_auth", side_effect=timeout):
+            self.assertRaises(
+                backends.CognitoUnavailable, backend.check_password, "testuser", "x"
+            )
+
+    def test_set_password_timeout(self):
+        cognito_user = backends.CognitoUser.from_username("testuser")
+        timeout = ConnectTimeoutError(endpoint_url="https://cognito")
+        with mock.patch.object(
+            cognito_user.client, "admin_set_user_password", side_effect=timeout
+        ):
+            self.assertRaises(
+                backends.CognitoUnavailable, cognito_user.admin_set_user_password, "x"
+            )
+
+
+def failing_call():
+    raise EndpointConnectionError(endpoint_url="https://cognito")
+
+
+def wrong_password_call():
+    raise ClientError(
+        {"Error": {"Code": "NotAuthorizedException"}}, "AdminInitiateAuth"
+    )
+
+
+@override_settings(
+    LIZARD_AUTH_SERVER_COGNITO_BREAKER_FAILURE_RATE=0.5,
+    LIZARD_AUTH_SERVER_COGNITO_BREAKER_MIN_CALLS=4,
+    LIZARD_AUTH_SERVER_COGNITO_BREAKER_WINDOW=60,
+    LIZARD_AUTH_SERVER_COGNITO_BREAKER_RESET_TIMEOUT=30,
+)
+@mock.patch("lizard_auth_server.backends.time.monotonic", return_value=1000)
+class TestCircuitBreaker(TestCase):
+    def setUp(self):
+        self.breaker = backends.CircuitBreaker()
+
+    def fail_calls(self, times=1):
+        for i in range(times):
+            self.assertRaises(EndpointConnectionError, self.breaker.call, failing_call)
+
+    def test_success(self, monotonic):
+        self.assertEqual(self.breaker.call(lambda: 42), 42)
+        self.assertEqual(self.breaker.state, "closed")
+
+    def test_trips_on_failure_rate(self, monotonic):
+        self.breaker.call(lambda: 42)
+        self.fail_calls(3)
+        self.assertEqual(self.breaker.state, "open")
+        self.assertRaises(backends.CognitoUnavailable, self.breaker.call, lambda: 42)
+        self.assertEqual(self.breaker.counters["tripped"], 1)
+        self.assertEqual(self.breaker.counters["short_circuited"], 1)
+
+    def test_not_below_minimum_calls(self, monotonic):
+        self.fail_calls(3)
+        self.assertEqual(self.breaker.state, "closed")
+
+    def test_wrong_password_is_no_failure(self, monotonic):
+        for i in range(4):
+            self.assertRaises(ClientError, self.breaker.call, wrong_password_call)
+        self.assertEqual(self.breaker.state, "closed")
+
+    def test_old_failures_expire(self, monotonic):
+        self.fail_calls(3)
+        monotonic.return_value = 1100
+        self.fail_calls(1)
+        self.assertEqual(self.breaker.state, "closed")
+
+    def test_half_open_probe(self, monotonic):
+        self.fail_calls(4)
+        monotonic.return_value = 1031
+        self.assertFalse(self.breaker.is_open())
+        self.assertEqual(self.breaker.call(lambda: 42), 42)
+        self.assertEqual(self.breaker.state, "closed")
+
+    def test_half_open_probe_fails(self, monotonic):
+        self.fail_calls(4)
+        monotonic.return_value = 1031
+        self.fail_calls(1)
+        self.assertEqual(self.breaker.state, "open")
+        self.assertEqual(self.breaker.counters["tripped"], 2)
+
+    def test_one_probe_at_a_time(self, monotonic):
+        self.fail_calls(4)
+        monotonic.return_value = 1031
+
+        def concurrent_call():
+            self.assertRaises(
+                backends.CognitoUnavailable, self.breaker.call, lambda: 42
+            )
+            return 42
+
+        self.assertEqual(self.breaker.call(concurrent_call), 42)
+        self.assertEqual(self.breaker.state, "closed")
+
+    def test_interrupted_probe(self, monotonic):
+        self.fail_calls(4)
+        monotonic.return_value = 1031
+
+        def interrupted_call():
+            raise KeyboardInterrupt()
+
+        self.assertRaises(KeyboardInterrupt, self.breaker.call, interrupted_call)
+        # The next call is the probe.
+        self.assertEqual(self.breaker.call(lambda: 42), 42)
+        self.assertEqual(self.breaker.state, "closed")
+
+
+@mock.patch("lizard_auth_server.backends.cognito_breaker")
+@mock.patch("lizard_auth_server.backends.CognitoUser.from_username")
+class TestCognitoBackendBreaker(TestCase):
+    def test_open_breaker_falls_through(self, from_username, breaker):
+        cognito_user = from_username.return_value
+        cognito_user.admin_authenticate.side_effect = backends.CognitoUnavailable
+        backend = backends.CognitoBackend()
+        self.assertIsNone(backend.authenticate(username="testuser", password="x"))
@@ -0,0 +1,120 @@
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import override_settings
+from django.test import TestCase
+from django.test import TransactionTestCase
+from lizard_auth_server import models
+from lizard_auth_server import role_graph
+from lizard_auth_server.benchmarks import fixtures
+from lizard_auth_server.benchmarks import runner
+from lizard_auth_server.management.commands import benchmark_sso
+
+
+@override_settings(PASSWORD_HASHERS=["django.contrib.auth.hashers.MD5PasswordHasher"])
+class TestBenchmarks(TestCase):
+    def setUp(self):
+        self.fixtures = fixtures.create_fixtures(
+            portals=2, organisations=4, roles_per_portal=4, users=10, seed=1
+        )
+
+    def test_fixtures(self):
+        self.assertEqual(len(self.fixtures.portals), 2)
+        self.assertEqual(len(self.fixtures.users), 10)
+        self.assertEqual(models.Role.objects.count(), 8)
+        for user in self.fixtures.users:
+            profile = models.UserProfile.objects.fetch_for_user(user)
+            for portal in self.fixtures.access[user.id]:
+                self.assertTrue(profile.has_access(portal))
+
+    def test_fixtures_are_deterministic(self):
+        access = {
+            user.username: [portal.name for portal in portals]
+            for user, portals in zip(self.fixtures.users, self.fixtures.access.values())
+        }
+        models.Portal.objects.all().delete()
+        models.Organisation.objects.all().delete()
+        User.objects.all().delete()
+        again = fixtures.create_fixtures(
+            portals=2, organisations=4, roles_per_portal=4, users=10, seed=1
+        )
+        self.assertEqual(
+            access,
+            {
+                user.username: [portal.name for portal in portals]
+                for user, portals in zip(again.users, again.access.values())
+            },
+        )
+
+    def test_run(self):
+        summary = runner.run(self.fixtures, iterations=3).summary()
+        self.assertEqual(
+            list(summary),
+            [
+                "v1.request_token",
+                "v1.authorize",
+                "v1.verify",
+                "v2.check_credentials",
+                "v2.login",
+                "v2.find_user",
+                "v2.new_user",
+            ],
+        )
+        for endpoint in summary.values():
+            self.assertEqual(endpoint["requests"], 3)
+            self.assertGreater(endpoint["queries"], 0)
+            self.assertLessEqual(endpoint["p50_ms"], endpoint["p99_ms"])
+
+
+class TestCompare(TestCase):
+    baseline = {"v1.verify": {"p95_ms": 10.0, "queries": 4}}
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(runner.percentile(values, 50), 50)
+        self.assertEqual(runner.percentile(values, 99), 99)
+        self.assertEqual(runner.percentile([7], 95), 7)
+
+    def test_no_regression(self):
+        summary = {"v1.verify": {"p95_ms": 11.0, "queries": 4}}
+        self.assertEqual(runner.compare(summary, self.baseline), [])
+
+    def test_regressions(self):
+        summary = {"v1.verify": {"p95_ms": 13.0, "queries": 5}}
+        self.assertEqual(len(runner.compare(summary, self.baseline)), 2)
+
+
+@override_settings(
+    CACHES={
+        "default": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+            "LOCATION": "test_benchmarks",
+        }
+    }
+)
+class TestBenchmarkCommand(TransactionTestCase):
+    def test_default_cache_untouched(self):
+        cache.clear()
+        cache.set("real", "data")
+        command = benchmark_sso.Command()
+        options = {
+            "portals": 2,
+            "organisations": 4,
+            "roles": 2,
+            "users": 5,
+            "iterations": 2,
+            "seed": 0,
+            "fast_hasher": True,
+        }
+        with command.isolated(options):
+            command.benchmark(options)
+        self.assertIsNone(role_graph._current)
+        self.assertEqual(cache.get("real"), "data")
+        keys = [
+            "lizard_auth_server.catalog.%s" % catalog
+            for catalog in ["organisations", "roles", "role_graph"]
+        ]
+        for profile in models.UserProfile.objects.all():
+            keys.append("lizard_auth_server.catalog.user_payload.%s" % profile.user_id)
+            keys.append("lizard_auth_server.catalog.access_vector.%s" % profile.id)
+        self.assertTrue(models.UserProfile.objects.exists())
+        self.assertEqual(cache.get_many(keys), {})
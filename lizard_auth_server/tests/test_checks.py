@@ -0,0 +1,22 @@
+from django.test import override_settings
+from django.test import TestCase
+from lizard_auth_server import checks
+
+
+def cache_settings(backend):
+    return {"default": {"BACKEND": backend}}
+
+
+class TestDefaultCacheCheck(TestCase):
+    def test_shared(self):
+        self.assertEqual(checks.check_default_cache(None), [])
+
+    @override_settings(CACHES=cache_settings(checks.LOCAL_CACHE_BACKEND))
+    def test_local(self):
+        errors = checks.check_default_cache(None)
+        self.assertEqual([error.id for error in errors], ["lizard_auth_server.W001"])
+
+    @override_settings(CACHES=cache_settings(checks.DUMMY_CACHE_BACKEND))
+    def test_dummy(self):
+        errors = checks.check_default_cache(None)
+        self.assertEqual([error.id for error in errors], ["lizard_auth_server.E001"])
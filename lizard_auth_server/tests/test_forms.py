@@ -2,8 +2,11 @@ from django.contrib.auth.models import User
 from django.core.exceptions import ValidationError
 from django.test import override_settings
 from django.test import TestCase
+from django.urls import reverse
+from lizard_auth_server.backends import CognitoUnavailable
 from lizard_auth_server.forms import JWTDecryptForm
 from lizard_auth_server.forms import SetPasswordMixin
+from lizard_auth_server.tests import factories
 from unittest import mock
 
 
@@ -45,31 +48,58 @@ class TestSetPasswordMixin(TestCase):
     @mock.patch("lizard_auth_server.forms.CognitoBackend")
     def test_clean_old_password_correct(self, CognitoBackend_m):
         # Simulate successful authentication with old_password
-        authenticate = CognitoBackend_m.return_value.authenticate
-        authenticate.return_value = User()
+        check_password = CognitoBackend_m.return_value.check_password
+        check_password.return_value = User()
 
         # Now clean a correct old_password
         self.form.cleaned_data["old_password"] = "correct"
         self.assertEqual("correct", self.form.clean_old_password())
 
-        # Check the authenticate call
-        self.assertDictEqual(
-            {"username": "testuser", "password": "correct"},
-            authenticate.call_args[1],
-        )
+        # Check the check_password call
+        self.assertEqual(("testuser", "correct"), check_password.call_args[0])
 
     @mock.patch("lizard_auth_server.forms.CognitoBackend")
     def test_clean_old_password_wrong(self, CognitoBackend_m):
         # Simulate failed authentication with old_password
-        authenticate = CognitoBackend_m.return_value.authenticate
-        authenticate.return_value = None
+        check_password = CognitoBackend_m.return_value.check_password
+        check_password.return_value = None
 
         # Now clean a wrong old_password
         self.form.cleaned_data["old_password"] = "wrong"
         self.assertRaises(ValidationError, self.form.clean_old_password)
 
-        # Check the authenticate call
-        self.assertDictEqual(
-            {"username": "testuser", "password": "wrong"},
-            authenticate.call_args[1],
+        # Check the check_password call
+        self.assertEqual(("testuser", "wrong"), check_password.call_args[0])
+
+    @mock.patch("lizard_auth_server.forms.CognitoBackend")
+    def test_clean_old_password_unavailable(self, CognitoBackend_m):
+        # A timeout isn't a wrong password.
+        check_password = CognitoBackend_m.return_value.check_password
+        check_password.side_effect = CognitoUnavailable("timeout")
+        self.form.cleaned_data["old_password"] = "correct"
+        with self.assertRaises(ValidationError) as context:
+            self.form.clean_old_password()
+        self.assertEqual(context.exception.code, "cognito_unavailable")
+
+
+class TestPasswordChangeView(TestCase):
+    def setUp(self):
+        self.user = factories.UserF(username="testuser", password="old")
+        self.client.force_login(self.user)
+
+    @override_settings(AWS_ACCESS_KEY_ID="something")
+    @mock.patch("lizard_auth_server.forms.CognitoUser")
+    @mock.patch("lizard_auth_server.forms.CognitoBackend")
+    def test_cognito_unavailable_on_save(self, CognitoBackend_m, CognitoUser_m):
+        CognitoBackend_m.return_value.check_password.return_value = self.user
+        cognito_user = CognitoUser_m.from_username.return_value
+        cognito_user.admin_set_user_password.side_effect = CognitoUnavailable()
+        response = self.client.post(
+            reverse("password_change"),
+            {
+                "old_password": "old",
+                "new_password1": "a new Password 123",
+                "new_password2": "a new Password 123",
+            },
         )
+        self.assertEqual(response.status_code, 503)
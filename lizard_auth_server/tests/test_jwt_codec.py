@@ -0,0 +1,161 @@
+from datetime import datetime
+from datetime import timedelta
+from django.core.exceptions import ValidationError
+from django.test import TestCase
+from lizard_auth_server import jwt_codec
+from lizard_auth_server.tests import factories
+
+import jwt
+
+
+SECRET = "some secret"
+
+
+class TestEncode(TestCase):
+    def test_same_as_pyjwt(self):
+        payload = {
+            "aud": "ssokey",
+            "exp": datetime.utcnow() + timedelta(minutes=5),
+            "user": '{"username": "pietje"}',
+        }
+        for algorithm in ("HS256", "HS512"):
+            self.assertEqual(
+                jwt_codec.encode(payload, SECRET, algorithm=algorithm),
+                jwt.encode(dict(payload), SECRET, algorithm=algorithm),
+            )
+
+    def test_payload_unchanged(self):
+        exp = datetime.utcnow()
+        payload = {"exp": exp}
+        jwt_codec.encode(payload, SECRET)
+        self.assertEqual(payload, {"exp": exp})
+
+    def test_no_hmac(self):
+        self.assertRaises(
+            jwt.exceptions.InvalidAlgorithmError,
+            jwt_codec.encode,
+            {},
+            SECRET,
+            algorithm="RS256",
+        )
+
+
+class TestDecode(TestCase):
+    def assertSameAsPyJWT(self, token, **kwargs):
+        try:
+            expected = jwt.decode(token, SECRET, algorithms=["HS256"], **kwargs)
+        except jwt.exceptions.PyJWTError as e:
+            with self.assertRaises(type(e)) as context:
+                jwt_codec.decode(token, SECRET, **kwargs)
+            self.assertEqual(str(context.exception), str(e))
+        else:
+            self.assertEqual(jwt_codec.decode(token, SECRET, **kwargs), expected)
+
+    def test_valid(self):
+        token = jwt.encode({"iss": "ssokey", "a": 1}, SECRET)
+        self.assertEqual(
+            jwt_codec.decode(token, SECRET, issuer="ssokey"), {"iss": "ssokey", "a": 1}
+        )
+        self.assertEqual(
+            jwt_codec.decode(token.decode("ascii"), SECRET), {"iss": "ssokey", "a": 1}
+        )
+
+    def test_same_errors_as_pyjwt(self):
+        valid = jwt.encode({"iss": "ssokey"}, SECRET).decode("ascii")
+        header, payload, signature = valid.split(".")
+        now = datetime.utcnow()
+        tokens = [
+            "",
+            "no segments",
+            "a.b",
+            "!.%s.%s" % (payload, signature),
+            "e30.%s.%s" % (payload, signature),
+            "%s.!.%s" % (header, payload),
+            "%s.%s.!" % (header, payload),
+            valid[:-2],
+            jwt.encode({"iss": "ssokey"}, "other secret"),
+            jwt.encode({"iss": "ssokey"}, SECRET, algorithm="HS512"),
+            jwt.encode({"iss": "other"}, SECRET),
+            jwt.encode({}, SECRET),
+            jwt.encode({"iss": "ssokey", "exp": now - timedelta(minutes=1)}, SECRET),
+            jwt.encode({"iss": "ssokey", "exp": "soon"}, SECRET),
+            jwt.encode({"iss": "ssokey", "nbf": now + timedelta(minutes=1)}, SECRET),
+            jwt.encode({"iss": "ssokey", "iat": "now"}, SECRET),
+            jwt.encode({"iss": "ssokey", "aud": "portal"}, SECRET),
+        ]
+        for token in tokens:
+            self.assertSameAsPyJWT(token, issuer="ssokey")
+        self.assertSameAsPyJWT(jwt.encode({}, SECRET))
+
+    def test_allowed_algorithms(self):
+        token = jwt.encode({}, SECRET, algorithm="HS512")
+        self.assertEqual(
+            jwt_codec.decode(token, SECRET, algorithms=frozenset(["HS512"])), {}
+        )
+        self.assertRaises(
+            jwt.exceptions.InvalidAlgorithmError, jwt_codec.decode, token, SECRET
+        )
+
+    def test_alg_not_a_string(self):
+        header = jwt.utils.base64url_encode(b'{"alg":["HS256"]}').decode("ascii")
+        valid = jwt.encode({}, SECRET).decode("ascii")
+        token = ".".join([header] + valid.split(".")[1:])
+        self.assertRaises(jwt.exceptions.DecodeError, jwt_codec.decode, token, SECRET)
+
+    def test_claim_not_a_number(self):
+        for claim in jwt_codec.TIME_CLAIMS:
+            token = jwt.encode({claim: [1]}, SECRET)
+            self.assertRaises(
+                jwt.exceptions.InvalidTokenError, jwt_codec.decode, token, SECRET
+            )
+
+
+class TestVerifyMessage(TestCase):
+    def setUp(self):
+        self.portal = factories.PortalF(sso_key="ssokey")
+
+    def error(self, key, message):
+        with self.assertRaises(ValidationError) as context:
+            jwt_codec.verify_message(key, message)
+        return context.exception.message
+
+    def test_valid(self):
+        message = jwt.encode({"iss": "ssokey", "a": 1}, self.portal.sso_secret)
+        portal, payload = jwt_codec.verify_message("ssokey", message)
+        self.assertEqual(portal, self.portal)
+        self.assertEqual(payload, {"iss": "ssokey", "a": 1})
+
+    def test_errors(self):
+        secret = self.portal.sso_secret
+        expired = datetime.utcnow() - timedelta(minutes=1)
+        self.assertEqual(self.error(None, "x"), "No SSO key")
+        self.assertEqual(self.error("nokey", "x"), "Invalid SSO key")
+        self.assertEqual(self.error("ssokey", "x"), "Failed to decode JWT")
+        self.assertEqual(
+            self.error("ssokey", jwt.encode({"iss": "ssokey"}, "other secret")),
+            "Failed to decode JWT",
+        )
+        self.assertEqual(
+            self.error("ssokey", jwt.encode({"iss": "ssokey", "exp": expired}, secret)),
+            "JWT has expired",
+        )
+        self.assertEqual(
+            self.error("ssokey", jwt.encode({"iss": "other"}, secret)),
+            "Public SSO key does not match signed issuer",
+        )
+        self.assertEqual(
+            self.error("ssokey", jwt.encode({}, secret)),
+            "JWT message misses 'iss' field (=SSO_KEY)",
+        )
+
+    def test_other_errors(self):
+        secret = self.portal.sso_secret
+        later = datetime.utcnow() + timedelta(minutes=1)
+        messages = [
+            jwt.encode({"iss": "ssokey", "nbf": later}, secret),
+            jwt.encode({"iss": "ssokey", "iat": "now"}, secret),
+            jwt.encode({"iss": "ssokey", "aud": "portal"}, secret),
+            jwt.encode({"iss": "ssokey"}, secret, algorithm="HS512"),
+        ]
+        for message in messages:
+            self.assertEqual(self.error("ssokey", message), "Failed to decode JWT")
@@ -0,0 +1,125 @@
+from django.core import mail
+from django.core.management import call_command
+from django.db import connection
+from django.test import override_settings
+from django.test import TestCase
+from django.utils import timezone
+from lizard_auth_server import models
+from lizard_auth_server.mail import send_mail
+from lizard_auth_server.management.commands import send_queued_mail
+from lizard_auth_server.tests import factories
+from unittest import mock
+
+import datetime
+
+
+class TestSendMail(TestCase):
+    def test_direct(self):
+        send_mail("Hi", "Hello", None, ["a@example.com"])
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertFalse(models.OutgoingEmail.objects.exists())
+
+    @override_settings(LIZARD_AUTH_SERVER_EMAIL_OUTBOX=True)
+    def test_queued(self):
+        send_mail("Hi", "Hello", None, ["a@example.com", "b@example.com"])
+        self.assertEqual(len(mail.outbox), 0)
+        queued = models.OutgoingEmail.objects.get()
+        self.assertEqual(
+            queued.recipients.splitlines(), ["a@example.com", "b@example.com"]
+        )
+
+    @override_settings(LIZARD_AUTH_SERVER_EMAIL_OUTBOX=True)
+    def test_invitation_is_queued(self):
+        invitation = factories.InvitationF.create(email="invited@example.com")
+        invitation.send_new_activation_email()
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(
+            models.OutgoingEmail.objects.get().recipients, invitation.email
+        )
+
+
+@override_settings(
+    LIZARD_AUTH_SERVER_EMAIL_OUTBOX=True,
+    LIZARD_AUTH_SERVER_EMAIL_OUTBOX_RETRY_DELAY=60,
+    LIZARD_AUTH_SERVER_EMAIL_OUTBOX_MAX_ATTEMPTS=2,
+)
+class TestSendQueuedMail(TestCase):
+    def setUp(self):
+        send_mail("Hi", "Hello", None, ["a@example.com"], html_message="<b>Hi</b>")
+        send_mail("Hi again", "Hello", None, ["b@example.com"])
+
+    def test_send(self):
+        call_command("send_queued_mail")
+        self.assertEqual(
+            [message.subject for message in mail.outbox], ["Hi", "Hi again"]
+        )
+        self.assertEqual(mail.outbox[0].alternatives, [("<b>Hi</b>", "text/html")])
+        self.assertFalse(models.OutgoingEmail.objects.filter(sent_at=None).exists())
+        # Nothing is sent twice.
+        call_command("send_queued_mail")
+        self.assertEqual(len(mail.outbox), 2)
+
+    def test_small_batches(self):
+        call_command("send_queued_mail", batch_size=1)
+        self.assertEqual(len(mail.outbox), 2)
+
+    @mock.patch(
+        "django.core.mail.EmailMultiAlternatives.send", side_effect=OSError("down")
+    )
+    def test_retry_with_backoff(self, patched_send):
+        call_command("send_queued_mail")
+        email = models.OutgoingEmail.objects.first()
+        self.assertEqual(email.attempts, 1)
+        self.assertEqual(email.last_error, "down")
+        self.assertGreater(
+            email.next_attempt_at, timezone.now() + datetime.timedelta(seconds=50)
+        )
+        # Not due yet.
+        call_command("send_queued_mail")
+        self.assertEqual(models.OutgoingEmail.objects.first().attempts, 1)
+
+    def test_old_mail_is_removed(self):
+        call_command("send_queued_mail")
+        models.OutgoingEmail.objects.update(
+            sent_at=timezone.now() - datetime.timedelta(days=8)
+        )
+        call_command("send_queued_mail")
+        self.assertFalse(models.OutgoingEmail.objects.exists())
+
+    @mock.patch(
+        "django.core.mail.EmailMultiAlternatives.send", side_effect=OSError("down")
+    )
+    def test_given_up_mail_is_removed(self, patched_send):
+        call_command("send_queued_mail")
+        models.OutgoingEmail.objects.update(next_attempt_at=timezone.now())
+        call_command("send_queued_mail")
+        self.assertEqual(models.OutgoingEmail.objects.first().attempts, 2)
+        models.OutgoingEmail.objects.update(
+            next_attempt_at=timezone.now() - datetime.timedelta(days=8)
+        )
+        call_command("send_queued_mail")
+        self.assertFalse(models.OutgoingEmail.objects.exists())
+
+    def test_sent_outside_a_transaction(self):
+        # Only the atomic blocks of the test itself are open while sending.
+        savepoint_ids = list(connection.savepoint_ids)
+        open_blocks = []
+
+        def send(message, *args, **kwargs):
+            open_blocks.append(connection.savepoint_ids != savepoint_ids)
+            return 1
+
+        with mock.patch("django.core.mail.EmailMultiAlternatives.send", send):
+            call_command("send_queued_mail")
+        self.assertEqual(open_blocks, [False, False])
+        email = models.OutgoingEmail.objects.first()
+        self.assertEqual(email.attempts, 1)
+        self.assertIsNotNone(email.sent_at)
+
+    def test_leased(self):
+        command = send_queued_mail.Command()
+        self.assertEqual(len(command.claim(10)), 2)
+        # Another worker doesn't get them.
+        self.assertEqual(command.claim(10), [])
+        models.OutgoingEmail.objects.update(next_attempt_at=timezone.now())
+        self.assertEqual(len(command.claim(10)), 2)
@@ -0,0 +1,144 @@
+from botocore.exceptions import ClientError
+from botocore.exceptions import EndpointConnectionError
+from django.core.exceptions import PermissionDenied
+from django.test import Client
+from django.test import override_settings
+from django.test import TestCase
+from itsdangerous import URLSafeTimedSerializer
+from lizard_auth_server import backends
+from lizard_auth_server import views_api_v2
+from lizard_auth_server.mail import send_mail
+from lizard_auth_server.tests import factories
+from prometheus_client import REGISTRY
+from unittest import mock
+
+
+def sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+class TestMetricsView(TestCase):
+    def test_metrics(self):
+        client = Client()
+        client.force_login(factories.UserF(username="admin", is_staff=True))
+        response = client.get("/metrics")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b"lizard_auth_server_sso_tokens_total", response.content)
+
+    def test_not_public(self):
+        self.assertEqual(Client().get("/metrics").status_code, 403)
+        client = Client()
+        client.force_login(factories.UserF(username="someone"))
+        self.assertEqual(client.get("/metrics").status_code, 403)
+        # Without a configured token, no header gets in.
+        response = Client().get("/metrics", HTTP_AUTHORIZATION="Bearer None")
+        self.assertEqual(response.status_code, 403)
+
+    @override_settings(LIZARD_AUTH_SERVER_METRICS_TOKEN="secret")
+    def test_token(self):
+        client = Client()
+        self.assertEqual(client.get("/metrics").status_code, 403)
+        response = client.get("/metrics", HTTP_AUTHORIZATION="Bearer wrong")
+        self.assertEqual(response.status_code, 403)
+        response = client.get("/metrics", HTTP_AUTHORIZATION="Bearer secret")
+        self.assertEqual(response.status_code, 200)
+
+
+class TestCredentialCheckMetrics(TestCase):
+    name = "lizard_auth_server_credential_checks_total"
+
+    def setUp(self):
+        self.portal = factories.PortalF()
+        factories.UserF(username="reinout", password="annie")
+        self.view = views_api_v2.CheckCredentialsView()
+
+    def check(self, **cleaned_data):
+        form = mock.Mock()
+        form.portal = self.portal
+        form.cleaned_data = cleaned_data
+        self.view.form_valid(form)
+
+    def test_valid(self):
+        before = sample(self.name, outcome="valid")
+        self.check(username="reinout", password="annie")
+        self.assertEqual(sample(self.name, outcome="valid"), before + 1)
+
+    def test_invalid(self):
+        before = sample(self.name, outcome="invalid")
+        with self.assertRaises(PermissionDenied):
+            self.check(username="reinout", password="wrong")
+        self.assertEqual(sample(self.name, outcome="invalid"), before + 1)
+
+    def test_bad_request(self):
+        before = sample(self.name, outcome="bad_request")
+        self.check(username="reinout")
+        self.assertEqual(sample(self.name, outcome="bad_request"), before + 1)
+
+
+class TestSSOTokenMetrics(TestCase):
+    name = "lizard_auth_server_sso_tokens_total"
+
+    def test_created(self):
+        portal = factories.PortalF(sso_key="ssokey")
+        message = URLSafeTimedSerializer(portal.sso_secret).dumps({"key": "ssokey"})
+        before = sample(self.name, event="created")
+        Client().get("/sso/api/request_token/", {"key": "ssokey", "message": message})
+        self.assertEqual(sample(self.name, event="created"), before + 1)
+
+
+class TestCognitoMetrics(TestCase):
+    name = "lizard_auth_server_cognito_calls_total"
+
+    def setUp(self):
+        self.breaker = backends.CircuitBreaker()
+
+    def assertOutcome(self, outcome, function):
+        before = sample(self.name, outcome=outcome)
+        try:
+            self.breaker.call(function)
+        except Exception:
+            pass
+        self.assertEqual(sample(self.name, outcome=outcome), before + 1)
+
+    def test_success(self):
+        self.assertOutcome("success", lambda: 42)
+
+    def test_error(self):
+        def wrong_password():
+            raise ClientError(
+                {"Error": {"Code": "NotAuthorizedException"}}, "AdminInitiateAuth"
+            )
+
+        self.assertOutcome("error", wrong_password)
+
+    def test_failure(self):
+        def timeout():
+            raise EndpointConnectionError(endpoint_url="https://cognito")
+
+        self.assertOutcome("failure", timeout)
+
+    def test_short_circuited(self):
+        self.breaker.state = self.breaker.OPEN
+        self.breaker._opened_at = float("inf")
+        self.assertOutcome("short_circuited", lambda: 42)
+
+    def test_duration(self):
+        name = "lizard_auth_server_cognito_call_duration_seconds_count"
+        before = sample(name)
+        self.breaker.call(lambda: 42)
+        self.assertEqual(sample(name), before + 1)
+
+
+class TestEmailMetrics(TestCase):
+    name = "lizard_auth_server_emails_total"
+
+    def test_direct(self):
+        before = sample(self.name, delivery="direct")
+        send_mail("subject", "body", None, ["someone@example.com"])
+        self.assertEqual(sample(self.name, delivery="direct"), before + 1)
+
+    @override_settings(LIZARD_AUTH_SERVER_EMAIL_OUTBOX=True)
+    def test_queued(self):
+        before = sample(self.name, delivery="queued")
+        send_mail("subject", "body", None, ["someone@example.com"])
+        self.assertEqual(sample(self.name, delivery="queued"), before + 1)
@@ -1,13 +1,26 @@
+from django.apps import apps
 from django.contrib.auth.models import User
 from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
+from django.db import IntegrityError
+from django.db.migrations.writer import MigrationWriter
 from django.forms.models import model_to_dict
 from django.test import override_settings
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from io import StringIO
 from lizard_auth_server import forms
 from lizard_auth_server import models
+from lizard_auth_server import utils
 from lizard_auth_server.tests import factories
 from unittest import mock
 
+import datetime
+import importlib
+
 
 @override_settings(AWS_ACCESS_KEY_ID="something")
 @mock.patch("lizard_auth_server.signal_handlers.CognitoUser")
@@ -247,6 +260,359 @@ class TestUserProfile(TestCase):
         self.assertTrue(profile_form.is_valid())
 
 
+class TestEffectiveOrganisationRole(TestCase):
+    def setUp(self):
+        self.portal = factories.PortalF.create()
+        self.role = factories.RoleF.create(portal=self.portal)
+        self.org = factories.OrganisationF.create()
+        self.orgrole = models.OrganisationRole.objects.create(
+            organisation=self.org, role=self.role
+        )
+        self.profile = factories.UserProfileF.create()
+
+    def found(self, portal=None):
+        return list(self.profile.all_organisation_roles(portal or self.portal))
+
+    def test_single_query(self):
+        self.profile.roles.add(self.orgrole)
+        with self.assertNumQueries(1):
+            self.assertEqual(self.found(), [self.orgrole])
+
+    def test_reverse_add_and_clear(self):
+        self.orgrole.user_profiles.add(self.profile)
+        self.assertEqual(self.found(), [self.orgrole])
+        self.orgrole.user_profiles.clear()
+        self.assertEqual(self.found(), [])
+
+    def test_profile_clear(self):
+        self.profile.roles.add(self.orgrole)
+        self.profile.roles.clear()
+        self.assertEqual(self.found(), [])
+
+    def test_for_all_users_change(self):
+        self.profile.organisations.add(self.org)
+        self.assertEqual(self.found(), [])
+        self.orgrole.for_all_users = True
+        self.orgrole.save()
+        self.assertEqual(self.found(), [self.orgrole])
+        self.org.user_profiles.remove(self.profile)
+        self.assertEqual(self.found(), [])
+
+    def test_organisation_change(self):
+        other_org = factories.OrganisationF.create()
+        self.profile.organisations.add(self.org)
+        self.orgrole.for_all_users = True
+        self.orgrole.save()
+        self.orgrole.organisation = other_org
+        self.orgrole.save()
+        self.assertEqual(self.found(), [])
+
+    def test_delete_organisation_role(self):
+        self.profile.roles.add(self.orgrole)
+        self.orgrole.delete()
+        self.assertEqual(self.found(), [])
+
+    def test_delete_organisation(self):
+        self.profile.organisations.add(self.org)
+        self.orgrole.for_all_users = True
+        self.orgrole.save()
+        self.org.delete()
+        self.assertEqual(self.found(), [])
+
+    def test_role_moves_to_other_portal(self):
+        other_portal = factories.PortalF.create()
+        self.profile.roles.add(self.orgrole)
+        self.role.portal = other_portal
+        self.role.save()
+        self.assertEqual(self.found(), [])
+        self.assertEqual(self.found(other_portal), [self.orgrole])
+
+    def test_inheritance_clear(self):
+        inheriting_role = factories.RoleF.create(name="inheriting", portal=self.portal)
+        inheriting_orgrole = models.OrganisationRole.objects.create(
+            organisation=self.org, role=inheriting_role
+        )
+        self.profile.roles.add(self.orgrole)
+        inheriting_role.base_roles.add(self.role)
+        self.assertEqual(len(self.found()), 2)
+        self.assertIn(inheriting_orgrole, self.found())
+        inheriting_role.base_roles.clear()
+        self.assertEqual(self.found(), [self.orgrole])
+
+    def test_inherited_organisation_role_created_later(self):
+        inheriting_role = factories.RoleF.create(name="inheriting", portal=self.portal)
+        self.role.inheriting_roles.add(inheriting_role)
+        self.profile.roles.add(self.orgrole)
+        inheriting_orgrole = models.OrganisationRole.objects.create(
+            organisation=self.org, role=inheriting_role
+        )
+        self.assertIn(inheriting_orgrole, self.found())
+
+    def add_chain(self, length):
+        """Add roles that inherit from self.role and from each other."""
+        roles = [self.role]
+        orgroles = [self.orgrole]
+        for i in range(length):
+            role = factories.RoleF.create(name="inheriting %s" % i, portal=self.portal)
+            role.base_roles.add(roles[-1])
+            roles.append(role)
+            orgroles.append(
+                models.OrganisationRole.objects.create(organisation=self.org, role=role)
+            )
+        return roles, orgroles
+
+    def test_multi_level_inheritance(self):
+        roles, orgroles = self.add_chain(3)
+        self.profile.roles.add(self.orgrole)
+        self.assertCountEqual(self.found(), orgroles)
+        # Breaking the chain in the middle.
+        roles[2].base_roles.clear()
+        self.assertCountEqual(self.found(), orgroles[:2])
+
+    def test_multi_level_inheritance_skips_organisations(self):
+        # The roles in between don't need an organisation role themselves.
+        roles, orgroles = self.add_chain(3)
+        orgroles[1].delete()
+        self.profile.roles.add(self.orgrole)
+        self.assertCountEqual(self.found(), [orgroles[0]] + orgroles[2:])
+
+    def test_delete_role_in_chain(self):
+        roles, orgroles = self.add_chain(3)
+        orgroles[1].delete()
+        self.profile.roles.add(self.orgrole)
+        roles[1].delete()
+        self.assertEqual(self.found(), [self.orgrole])
+
+    def test_inheritance_cycle(self):
+        roles, orgroles = self.add_chain(2)
+        roles[0].base_roles.add(roles[2])
+        self.profile.roles.add(orgroles[1])
+        self.assertCountEqual(self.found(), orgroles)
+        explanation = self.profile.all_organisation_roles(
+            self.portal, return_explanation=True
+        )
+        self.assertEqual(explanation["results"], orgroles)
+        self.assertEqual(explanation["inheritance_cycles"], [roles])
+
+    def test_explanation(self):
+        roles, orgroles = self.add_chain(2)
+        self.profile.organisations.add(self.org)
+        self.orgrole.for_all_users = True
+        self.orgrole.save()
+        explanation = self.profile.all_organisation_roles(
+            self.portal, return_explanation=True
+        )
+        self.assertEqual(explanation["organisation_roles_directly"], [])
+        self.assertEqual(
+            explanation["organisation_roles_via_organisation"], orgroles[:1]
+        )
+        self.assertEqual(explanation["direct_results"], orgroles[:1])
+        self.assertEqual(explanation["indirect_results"], orgroles[1:])
+        self.assertEqual(explanation["results"], orgroles)
+        self.assertEqual(explanation["inheritance_cycles"], [])
+
+    def test_rebuild_command(self):
+        self.profile.roles.add(self.orgrole)
+        models.EffectiveOrganisationRole.objects.all().delete()
+        stdout = StringIO()
+        call_command("rebuild_effective_roles", stdout=stdout)
+        self.assertEqual(self.found(), [self.orgrole])
+        self.assertIn("Verified", stdout.getvalue())
+
+    def test_rebuild_command_with_inheritance(self):
+        roles, orgroles = self.add_chain(3)
+        self.profile.roles.add(self.orgrole)
+        models.EffectiveOrganisationRole.objects.all().delete()
+        call_command("rebuild_effective_roles", stdout=StringIO())
+        self.assertCountEqual(self.found(), orgroles)
+
+    def test_migration_fills_table(self):
+        roles, orgroles = self.add_chain(2)
+        self.profile.roles.add(self.orgrole)
+        member = factories.UserProfileF.create()
+        member.organisations.add(self.org)
+        orgroles[1].for_all_users = True
+        orgroles[1].save()
+        stored = models.EffectiveOrganisationRole.objects.values_list(
+            "user_profile_id", "organisation_role_id", "portal_id"
+        )
+        expected = set(stored)
+        self.assertEqual(len(expected), 5)
+        models.EffectiveOrganisationRole.objects.all().delete()
+        migration = importlib.import_module(
+            "lizard_auth_server.migrations.0019_effectiveorganisationrole"
+        )
+        migration.fill_effective_roles(apps, mock.Mock(connection=connection))
+        self.assertEqual(set(stored), expected)
+
+    @mock.patch.object(models.EffectiveOrganisationRoleManager, "rebuild_for_profiles")
+    def test_rebuild_command_detects_mismatch(self, rebuild_for_profiles):
+        self.profile.roles.add(self.orgrole)
+        models.EffectiveOrganisationRole.objects.all().delete()
+        self.assertRaises(
+            CommandError, call_command, "rebuild_effective_roles", stdout=StringIO()
+        )
+
+
+class TestChangeLogCleanup(TestCase):
+    def setUp(self):
+        self.organisations = factories.OrganisationF.create_batch(3)
+        self.entries = list(models.ChangeLogEntry.objects.order_by("id"))
+        models.ChangeLogEntry.objects.update(
+            created=timezone.now() - datetime.timedelta(days=100)
+        )
+
+    def test_prune(self):
+        entry = factories.OrganisationF()
+        stdout = StringIO()
+        call_command("cleanup_change_log", stdout=stdout)
+        self.assertEqual(
+            list(models.ChangeLogEntry.objects.values_list("object_id", flat=True)),
+            [entry.unique_id],
+        )
+        self.assertIn("Deleted 3 old change log entries", stdout.getvalue())
+
+    def test_last_entry_is_kept(self):
+        self.assertEqual(list(models.ChangeLogEntry.objects.prune(timezone.now())), [2])
+        self.assertEqual(list(models.ChangeLogEntry.objects.all()), self.entries[2:])
+        self.assertEqual(
+            models.ChangeLogEntry.objects.oldest_cursor(), self.entries[2].id - 1
+        )
+
+    def test_batches(self):
+        factories.OrganisationF()
+        pruned = models.ChangeLogEntry.objects.prune(timezone.now(), batch_size=2)
+        self.assertEqual(list(pruned), [2, 1])
+
+    @override_settings(LIZARD_AUTH_SERVER_CHANGES_KEEP_DAYS=365)
+    def test_dry_run(self):
+        stdout = StringIO()
+        call_command("cleanup_change_log", dry_run=True, stdout=stdout)
+        self.assertEqual(stdout.getvalue(), "0 old change log entries\n")
+        self.assertEqual(models.ChangeLogEntry.objects.count(), 3)
+
+
+class TestCaseInsensitiveUserLookups(TestCase):
+    def setUp(self):
+        self.user = factories.UserF(username="Pietje", email="Pietje@Example.com")
+        factories.UserF(username="klaasje", email="klaasje@example.com")
+
+    def explain(self, queryset):
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            if connection.vendor == "sqlite":
+                cursor.execute("EXPLAIN QUERY PLAN " + sql, params)
+            else:
+                # The test tables are tiny: a sequential scan would win.
+                cursor.execute("SET LOCAL enable_seqscan = off")
+                cursor.execute("EXPLAIN " + sql, params)
+            return " ".join(str(row) for row in cursor.fetchall())
+
+    def test_users_by_username(self):
+        self.assertEqual(list(models.users_by_username("PIETJE")), [self.user])
+
+    def test_users_by_email(self):
+        self.assertEqual(list(models.users_by_email("pietje@example.COM")), [self.user])
+
+    def test_no_match(self):
+        self.assertFalse(models.users_by_username("Pietje@Example.com").exists())
+
+    def test_username_index_is_used(self):
+        if connection.vendor not in ("postgresql", "sqlite"):
+            self.skipTest("No expression indexes on %s" % connection.vendor)
+        plan = self.explain(models.users_by_username("pietje"))
+        self.assertIn("lizard_auth_server_user_username_lower", plan)
+
+    def test_email_index_is_used(self):
+        if connection.vendor not in ("postgresql", "sqlite"):
+            self.skipTest("No expression indexes on %s" % connection.vendor)
+        plan = self.explain(models.users_by_email("pietje@example.com"))
+        self.assertIn("lizard_auth_server_user_email_lower", plan)
+
+    def test_unmigrated_users_by_username(self):
+        self.assertTrue(models.unmigrated_users_by_username("pietje").exists())
+        models.UserProfile.objects.filter(user=self.user).update(
+            migrated_at=timezone.now()
+        )
+        self.assertFalse(models.unmigrated_users_by_username("pietje").exists())
+
+    def test_unmigrated_lookup_is_indexed(self):
+        if connection.vendor not in ("postgresql", "sqlite"):
+            self.skipTest("No partial indexes on %s" % connection.vendor)
+        plan = self.explain(models.unmigrated_users_by_username("pietje"))
+        if connection.vendor == "postgresql":
+            self.assertIn("lizard_auth_server_userprofile_unmigrated", plan)
+        else:
+            # SQLite always prefers the unique index on user_id, but it
+            # mustn't scan the profiles.
+            self.assertIn("lizard_auth_server_user_username_lower", plan)
+            self.assertNotIn("SCAN", plan)
+
+
+class TestKeyGeneration(TestCase):
+    def test_key(self):
+        key = utils.default_gen_secret_key(64)
+        self.assertEqual(len(key), 64)
+        self.assertTrue(set(key) <= set(utils.KEY_CHARACTERS))
+
+    def test_all_characters_used(self):
+        keys = "".join(utils.default_gen_secret_key(64) for _ in range(100))
+        self.assertEqual(set(keys), set(utils.KEY_CHARACTERS))
+
+    def test_unusable_bytes_are_dropped(self):
+        # Only the first call returns the (biased) bytes above 247.
+        random_bytes = [bytes(range(248, 256)) * 10, bytes(range(200))]
+        with mock.patch("os.urandom", side_effect=random_bytes):
+            key = utils.default_gen_secret_key(64)
+        self.assertEqual(key, utils.KEY_CHARACTERS[:62] + "ab")
+
+    def test_create_for_portal_no_existence_check(self):
+        portal = factories.PortalF()
+        with CaptureQueriesContext(connection) as context:
+            token = models.Token.objects.create_for_portal(portal)
+        statements = [query["sql"].split()[0] for query in context.captured_queries]
+        self.assertIn("INSERT", statements)
+        self.assertNotIn("SELECT", statements)
+        self.assertNotEqual(token.request_token, token.auth_token)
+
+    def test_create_for_portal_collision(self):
+        portal = factories.PortalF()
+        keys = ["a" * 64 + "b" * 64] * 2 + ["c" * 128]
+        with mock.patch("lizard_auth_server.models.gen_secret_key", side_effect=keys):
+            models.Token.objects.create_for_portal(portal)
+            token = models.Token.objects.create_for_portal(portal)
+        self.assertEqual(token.request_token, "c" * 64)
+        self.assertEqual(models.Token.objects.count(), 2)
+
+    def test_create_for_portal_gives_up(self):
+        portal = factories.PortalF()
+        with mock.patch(
+            "lizard_auth_server.models.gen_secret_key", return_value="a" * 128
+        ) as gen_secret_key:
+            models.Token.objects.create_for_portal(portal)
+            self.assertRaises(
+                IntegrityError, models.Token.objects.create_for_portal, portal
+            )
+        self.assertEqual(gen_secret_key.call_count, 1 + models.KEY_ATTEMPTS)
+
+    def test_rotate_keys_collision(self):
+        portal = factories.PortalF()
+        other = factories.PortalF()
+        keys = [other.sso_secret, other.sso_key, "a" * 64, "b" * 64]
+        with mock.patch("lizard_auth_server.models.gen_secret_key", side_effect=keys):
+            portal.rotate_keys()
+        portal.refresh_from_db()
+        self.assertEqual(portal.sso_secret, "a" * 64)
+        self.assertEqual(portal.sso_key, "b" * 64)
+
+    def test_key_fields_serializable(self):
+        # Migrations need to serialize the GenKey defaults.
+        for name in ("sso_secret", "sso_key"):
+            field = models.Portal._meta.get_field(name)
+            serialized, imports = MigrationWriter.serialize(field)
+            self.assertIn("lizard_auth_server.models.GenKey", serialized)
+
+
 class StrMethodTestCase(TestCase):
     def call_str(self, obj):
         self.assertEqual(type(obj.__str__()), str)
@@ -0,0 +1,124 @@
+from django.conf import settings
+from django.test import Client
+from django.test import override_settings
+from django.test import TestCase
+from lizard_auth_server import performance
+from lizard_auth_server import query_budgets
+from lizard_auth_server.tests import factories
+from unittest import mock
+
+import json
+import jwt
+
+
+MIDDLEWARE = ["lizard_auth_server.middleware.PerformanceMiddleware"] + list(
+    settings.MIDDLEWARE
+)
+
+
+class TestHistogram(TestCase):
+    def test_observe(self):
+        histogram = performance.Histogram((1, 10))
+        for value in (0.5, 1, 5, 20):
+            histogram.observe(value)
+        self.assertEqual(histogram.count, 4)
+        self.assertEqual(histogram.sum, 26.5)
+        self.assertEqual(histogram.cumulative_counts(), [(1, 2), (10, 3), ("+Inf", 4)])
+
+
+class TestTimed(TestCase):
+    def tearDown(self):
+        performance.end_request()
+
+    def test_outside_request(self):
+        with performance.timed("jwt"):
+            pass
+
+    def test_section(self):
+        timer = performance.start_request()
+        with performance.timed("jwt"):
+            sum(range(1000))
+        self.assertGreater(timer.sections["jwt"], 0)
+        self.assertEqual(timer.sections["cognito"], 0)
+
+    def test_nested_counts_once(self):
+        timer = performance.start_request()
+        with performance.timed("cognito"):
+            with performance.timed("cognito"):
+                sum(range(1000))
+            inner = timer.sections["cognito"]
+        self.assertEqual(inner, 0)
+        self.assertGreater(timer.sections["cognito"], 0)
+
+
+@override_settings(MIDDLEWARE=MIDDLEWARE)
+class TestPerformanceMiddleware(TestCase):
+    def setUp(self):
+        performance.stats.reset()
+        self.portal = factories.PortalF(sso_key="ssokey")
+        self.client = Client()
+
+    def test_start_view(self):
+        self.client.get("/api2/")
+        self.client.get("/api2/")
+        stats = performance.stats.snapshot()["lizard_auth_server.api_v2.start"]
+        self.assertEqual(stats["wall_ms"]["count"], 2)
+        self.assertEqual(stats["queries"]["sum"], 0)
+
+    def test_queries_and_jwt(self):
+        factories.OrganisationF()
+        message = jwt.encode({"iss": "ssokey"}, self.portal.sso_secret)
+        self.client.get("/api2/organisations/", {"key": "ssokey", "message": message})
+        stats = performance.stats.snapshot()["lizard_auth_server.api_v2.organisations"]
+        self.assertGreater(stats["queries"]["sum"], 0)
+        # Django logs the query times in whole milliseconds.
+        self.assertEqual(stats["db_ms"]["count"], 1)
+        self.assertGreater(stats["jwt_ms"]["sum"], 0)
+        self.assertEqual(stats["cognito_ms"]["sum"], 0)
+
+    def test_unresolved(self):
+        self.client.get("/does/not/exist/")
+        self.assertIn(performance.UNRESOLVED, performance.stats.snapshot())
+
+    @override_settings(LIZARD_AUTH_SERVER_PERFORMANCE_SLOW_REQUEST_MS=0)
+    def test_slow_request_log(self):
+        with self.assertLogs("lizard_auth_server.middleware", "WARNING") as logs:
+            self.client.get("/api2/")
+        log_line = json.loads(logs.records[0].getMessage())
+        self.assertEqual(log_line["event"], "slow_request")
+        self.assertEqual(log_line["url_name"], "lizard_auth_server.api_v2.start")
+        self.assertEqual(log_line["status"], 200)
+        self.assertIn("db_ms", log_line)
+
+    def test_query_budget_exceeded_log(self):
+        message = jwt.encode({"iss": "ssokey"}, self.portal.sso_secret)
+        url_name = "lizard_auth_server.api_v2.organisations"
+        with mock.patch.dict(query_budgets.COLD_BUDGETS, {url_name: 0}):
+            with self.assertLogs("lizard_auth_server.middleware", "WARNING") as logs:
+                self.client.get(
+                    "/api2/organisations/", {"key": "ssokey", "message": message}
+                )
+        log_line = json.loads(logs.records[0].getMessage())
+        self.assertEqual(log_line["event"], "query_budget_exceeded")
+        self.assertEqual(log_line["budget"], 0)
+        self.assertGreater(log_line["queries"], 0)
+
+    def test_fast_request_not_logged(self):
+        with self.assertRaises(AssertionError):
+            with self.assertLogs("lizard_auth_server.middleware", "WARNING"):
+                self.client.get("/api2/")
+
+    def test_endpoint_staff_only(self):
+        user = factories.UserF(username="someone")
+        self.client.force_login(user)
+        response = self.client.get("/performance/")
+        self.assertEqual(response.status_code, 302)
+
+    def test_endpoint(self):
+        user = factories.UserF(username="admin", is_staff=True)
+        self.client.force_login(user)
+        self.client.get("/api2/")
+        response = self.client.get("/performance/")
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(data["lizard_auth_server.api_v2.start"]["wall_ms"]["count"], 1)
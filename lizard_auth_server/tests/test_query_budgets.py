@@ -0,0 +1,265 @@
+from django.contrib.auth.models import Permission
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import connection
+from django.db import transaction
+from django.test import Client
+from django.test import override_settings
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from lizard_auth_server import models
+from lizard_auth_server import query_budgets
+from lizard_auth_server.benchmarks import fixtures
+from lizard_auth_server.benchmarks.flows import v1_message
+from lizard_auth_server.benchmarks.flows import v2_message
+from lizard_auth_server.registry import portal_registry
+from lizard_auth_server.token_store import get_token_store
+
+
+# The bigger data set has more of everything, including more permissions,
+# organisations and organisation roles for the user of the requests.
+SIZES = [
+    ({"portals": 2, "organisations": 4, "roles_per_portal": 3, "users": 5}, 1),
+    ({"portals": 4, "organisations": 16, "roles_per_portal": 8, "users": 40}, 6),
+]
+
+
+def grow(data, user, portal, amount):
+    """Give every user ``amount`` permissions and ``user`` more memberships."""
+    permissions = list(Permission.objects.order_by("id")[:amount])
+    User.user_permissions.through.objects.bulk_create(
+        [
+            User.user_permissions.through(user_id=other.id, permission_id=permission.id)
+            for other in data.users
+            for permission in permissions
+        ]
+    )
+    profile = models.UserProfile.objects.fetch_for_user(user)
+    organisations = list(models.Organisation.objects.order_by("id")[:amount])
+    profile.organisations.add(*organisations)
+    profile.roles.add(
+        *models.OrganisationRole.objects.filter(
+            organisation__in=organisations, role__portal=portal
+        )
+    )
+
+
+class Requests(object):
+    """One request per endpoint with a query budget, keyed by URL name.
+
+    Every method prepares a fresh request (tokens, logged-in client) and
+    returns a function that does it, so only the request itself is measured.
+
+    """
+
+    def __init__(self, data, user, portal):
+        self.data = data
+        self.user = user
+        self.portal = portal
+
+    def logged_in_client(self):
+        client = Client()
+        client.force_login(self.user)
+        return client
+
+    def v1_post(self, url_name, **params):
+        return lambda: Client().post(
+            reverse(url_name), v1_message(self.portal, **params)
+        )
+
+    def get_user(self):
+        return self.v1_post(
+            "lizard_auth_server.api.get_user", username=self.user.username
+        )
+
+    def get_users(self):
+        return self.v1_post("lizard_auth_server.api.get_users")
+
+    def get_organisations(self):
+        return self.v1_post("lizard_auth_server.api.get_organisations")
+
+    def roles(self):
+        return self.v1_post("lizard_auth_server.api.roles")
+
+    def user_organisation_roles(self):
+        return self.v1_post(
+            "lizard_auth_server.api.user_organisation_roles",
+            username=self.user.username,
+        )
+
+    def user_organisation_roles_batch(self):
+        return self.v1_post(
+            "lizard_auth_server.api.user_organisation_roles_batch",
+            usernames=[user.username for user in self.data.users],
+        )
+
+    def request_token(self):
+        return lambda: Client().get(
+            reverse("lizard_auth_server.sso.api.request_token"),
+            v1_message(self.portal),
+        )
+
+    def authorize(self):
+        token = get_token_store().create(self.portal)
+        client = self.logged_in_client()
+        return lambda: client.get(
+            reverse("lizard_auth_server.sso.authorize"),
+            v1_message(self.portal, request_token=token.request_token),
+        )
+
+    def verify(self):
+        store = get_token_store()
+        token = store.create(self.portal)
+        store.authorize(token, self.user)
+        return lambda: Client().get(
+            reverse("lizard_auth_server.sso.api.verify"),
+            v1_message(self.portal, auth_token=token.auth_token),
+        )
+
+    def check_credentials(self):
+        return lambda: Client().post(
+            reverse("lizard_auth_server.api_v2.check_credentials"),
+            v2_message(
+                self.portal, username=self.user.username, password=self.data.password
+            ),
+        )
+
+    def login(self):
+        client = self.logged_in_client()
+        return lambda: client.get(
+            reverse("lizard_auth_server.api_v2.login"),
+            v2_message(self.portal, login_success_url=self.portal.visit_url),
+        )
+
+    def find_user(self):
+        return lambda: Client().get(
+            reverse("lizard_auth_server.api_v2.find_user"),
+            v2_message(self.portal, email=self.user.email),
+        )
+
+    def organisations(self):
+        return lambda: Client().get(
+            reverse("lizard_auth_server.api_v2.organisations"),
+            v2_message(self.portal),
+        )
+
+    def changes(self):
+        # The fixtures are inserted without signals, so there are hardly any
+        # change log entries yet. Log them all, so the feed returns objects
+        # of every type.
+        log = models.ChangeLogEntry.objects.log
+        log(models.ChangeLogEntry.USER, [user.username for user in self.data.users])
+        log(
+            models.ChangeLogEntry.ORGANISATION,
+            models.Organisation.objects.values_list("unique_id", flat=True),
+        )
+        for role in models.Role.objects.filter(portal=self.portal):
+            log(models.ChangeLogEntry.ROLE, [role.unique_id], portal_id=role.portal_id)
+        log(
+            models.ChangeLogEntry.ORGANISATION_ROLE,
+            [
+                str(pk)
+                for pk in models.OrganisationRole.objects.filter(
+                    role__portal=self.portal
+                ).values_list("pk", flat=True)
+            ],
+            portal_id=self.portal.id,
+        )
+        return lambda: Client().get(
+            reverse("lizard_auth_server.api_v2.changes"),
+            v2_message(self.portal, cursor=0),
+        )
+
+    def prepare(self, url_name):
+        return getattr(self, url_name.rsplit(".", 1)[-1])()
+
+
+def run_commit_hooks():
+    """Run the on_commit() callbacks as if the transaction was committed.
+
+    The role graph and the access vectors are only cached once their changes
+    are committed, see ``catalog.bump_on_commit()``.
+
+    """
+    callbacks, connection.run_on_commit = connection.run_on_commit, []
+    for savepoint_ids, callback in callbacks:
+        callback()
+
+
+def count_queries(requests, url_name, cold=False):
+    # Do the request once beforehand to fill the caches (the portal registry,
+    # the catalog versions), so that we measure the steady state. With
+    # ``cold``, we empty the caches again right before the request.
+    requests.prepare(url_name)()
+    do_request = requests.prepare(url_name)
+    if cold:
+        cache.clear()
+        portal_registry.clear()
+    with CaptureQueriesContext(connection) as captured:
+        response = do_request()
+    assert response.status_code in (200, 302), response.content[:200]
+    return len(captured)
+
+
+@override_settings(
+    PASSWORD_HASHERS=["django.contrib.auth.hashers.MD5PasswordHasher"],
+    LIZARD_AUTH_SERVER_CHANGES_SETTLE_SECONDS=0,
+)
+class TestQueryBudgets(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cache.clear()
+        cls.counts = [cls.measure(size, amount) for size, amount in SIZES]
+        cls.cold_counts = [
+            cls.measure(size, amount, cold=True) for size, amount in SIZES
+        ]
+
+    @classmethod
+    def measure(cls, size, amount, cold=False):
+        """Return the query counts per URL name for a data set of this size."""
+        with transaction.atomic():
+            data = fixtures.create_fixtures(**size)
+            user = data.users[0]
+            portal = data.access[user.id][0]
+            grow(data, user, portal, amount)
+            run_commit_hooks()
+            requests = Requests(data, user, portal)
+            counts = {
+                url_name: count_queries(requests, url_name, cold=cold)
+                for url_name in query_budgets.BUDGETS
+            }
+            transaction.set_rollback(True)
+        return counts
+
+    def test_every_budget_has_a_request(self):
+        for url_name in query_budgets.BUDGETS:
+            reverse(url_name)
+            self.assertTrue(hasattr(Requests, url_name.rsplit(".", 1)[-1]))
+
+    def test_constant(self):
+        for counts in (self.counts, self.cold_counts):
+            small, large = counts
+            growing = {
+                url_name: (small[url_name], large[url_name])
+                for url_name in query_budgets.BUDGETS
+                if small[url_name] != large[url_name]
+            }
+            self.assertEqual(growing, {}, "The number of queries grows with the data")
+
+    def test_within_budget(self):
+        for all_counts, budgets in (
+            (self.counts, query_budgets.BUDGETS),
+            (self.cold_counts, query_budgets.COLD_BUDGETS),
+        ):
+            over_budget = {
+                url_name: max(counts[url_name] for counts in all_counts)
+                for url_name, budget in budgets.items()
+                if max(counts[url_name] for counts in all_counts) > budget
+            }
+            self.assertEqual(over_budget, {}, "Queries over budget")
+
+    def test_cold_budgets(self):
+        self.assertEqual(set(query_budgets.COLD_BUDGETS), set(query_budgets.BUDGETS))
+        for url_name, budget in query_budgets.BUDGETS.items():
+            self.assertGreaterEqual(query_budgets.COLD_BUDGETS[url_name], budget)
@@ -0,0 +1,55 @@
+from django.test import override_settings
+from django.test import TestCase
+from lizard_auth_server.models import Portal
+from lizard_auth_server.registry import portal_registry
+from lizard_auth_server.registry import PortalRegistry
+from lizard_auth_server.tests import factories
+
+
+class TestPortalRegistry(TestCase):
+    def setUp(self):
+        portal_registry.clear()
+        self.portal = factories.PortalF.create(sso_key="ssokey")
+
+    def test_get(self):
+        self.assertEqual(portal_registry.get("ssokey"), self.portal)
+
+    def test_second_get_is_free(self):
+        portal_registry.get("ssokey")
+        with self.assertNumQueries(0):
+            portal_registry.get("ssokey")
+
+    def test_unknown_key(self):
+        self.assertRaises(Portal.DoesNotExist, portal_registry.get, "nonexisting")
+
+    def test_save_invalidates(self):
+        portal_registry.get("ssokey")
+        self.portal.name = "renamed"
+        self.portal.save()
+        self.assertEqual(portal_registry.get("ssokey").name, "renamed")
+
+    def test_delete_invalidates(self):
+        portal_registry.get("ssokey")
+        self.portal.delete()
+        self.assertRaises(Portal.DoesNotExist, portal_registry.get, "ssokey")
+
+    def test_rotate_keys_invalidates_old_key(self):
+        portal_registry.get("ssokey")
+        self.portal.rotate_keys()
+        self.assertRaises(Portal.DoesNotExist, portal_registry.get, "ssokey")
+        self.assertEqual(portal_registry.get(self.portal.sso_key), self.portal)
+
+    @override_settings(LIZARD_AUTH_SERVER_PORTAL_CACHE_TIMEOUT=0)
+    def test_expiry(self):
+        portal_registry.get("ssokey")
+        with self.assertNumQueries(1):
+            portal_registry.get("ssokey")
+
+    @override_settings(LIZARD_AUTH_SERVER_PORTAL_CACHE_SIZE=1)
+    def test_size_bound(self):
+        registry = PortalRegistry()
+        factories.PortalF.create(sso_key="otherkey")
+        registry.get("ssokey")
+        registry.get("otherkey")
+        with self.assertNumQueries(1):
+            registry.get("ssokey")
@@ -0,0 +1,134 @@
+from django.core.cache import cache
+from django.test import override_settings
+from django.test import TestCase
+from django.urls import reverse
+from lizard_auth_server import replay_cache
+from lizard_auth_server import views_api_v2
+from lizard_auth_server.tests import factories
+
+import datetime
+import jwt
+import mock
+import time
+
+
+def message(portal, **payload):
+    exp = datetime.datetime.utcnow() + datetime.timedelta(minutes=1)
+    payload.setdefault("exp", exp)
+    payload["iss"] = portal.sso_key
+    return jwt.encode(payload, portal.sso_secret, algorithm="HS256").decode("ascii")
+
+
+class TestWindow(TestCase):
+    def test_exp(self):
+        self.assertEqual(replay_cache.window({"exp": int(time.time()) + 60}), 60)
+
+    def test_capped(self):
+        self.assertEqual(replay_cache.window({"exp": int(time.time()) + 3600}), 300)
+
+    def test_no_exp(self):
+        self.assertEqual(replay_cache.window({}), 300)
+
+    def test_expired(self):
+        self.assertEqual(replay_cache.window({"exp": int(time.time()) - 1}), 0)
+
+
+class TestReplayCache(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.portal = factories.PortalF.create(sso_key="ssokey")
+        self.user = factories.UserF(
+            username="reinout", password="annie", email="reinout@example.com"
+        )
+
+    def check_credentials(self, signed_message):
+        return self.client.post(
+            reverse("lizard_auth_server.api_v2.check_credentials"),
+            {"key": "ssokey", "message": signed_message},
+        )
+
+    def find_user(self, signed_message):
+        return self.client.get(
+            reverse("lizard_auth_server.api_v2.find_user"),
+            {"key": "ssokey", "message": signed_message},
+        )
+
+    def test_disabled_by_default(self):
+        signed_message = message(self.portal, username="reinout", password="annie")
+        self.assertEqual(self.check_credentials(signed_message).status_code, 200)
+        self.assertEqual(self.check_credentials(signed_message).status_code, 200)
+
+    @override_settings(LIZARD_AUTH_SERVER_JWT_REPLAY_CACHE="default")
+    def test_check_credentials_replay_rejected(self):
+        signed_message = message(self.portal, username="reinout", password="annie")
+        with mock.patch.object(
+            views_api_v2,
+            "django_authenticate",
+            wraps=views_api_v2.django_authenticate,
+        ) as authenticate:
+            self.assertEqual(self.check_credentials(signed_message).status_code, 200)
+            response = self.check_credentials(signed_message)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(authenticate.call_count, 1)
+        # A new message is fine.
+        other_message = message(
+            self.portal, username="reinout", password="annie", nonce=1
+        )
+        self.assertEqual(self.check_credentials(other_message).status_code, 200)
+
+    @override_settings(LIZARD_AUTH_SERVER_JWT_REPLAY_CACHE="default")
+    def test_find_user_remembered(self):
+        signed_message = message(self.portal, email="reinout@example.com")
+        response = self.find_user(signed_message)
+        self.assertEqual(response.status_code, 200)
+        with self.assertNumQueries(0):
+            replayed = self.find_user(signed_message)
+        self.assertEqual(replayed.status_code, 200)
+        self.assertEqual(replayed.content, response.content)
+        self.assertEqual(replayed["Content-Type"], "application/json")
+        self.assertIn("no-cache", replayed["Cache-Control"])
+
+    @override_settings(LIZARD_AUTH_SERVER_JWT_REPLAY_CACHE="default")
+    def test_errors_not_remembered(self):
+        signed_message = message(self.portal, email="pietje@example.com")
+        self.assertEqual(self.find_user(signed_message).status_code, 404)
+        factories.UserF(username="pietje", email="pietje@example.com")
+        self.assertEqual(self.find_user(signed_message).status_code, 200)
+
+    @override_settings(LIZARD_AUTH_SERVER_JWT_REPLAY_CACHE="default")
+    def test_copied_signature(self):
+        signed_message = message(self.portal, email="reinout@example.com")
+        self.find_user(signed_message)
+        header, payload, signature = signed_message.split(".")
+        other_payload = message(self.portal, email="other@example.com").split(".")[1]
+        response = self.find_user(".".join([header, other_payload, signature]))
+        self.assertEqual(response.status_code, 400)
+
+    @override_settings(LIZARD_AUTH_SERVER_JWT_REPLAY_CACHE="default")
+    def test_organisations_conditional(self):
+        url = reverse("lizard_auth_server.api_v2.organisations")
+        params = {"key": "ssokey", "message": message(self.portal)}
+        response = self.client.get(url, params)
+        self.assertEqual(self.client.get(url, params)["ETag"], response["ETag"])
+        response = self.client.get(url, params, HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(response.status_code, 304)
+
+    @override_settings(LIZARD_AUTH_SERVER_JWT_REPLAY_CACHE="default")
+    def test_not_remembered_after_exp(self):
+        exp = int(time.time()) + 60
+        signed_message = message(self.portal, email="reinout@example.com", exp=exp)
+        self.assertEqual(self.find_user(signed_message).status_code, 200)
+        # The cache may keep the entry a bit longer than the message is valid.
+        with mock.patch.object(replay_cache, "time") as mocked_time:
+            mocked_time.time.return_value = exp + 1
+            self.assertIsNone(
+                replay_cache.get_response({"key": "ssokey", "message": signed_message})
+            )
+
+    @override_settings(LIZARD_AUTH_SERVER_JWT_REPLAY_CACHE="default")
+    def test_not_remembered_after_new_secret(self):
+        signed_message = message(self.portal, email="reinout@example.com")
+        self.assertEqual(self.find_user(signed_message).status_code, 200)
+        self.portal.sso_secret = "new secret"
+        self.portal.save()
+        self.assertEqual(self.find_user(signed_message).status_code, 400)
@@ -0,0 +1,144 @@
+from django.core.cache import cache
+from django.db import transaction
+from django.test import TestCase
+from django.test import TransactionTestCase
+from lizard_auth_server import role_graph
+from lizard_auth_server.tests import factories
+
+import mock
+
+
+class TestRoleGraph(TestCase):
+    def graph(self, inheritance, portals=None):
+        # Roles 1..6, in portal 1 unless specified otherwise.
+        portals = portals or {}
+        return role_graph.RoleGraph(
+            [(role_id, portals.get(role_id, 1)) for role_id in range(1, 7)],
+            inheritance,
+        )
+
+    def test_no_inheritance(self):
+        graph = self.graph([])
+        self.assertEqual(graph.ancestor_ids([1, 2]), set())
+        self.assertEqual(graph.descendant_ids([1, 2]), set())
+        self.assertEqual(graph.cycles, [])
+
+    def test_chain(self):
+        # 1 is the base role of 2, 2 of 3, 3 of 4.
+        graph = self.graph([(1, 2), (2, 3), (3, 4)])
+        self.assertEqual(graph.ancestor_ids([4]), {1, 2, 3})
+        self.assertEqual(graph.descendant_ids([1]), {2, 3, 4})
+        self.assertEqual(graph.descendant_ids([3]), {4})
+        self.assertTrue(graph.ancestors_of(4) & graph.bit(1))
+        self.assertFalse(graph.ancestors_of(1) & graph.bit(4))
+
+    def test_diamond(self):
+        graph = self.graph([(1, 2), (1, 3), (2, 4), (3, 4)])
+        self.assertEqual(graph.ancestor_ids([4]), {1, 2, 3})
+        self.assertEqual(graph.descendant_ids([1]), {2, 3, 4})
+        self.assertEqual(graph.cycles, [])
+
+    def test_cycle(self):
+        # 2, 3 and 4 inherit from each other, 5 inherits from the cycle.
+        graph = self.graph([(1, 2), (2, 3), (3, 4), (4, 2), (4, 5)])
+        self.assertEqual(graph.cycles, [[2, 3, 4]])
+        self.assertEqual(graph.ancestor_ids([3]), {1, 2, 3, 4})
+        self.assertEqual(graph.ancestor_ids([5]), {1, 2, 3, 4})
+        self.assertEqual(graph.descendant_ids([2]), {2, 3, 4, 5})
+        self.assertEqual(graph.descendant_ids([5]), set())
+
+    def test_self_inheritance(self):
+        graph = self.graph([(1, 1)])
+        self.assertEqual(graph.cycles, [[1]])
+
+    def test_long_chain(self):
+        # No recursion limit.
+        count = 5000
+        graph = role_graph.RoleGraph(
+            [(role_id, 1) for role_id in range(count)],
+            [(role_id, role_id + 1) for role_id in range(count - 1)],
+        )
+        self.assertEqual(len(graph.ancestor_ids([count - 1])), count - 1)
+
+    def test_descendants_per_portal(self):
+        graph = self.graph([(1, 2), (2, 3)], portals={3: 2})
+        self.assertEqual(graph.descendant_ids([1], portal_id=1), {2})
+        self.assertEqual(graph.descendant_ids([1], portal_id=2), {3})
+        self.assertEqual(graph.descendant_ids([1], portal_id=3), set())
+
+    def test_unknown_roles(self):
+        graph = self.graph([(1, 2), (7, 2)])
+        self.assertEqual(graph.ancestor_ids([2]), {1})
+        self.assertEqual(graph.bit(7), 0)
+        self.assertEqual(graph.ancestors_of(7), 0)
+
+
+class TestGetRoleGraph(TransactionTestCase):
+    # The graph version is only bumped after a commit.
+
+    def setUp(self):
+        cache.clear()
+        portal = factories.PortalF.create()
+        self.role1 = factories.RoleF.create(portal=portal)
+        self.role2 = factories.RoleF.create(portal=portal)
+
+    def test_cached(self):
+        role_graph.get_role_graph()
+        with self.assertNumQueries(0):
+            role_graph.get_role_graph()
+
+    def test_reloaded_after_change(self):
+        self.assertEqual(
+            role_graph.get_role_graph().descendant_ids([self.role1.id]), set()
+        )
+        self.role1.inheriting_roles.add(self.role2)
+        self.assertEqual(
+            role_graph.get_role_graph().descendant_ids([self.role1.id]),
+            {self.role2.id},
+        )
+        self.role2.delete()
+        self.assertEqual(
+            role_graph.get_role_graph().descendant_ids([self.role1.id]), set()
+        )
+
+    def test_uncommitted_changes(self):
+        role_graph.get_role_graph()
+        with transaction.atomic():
+            self.role1.inheriting_roles.add(self.role2)
+            graph = role_graph.get_role_graph()
+            self.assertEqual(graph.descendant_ids([self.role1.id]), {self.role2.id})
+            # Not kept: another graph every time.
+            self.assertIsNot(role_graph.get_role_graph(), graph)
+        with self.assertNumQueries(2):
+            graph = role_graph.get_role_graph()
+        self.assertEqual(graph.descendant_ids([self.role1.id]), {self.role2.id})
+
+    def test_rollback(self):
+        role_graph.get_role_graph()
+        with self.assertRaises(RuntimeError):
+            with transaction.atomic():
+                self.role1.inheriting_roles.add(self.role2)
+                role_graph.get_role_graph()
+                raise RuntimeError("Roll back")
+        with self.assertNumQueries(0):
+            graph = role_graph.get_role_graph()
+        self.assertEqual(graph.descendant_ids([self.role1.id]), set())
+
+    def test_loaded_while_waiting(self):
+        loaded = role_graph.get_role_graph()
+        role_graph._current = None
+
+        class OtherThreadLoads(object):
+            # The lock is released after another thread loaded the graph.
+            def __enter__(self):
+                role_graph._current = (
+                    role_graph.catalog.get_version(role_graph.catalog.ROLE_GRAPH),
+                    loaded,
+                )
+
+            def __exit__(self, *exc_info):
+                pass
+
+        with mock.patch.object(role_graph, "_lock", OtherThreadLoads()):
+            with self.assertNumQueries(0):
+                self.assertIs(role_graph.get_role_graph(), loaded)
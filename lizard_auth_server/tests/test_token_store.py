@@ -0,0 +1,226 @@
+from django.conf import settings
+from django.core.cache import caches
+from django.core.management import call_command
+from django.test import Client
+from django.test import override_settings
+from django.test import TestCase
+from io import StringIO
+from itsdangerous import URLSafeTimedSerializer
+from lizard_auth_server import models
+from lizard_auth_server.tests import factories
+from lizard_auth_server.token_store import CacheTokenStore
+from lizard_auth_server.token_store import DatabaseTokenStore
+from lizard_auth_server.token_store import get_token_store
+from unittest import mock
+
+import datetime
+import json
+import pytz
+
+
+TOKEN_CACHES = dict(
+    settings.CACHES,
+    tokens={"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+)
+CACHE_STORE = "lizard_auth_server.token_store.CacheTokenStore"
+
+
+class TokenStoreTests(object):
+    """Tests that every token store should pass."""
+
+    def setUp(self):
+        self.store = get_token_store()
+        self.portal = factories.PortalF()
+        self.other_portal = factories.PortalF()
+        self.user = factories.UserF()
+
+    def test_create(self):
+        token = self.store.create(self.portal)
+        self.assertEqual(len(token.request_token), 64)
+        self.assertEqual(len(token.auth_token), 64)
+        self.assertEqual(token.portal, self.portal)
+
+    def test_get_unauthorized(self):
+        token = self.store.create(self.portal)
+        found = self.store.get_unauthorized(token.request_token, self.portal)
+        self.assertEqual(found.auth_token, token.auth_token)
+        self.assertIsNone(found.user_id)
+
+    def test_get_unauthorized_other_portal(self):
+        token = self.store.create(self.portal)
+        self.assertIsNone(
+            self.store.get_unauthorized(token.request_token, self.other_portal)
+        )
+
+    def test_get_unauthorized_unknown(self):
+        self.assertIsNone(self.store.get_unauthorized("unknown", self.portal))
+
+    def test_authorize_once(self):
+        token = self.store.create(self.portal)
+        self.assertTrue(self.store.authorize(token, self.user))
+        self.assertFalse(self.store.authorize(token, self.user))
+        self.assertIsNone(self.store.get_unauthorized(token.request_token, self.portal))
+
+    def test_pop_authorized(self):
+        token = self.store.create(self.portal)
+        self.store.authorize(token, self.user)
+        found = self.store.pop_authorized(token.auth_token, self.portal)
+        self.assertEqual(found.user, self.user)
+        self.assertEqual(found.request_token, token.request_token)
+        self.assertIsNone(self.store.pop_authorized(token.auth_token, self.portal))
+
+    def test_pop_unauthorized(self):
+        token = self.store.create(self.portal)
+        self.assertIsNone(self.store.pop_authorized(token.auth_token, self.portal))
+
+    def test_pop_authorized_other_portal(self):
+        token = self.store.create(self.portal)
+        self.store.authorize(token, self.user)
+        self.assertIsNone(
+            self.store.pop_authorized(token.auth_token, self.other_portal)
+        )
+        # The token isn't used up by the wrong portal.
+        self.assertIsNotNone(self.store.pop_authorized(token.auth_token, self.portal))
+
+    def test_delete(self):
+        token = self.store.create(self.portal)
+        self.store.delete(token)
+        self.assertIsNone(self.store.get_unauthorized(token.request_token, self.portal))
+
+    def test_created(self):
+        before = datetime.datetime.now(tz=pytz.UTC)
+        token = self.store.create(self.portal)
+        found = self.store.get_unauthorized(token.request_token, self.portal)
+        self.assertLess(abs((found.created - before).total_seconds()), 5)
+
+
+class TestDatabaseTokenStore(TokenStoreTests, TestCase):
+    def test_is_default(self):
+        self.assertIsInstance(self.store, DatabaseTokenStore)
+
+    def create_expired(self, number):
+        old = datetime.datetime(2000, 1, 1, tzinfo=pytz.UTC)
+        for _ in range(number):
+            self.store.create(self.portal)
+        models.Token.objects.update(created=old)
+
+    def test_cleanup(self):
+        self.create_expired(1)
+        token = self.store.create(self.portal)
+        stdout = StringIO()
+        call_command("cleanup_tokens", stdout=stdout)
+        self.assertEqual(list(models.Token.objects.all()), [token])
+        self.assertIn("Deleted 1 expired tokens", stdout.getvalue())
+
+    def test_cleanup_batches(self):
+        self.create_expired(5)
+        self.assertEqual(list(self.store.cleanup(batch_size=2)), [2, 2, 1])
+        self.assertFalse(models.Token.objects.exists())
+
+    def test_cleanup_batch_queries(self):
+        self.create_expired(4)
+        # One select and one delete per batch, plus the final empty select.
+        with self.assertNumQueries(5):
+            list(self.store.cleanup(batch_size=2))
+
+    @mock.patch("lizard_auth_server.token_store.time.sleep")
+    def test_cleanup_sleep(self, sleep):
+        self.create_expired(3)
+        list(self.store.cleanup(batch_size=1, sleep=0.5))
+        sleep.assert_called_with(0.5)
+        self.assertEqual(sleep.call_count, 3)
+
+    def test_cleanup_dry_run(self):
+        self.create_expired(3)
+        stdout = StringIO()
+        call_command("cleanup_tokens", dry_run=True, stdout=stdout)
+        self.assertEqual(stdout.getvalue(), "3 expired tokens\n")
+        self.assertEqual(models.Token.objects.count(), 3)
+
+
+@override_settings(
+    CACHES=TOKEN_CACHES,
+    LIZARD_AUTH_SERVER_TOKEN_STORE=CACHE_STORE,
+    LIZARD_AUTH_SERVER_TOKEN_STORE_CACHE="tokens",
+)
+class TestLocMemCacheTokenStore(TokenStoreTests, TestCase):
+    def setUp(self):
+        caches["tokens"].clear()
+        super(TestLocMemCacheTokenStore, self).setUp()
+
+    def test_no_database_writes(self):
+        with self.assertNumQueries(0):
+            token = self.store.create(self.portal)
+            self.store.authorize(token, self.user)
+        self.assertFalse(models.Token.objects.exists())
+
+    def test_timeout(self):
+        self.assertEqual(self.store.timeout, settings.SSO_TOKEN_TIMEOUT_MINUTES * 60)
+
+
+@override_settings(LIZARD_AUTH_SERVER_TOKEN_STORE=CACHE_STORE)
+class TestFileCacheTokenStore(TokenStoreTests, TestCase):
+    def setUp(self):
+        caches["default"].clear()
+        super(TestFileCacheTokenStore, self).setUp()
+
+    def test_is_cache_store(self):
+        self.assertIsInstance(self.store, CacheTokenStore)
+
+    def test_cleanup_dry_run(self):
+        stdout = StringIO()
+        call_command("cleanup_tokens", dry_run=True, stdout=stdout)
+        self.assertIn("expires tokens by itself", stdout.getvalue())
+
+
+@override_settings(
+    CACHES=TOKEN_CACHES,
+    LIZARD_AUTH_SERVER_TOKEN_STORE=CACHE_STORE,
+    LIZARD_AUTH_SERVER_TOKEN_STORE_CACHE="tokens",
+)
+class TestSSOFlowWithCacheTokenStore(TestCase):
+    def setUp(self):
+        caches["tokens"].clear()
+        self.key = "secret_key"
+        self.portal = factories.PortalF(
+            sso_key=self.key, redirect_url="http://portal.net"
+        )
+        user = factories.UserF(username="me")
+        user.set_password("pass")
+        user.save()
+        models.UserProfile.objects.fetch_for_user(user).portals.add(self.portal)
+        self.client = Client()
+        self.client.login(username="me", password="pass")
+
+    def sign(self, **params):
+        params["key"] = self.key
+        message = URLSafeTimedSerializer(self.portal.sso_secret).dumps(params)
+        return {"key": self.key, "message": message}
+
+    def unsign(self, data):
+        return URLSafeTimedSerializer(self.portal.sso_secret).loads(data)
+
+    def test_flow(self):
+        response = self.client.get("/sso/api/request_token/", self.sign())
+        request_token = self.unsign(response.content)["request_token"]
+
+        response = self.client.get(
+            "/sso/authorize/", self.sign(request_token=request_token)
+        )
+        self.assertEqual(response.status_code, 302)
+        message = response.url.split("message=")[1]
+        auth_token = self.unsign(message)["auth_token"]
+
+        response = self.client.get("/sso/api/verify/", self.sign(auth_token=auth_token))
+        self.assertEqual(response.status_code, 200)
+        user = json.loads(self.unsign(response.content)["user"])
+        self.assertEqual(user["username"], "me")
+        self.assertFalse(models.Token.objects.exists())
+
+        # The tokens can be used only once.
+        response = self.client.get(
+            "/sso/authorize/", self.sign(request_token=request_token)
+        )
+        self.assertEqual(response.status_code, 403)
+        response = self.client.get("/sso/api/verify/", self.sign(auth_token=auth_token))
+        self.assertEqual(response.status_code, 403)
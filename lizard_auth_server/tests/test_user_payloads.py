@@ -0,0 +1,135 @@
+from django.contrib.auth.models import Permission
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import transaction
+from django.test import TransactionTestCase
+from lizard_auth_server import models
+from lizard_auth_server import user_payloads
+from lizard_auth_server.tests import factories
+from lizard_auth_server.views_sso import construct_user_data
+
+import json
+
+
+class TestUserPayloads(TransactionTestCase):
+    # The versions are only bumped after a commit.
+
+    def setUp(self):
+        cache.clear()
+        self.user = factories.UserF(username="reinout")
+        self.organisation = factories.OrganisationF(name="Nelen & Schuurmans")
+        self.permission = Permission.objects.get(codename="change_portal")
+
+    def get(self):
+        # Fetch the user again, like a view would.
+        return json.loads(user_payloads.get_json(User.objects.get(id=self.user.id)))
+
+    def test_same_as_construct_user_data(self):
+        self.user.user_permissions.add(self.permission)
+        self.user.user_profile.organisations.add(self.organisation)
+        self.assertEqual(
+            user_payloads.get_json(self.user),
+            json.dumps(construct_user_data(user=self.user)),
+        )
+
+    def test_cached(self):
+        user_payloads.get_json(self.user)
+        with self.assertNumQueries(0):
+            user_payloads.get_json(self.user)
+
+    def test_user_change(self):
+        self.get()
+        self.user.first_name = "Reinout"
+        self.user.save()
+        self.assertEqual(self.get()["first_name"], "Reinout")
+
+    def test_login_keeps_cache(self):
+        user_payloads.get_json(self.user)
+        self.user.save(update_fields=["last_login"])
+        with self.assertNumQueries(0):
+            user_payloads.get_json(self.user)
+
+    def test_organisations(self):
+        self.get()
+        self.user.user_profile.organisations.add(self.organisation)
+        self.assertEqual(self.get()["organisation"], "Nelen & Schuurmans")
+        self.organisation.user_profiles.clear()
+        self.assertIsNone(self.get()["organisation"])
+        self.organisation.user_profiles.add(self.user.user_profile)
+        self.assertEqual(self.get()["organisation"], "Nelen & Schuurmans")
+
+    def test_organisation_renamed(self):
+        self.user.user_profile.organisations.add(self.organisation)
+        self.get()
+        self.organisation.name = "N&S"
+        self.organisation.save()
+        self.assertEqual(self.get()["organisation"], "N&S")
+
+    def test_organisation_deleted(self):
+        self.user.user_profile.organisations.add(self.organisation)
+        self.get()
+        self.organisation.delete()
+        self.assertIsNone(self.get()["organisation"])
+
+    def test_permissions(self):
+        self.get()
+        self.user.user_permissions.add(self.permission)
+        self.assertEqual(len(self.get()["permissions"]), 1)
+        self.permission.user_set.remove(self.user)
+        self.assertEqual(self.get()["permissions"], [])
+        self.permission.user_set.add(self.user)
+        self.assertEqual(len(self.get()["permissions"]), 1)
+        self.permission.user_set.clear()
+        self.assertEqual(self.get()["permissions"], [])
+
+    def test_permission_renamed(self):
+        self.user.user_permissions.add(self.permission)
+        self.get()
+        self.permission.codename = "edit_portal"
+        self.permission.save()
+        self.assertEqual(self.get()["permissions"][0]["codename"], "edit_portal")
+
+    def test_get_json_many(self):
+        users = [self.user] + [factories.UserF() for i in range(3)]
+        for user in users:
+            user.user_permissions.add(self.permission)
+        user_payloads.get_json(users[1])
+
+        def profiles():
+            return (
+                models.UserProfile.objects.filter(user__in=users)
+                .select_related("user")
+                .order_by("user_id")
+            )
+
+        # The users, their permissions and their organisations.
+        with self.assertNumQueries(3):
+            payloads = user_payloads.get_json_many(profiles())
+        self.assertEqual(
+            payloads,
+            [json.dumps(construct_user_data(user=user)) for user in users],
+        )
+        with self.assertNumQueries(1):
+            self.assertEqual(user_payloads.get_json_many(profiles()), payloads)
+
+    def test_uncommitted_changes(self):
+        self.get()
+        with transaction.atomic():
+            self.user.first_name = "Reinout"
+            self.user.save()
+            self.assertEqual(self.get()["first_name"], "Reinout")
+            profiles = models.UserProfile.objects.filter(user=self.user)
+            payload = user_payloads.get_json_many(profiles.select_related("user"))[0]
+            self.assertEqual(json.loads(payload)["first_name"], "Reinout")
+        self.assertEqual(self.get()["first_name"], "Reinout")
+
+    def test_rollback(self):
+        self.get()
+        with self.assertRaises(RuntimeError):
+            with transaction.atomic():
+                self.user.first_name = "Reinout"
+                self.user.save()
+                self.get()
+                raise RuntimeError("Roll back")
+        with self.assertNumQueries(1):
+            self.assertEqual(self.get()["first_name"], "")
@@ -83,7 +83,7 @@ class JWTViewTestCase(TestCase):
         self.assertTrue(JWTView.is_url(fake.url()))
 
     def test_invalid_portal(self):
-        random_sso_key = GenKey("Portal", "sso_key")
+        random_sso_key = GenKey("Portal", "sso_key")()
         self.assertFalse(JWTView.is_portal(sso_key=random_sso_key))
 
     def test_valid_portal(self):
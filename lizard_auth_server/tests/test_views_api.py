@@ -1,7 +1,19 @@
+from django.contrib.auth.models import Permission
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import Client
+from django.test import override_settings
 from django.test import TestCase
+from django.test.client import RequestFactory
+from django.urls import reverse
+from itsdangerous import URLSafeTimedSerializer
 from lizard_auth_server import models
 from lizard_auth_server import views_api
 from lizard_auth_server.tests import factories
+from lizard_auth_server.views_sso import construct_user_data
+from unittest import mock
+
+import json
 
 
 class TestGetOrganisationsView(TestCase):
@@ -22,3 +34,181 @@ class TestGetOrganisationsView(TestCase):
 
         self.assertEqual(len(organisations), 1)
         self.assertEqual(organisations[0]["unique_id"], organisation.unique_id)
+
+
+class TestUserOrganisationRolesBatchView(TestCase):
+    def setUp(self):
+        self.portal = factories.PortalF.create()
+        role = factories.RoleF.create(portal=self.portal)
+        self.organisation = factories.OrganisationF.create()
+        self.orgrole = models.OrganisationRole.objects.create(
+            organisation=self.organisation, role=role
+        )
+        self.profiles = [
+            factories.UserProfileF.create(user__username="user%s" % i) for i in range(3)
+        ]
+        self.profiles[0].roles.add(self.orgrole)
+        self.client = Client()
+
+    def post(self, message):
+        message["key"] = self.portal.sso_key
+        return self.client.post(
+            reverse("lizard_auth_server.api.user_organisation_roles_batch"),
+            {
+                "key": self.portal.sso_key,
+                "message": URLSafeTimedSerializer(self.portal.sso_secret).dumps(
+                    message
+                ),
+            },
+        )
+
+    def test_roles(self):
+        response = self.post({"usernames": ["user0", "user1", "unknown"]})
+        self.assertEqual(
+            response.json()["user_organisation_roles"],
+            {
+                "user0": [[self.organisation.unique_id, self.orgrole.role.unique_id]],
+                "user1": [],
+            },
+        )
+
+    def test_constant_number_of_queries(self):
+        more_profiles = [
+            factories.UserProfileF.create(user__username="more%s" % i)
+            for i in range(10)
+        ]
+        for profile in more_profiles:
+            profile.roles.add(self.orgrole)
+        usernames = [profile.user.username for profile in more_profiles]
+        with self.assertNumQueries(2):
+            result = models.UserProfile.objects.organisation_roles_for_usernames(
+                usernames, self.portal
+            )
+        self.assertEqual(len(result), 10)
+
+    def test_missing_usernames(self):
+        response = self.post({})
+        self.assertFalse(response.json()["success"])
+
+
+class TestGetUsersView(TestCase):
+    def setUp(self):
+        self.view = views_api.GetUsersView()
+        self.portal = factories.PortalF.create()
+        permission = Permission.objects.get(codename="change_portal")
+        for i in range(5):
+            profile = factories.UserProfileF.create(user__username="user%s" % i)
+            profile.portals.add(self.portal)
+            profile.organisations.add(factories.OrganisationF.create())
+            profile.user.user_permissions.add(permission)
+        factories.UserProfileF.create(user__username="staff", user__is_staff=True)
+        factories.UserProfileF.create(user__username="other")
+
+    def expected(self):
+        # What the view returned when it checked every user separately.
+        return [
+            construct_user_data(profile=user.user_profile)
+            for user in User.objects.order_by("id")
+            if user.user_profile.has_access(self.portal)
+        ]
+
+    def test_same_output(self):
+        users = json.loads(self.view.get_users(self.portal).content)["users"]
+        self.assertEqual(len(users), 6)
+        self.assertEqual(users, json.loads(json.dumps(self.expected())))
+
+    def test_number_of_queries(self):
+        # Users, permissions (with content types) and organisations.
+        with self.assertNumQueries(3):
+            self.view.get_users(self.portal)
+
+    def test_page(self):
+        response = self.view.get_users_page(self.portal, after_pk=0, limit=4)
+        data = json.loads(response.content)
+        self.assertEqual(len(data["users"]), 4)
+        response = self.view.get_users_page(
+            self.portal, after_pk=data["next_after_pk"], limit=4
+        )
+        data2 = json.loads(response.content)
+        self.assertEqual(len(data2["users"]), 2)
+        self.assertIsNone(data2["next_after_pk"])
+        self.assertEqual(
+            data["users"] + data2["users"], json.loads(json.dumps(self.expected()))
+        )
+
+    @override_settings(LIZARD_AUTH_SERVER_GET_USERS_CHUNK_SIZE=4)
+    def test_stream(self):
+        response = self.view.stream_users(self.portal)
+        with self.assertNumQueries(6):
+            content = b"".join(response.streaming_content)
+        data = json.loads(content.decode())
+        self.assertTrue(data["success"])
+        self.assertEqual(data["users"], json.loads(json.dumps(self.expected())))
+
+    def test_stream_only_staff(self):
+        response = self.view.stream_users(factories.PortalF.create(name="other"))
+        data = json.loads(b"".join(response.streaming_content).decode())
+        self.assertEqual([user["username"] for user in data["users"]], ["staff"])
+
+    def test_invalid_limit(self):
+        form = mock.Mock()
+        form.cleaned_data = {"limit": "many"}
+        data = json.loads(self.view.form_valid(form).content)
+        self.assertFalse(data["success"])
+
+
+class TestRolesViewETag(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.portal = factories.PortalF.create()
+        self.form = mock.Mock()
+        self.form.portal = self.portal
+
+    def post(self, **headers):
+        view = views_api.RolesView()
+        view.request = RequestFactory().post("/api/roles/", **headers)
+        return view.form_valid(self.form)
+
+    def test_not_modified(self):
+        etag = self.post()["ETag"]
+        with self.assertNumQueries(0):
+            response = self.post(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(304, response.status_code)
+
+    def test_new_role(self):
+        etag = self.post()["ETag"]
+        factories.RoleF.create(portal=self.portal)
+        response = self.post(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(len(json.loads(response.content)["roles"]), 1)
+
+
+class TestGetOrganisationsSnapshot(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.form = mock.Mock()
+        self.form.portal = factories.PortalF.create()
+        factories.OrganisationF.create(name="Nelen & Schuurmans")
+
+    def post(self):
+        view = views_api.GetOrganisationsView()
+        view.request = RequestFactory().post("/api/get_organisations/")
+        return view.form_valid(self.form)
+
+    def test_snapshot(self):
+        content = self.post().content
+        with self.assertNumQueries(0):
+            self.assertEqual(self.post().content, content)
+        data = json.loads(content)
+        self.assertTrue(data["success"])
+        self.assertEqual(data["organisations"][0]["name"], "Nelen & Schuurmans")
+
+    def test_new_organisation(self):
+        self.post()
+        factories.OrganisationF.create(name="Signalmanufaktur Neuwitz")
+        self.assertEqual(len(json.loads(self.post().content)["organisations"]), 2)
+
+    def test_deleted_organisation(self):
+        self.post()
+        models.Organisation.objects.get().delete()
+        self.assertEqual(json.loads(self.post().content)["organisations"], [])
@@ -1,9 +1,13 @@
 from django.contrib.auth.models import User
+from django.core.cache import cache
 from django.core.exceptions import PermissionDenied
 from django.test import Client
+from django.test import override_settings
 from django.test import TestCase
 from django.test.client import RequestFactory
 from django.urls import reverse
+from django.utils import timezone
+from lizard_auth_server import models
 from lizard_auth_server import views_api_v2
 from lizard_auth_server.tests import factories
 
@@ -28,7 +32,7 @@ class TestStartView(TestCase):
 class TestCheckCredentialsView(TestCase):
     def setUp(self):
         self.sso_key = "sso key"
-        factories.PortalF.create(sso_key=self.sso_key)
+        self.portal = factories.PortalF.create(sso_key=self.sso_key)
         self.view = views_api_v2.CheckCredentialsView()
         self.request_factory = RequestFactory()
         self.some_request = self.request_factory.get("/some/url/")
@@ -49,6 +53,7 @@ class TestCheckCredentialsView(TestCase):
 
     def test_valid_login(self):
         form = mock.Mock()
+        form.portal = self.portal
         form.cleaned_data = {
             "iss": self.sso_key,
             "username": self.username,
@@ -60,6 +65,7 @@ class TestCheckCredentialsView(TestCase):
 
     def test_invalid_login(self):
         form = mock.Mock()
+        form.portal = self.portal
         form.cleaned_data = {
             "iss": self.sso_key,
             "username": "pietje",
@@ -71,6 +77,7 @@ class TestCheckCredentialsView(TestCase):
         self.user.is_active = False
         self.user.save()
         form = mock.Mock()
+        form.portal = self.portal
         form.cleaned_data = {
             "iss": self.sso_key,
             "username": self.username,
@@ -80,6 +87,7 @@ class TestCheckCredentialsView(TestCase):
 
     def test_missing_username(self):
         form = mock.Mock()
+        form.portal = self.portal
         form.cleaned_data = {"iss": self.sso_key, "password": "ikkanniettypen"}
         response = self.view.form_valid(form)
         self.assertEqual(400, response.status_code)
@@ -259,6 +267,7 @@ class TestNewUserView(TestCase):
 
     def test_new_user(self):
         form = mock.Mock()
+        form.portal = self.portal
         form.cleaned_data = self.user_data
         self.view.request = self.some_request
         result = self.view.form_valid(form)
@@ -267,6 +276,7 @@ class TestNewUserView(TestCase):
 
     def test_new_user_starts_inactive(self):
         form = mock.Mock()
+        form.portal = self.portal
         form.cleaned_data = self.user_data
         self.view.request = self.some_request
         self.view.form_valid(form)
@@ -274,6 +284,7 @@ class TestNewUserView(TestCase):
 
     def test_new_user_sends_email(self):
         form = mock.Mock()
+        form.portal = self.portal
         form.cleaned_data = self.user_data
         self.view.request = self.some_request
         with mock.patch("lizard_auth_server.views_api_v2.send_mail") as mocked:
@@ -285,6 +296,7 @@ class TestNewUserView(TestCase):
     def test_exiting_user(self):
         factories.UserF(email="pietje@klaasje.test.com")
         form = mock.Mock()
+        form.portal = self.portal
         form.cleaned_data = self.user_data
         result = self.view.form_valid(form)
         # Should return a 409 conflict statuscode.
@@ -293,6 +305,7 @@ class TestNewUserView(TestCase):
     def test_exiting_user_different_case(self):
         factories.UserF(email="Pietje@Klaasje.Test.Com")
         form = mock.Mock()
+        form.portal = self.portal
         form.cleaned_data = self.user_data
         result = self.view.form_valid(form)
         # Should return a 409 conflict statucode
@@ -302,6 +315,7 @@ class TestNewUserView(TestCase):
         factories.UserF(email="pietje@klaasje.test.com")
         factories.UserF(email="pietje@klaasje.test.com")
         form = mock.Mock()
+        form.portal = self.portal
         form.cleaned_data = self.user_data
         result = self.view.form_valid(form)
         # Should return a 409 conflict statuscode
@@ -310,6 +324,7 @@ class TestNewUserView(TestCase):
     def test_duplicate_username(self):
         factories.UserF(username="pietje", email="nietpietje@example.com")
         form = mock.Mock()
+        form.portal = self.portal
         form.cleaned_data = self.user_data
         response = self.view.form_valid(form)
         self.assertEqual(409, response.status_code)
@@ -347,6 +362,7 @@ class TestNewUserView(TestCase):
             "visit_url": "http://reinout.vanrees.org/",
         }
         form = mock.Mock()
+        form.portal = self.portal
         form.cleaned_data = user_data
         self.view.request = self.some_request
 
@@ -367,6 +383,7 @@ class TestNewUserView(TestCase):
             "visit_url": "http://reinout.vanrees.org/",
         }
         form = mock.Mock()
+        form.portal = self.portal
         form.cleaned_data = user_data
         self.view.request = self.some_request
         with mock.patch("lizard_auth_server.views_api_v2.send_mail") as mocked:
@@ -377,6 +394,7 @@ class TestNewUserView(TestCase):
 
     def test_missing_mandatory_field(self):
         form = mock.Mock()
+        form.portal = self.portal
         form.cleaned_data = copy.deepcopy(self.user_data)
         del form.cleaned_data["first_name"]
         response = self.view.form_valid(form)
@@ -384,6 +402,7 @@ class TestNewUserView(TestCase):
 
     def test_failure_on_unavailable_language(self):
         form = mock.Mock()
+        form.portal = self.portal
         form.cleaned_data = copy.deepcopy(self.user_data)
         form.cleaned_data["language"] = "tlh"
         response = self.view.form_valid(form)
@@ -598,7 +617,7 @@ class TestFindUserView(TestCase):
     def setUp(self):
         self.view = views_api_v2.FindUserView()
         self.sso_key = "sso key"
-        factories.PortalF.create(sso_key=self.sso_key)
+        self.portal = factories.PortalF.create(sso_key=self.sso_key)
         self.request_factory = RequestFactory()
         self.some_request = self.request_factory.get("http://some.site/some/url/")
         self.user_data = {"iss": self.sso_key, "email": "pietje@klaasje.test.com"}
@@ -606,6 +625,7 @@ class TestFindUserView(TestCase):
     def test_exiting_user(self):
         factories.UserF(email="pietje@klaasje.test.com")
         form = mock.Mock()
+        form.portal = self.portal
         form.cleaned_data = self.user_data
         result = self.view.form_valid(form)
         self.assertEqual(200, result.status_code)
@@ -613,12 +633,14 @@ class TestFindUserView(TestCase):
     def test_exiting_user_different_case(self):
         factories.UserF(email="Pietje@Klaasje.Test.Com")
         form = mock.Mock()
+        form.portal = self.portal
         form.cleaned_data = self.user_data
         result = self.view.form_valid(form)
         self.assertEqual(200, result.status_code)
 
     def test_nonexiting_user(self):
         form = mock.Mock()
+        form.portal = self.portal
         form.cleaned_data = self.user_data
         result = self.view.form_valid(form)
         self.assertEqual(404, result.status_code)
@@ -659,6 +681,7 @@ class TestUserMigrationView(TestCase):
 
     def form_valid(self, **kwargs):
         form = mock.Mock()
+        form.portal = self.portal
         form.cleaned_data = {
             "iss": self.sso_key,
             "username": self.username,
@@ -758,6 +781,7 @@ class TestUserExistsView(TestCase):
 
     def form_valid(self, **kwargs):
         form = mock.Mock()
+        form.portal = self.portal
         form.cleaned_data = {"iss": self.sso_key, **kwargs}
         return self.view.form_valid(form)
 
@@ -792,3 +816,210 @@ class TestUserExistsView(TestCase):
         self.user.save()
         result = self.form_valid(username=self.username)
         self.assertFalse(json.loads(result.content)["exists"])
+
+
+@override_settings(LIZARD_AUTH_SERVER_CHANGES_SETTLE_SECONDS=0)
+class TestChangesView(TestCase):
+    def setUp(self):
+        self.sso_key = "ssokey"
+        self.secret_key = "a secret"
+        self.portal = factories.PortalF.create(
+            sso_key=self.sso_key,
+            sso_secret=self.secret_key,
+        )
+
+    def get_changes(self, **payload):
+        payload["iss"] = self.sso_key
+        message = jwt.encode(payload, self.secret_key, algorithm="HS256")
+        response = self.client.get(
+            "/api2/changes/", {"key": self.sso_key, "message": message}
+        )
+        self.assertEqual(200, response.status_code)
+        return response.json()
+
+    def test_no_cursor_returns_current_cursor(self):
+        factories.OrganisationF(name="Signalmanufaktur Neuwitz")
+        result = self.get_changes()
+        self.assertEqual(result["changes"], [])
+        self.assertEqual(self.get_changes(cursor=result["cursor"])["changes"], [])
+
+    def test_changes_since_cursor(self):
+        cursor = self.get_changes()["cursor"]
+        organisation = factories.OrganisationF(name="Signalmanufaktur Neuwitz")
+        user = factories.UserF(username="pietje")
+        user.user_profile.portals.add(self.portal)
+        result = self.get_changes(cursor=cursor)
+        self.assertEqual(
+            [(change["type"], change["id"]) for change in result["changes"]],
+            [("organisation", organisation.unique_id), ("user", "pietje")],
+        )
+        self.assertEqual(result["changes"][1]["data"]["username"], "pietje")
+
+        user.delete()
+        result = self.get_changes(cursor=result["cursor"])
+        self.assertEqual(
+            result["changes"], [{"type": "user", "id": "pietje", "deleted": True}]
+        )
+
+    def test_renamed_user(self):
+        user = factories.UserF(username="pietje")
+        user.user_profile.portals.add(self.portal)
+        cursor = self.get_changes()["cursor"]
+        user.username = "jantje"
+        user.save()
+        changes = self.get_changes(cursor=cursor)["changes"]
+        self.assertEqual(
+            [(change["id"], change["deleted"]) for change in changes],
+            [("pietje", True), ("jantje", False)],
+        )
+
+    def test_user_without_access(self):
+        cursor = self.get_changes()["cursor"]
+        factories.UserF(username="pietje")
+        factories.UserF(username="jantje", is_staff=True)
+        changes = self.get_changes(cursor=cursor)["changes"]
+        self.assertEqual(
+            [(change["id"], change["deleted"]) for change in changes],
+            [("pietje", True), ("jantje", False)],
+        )
+
+    def test_login_is_not_a_change(self):
+        user = factories.UserF(username="pietje")
+        cursor = self.get_changes()["cursor"]
+        user.save(update_fields=["last_login"])
+        self.assertEqual(self.get_changes(cursor=cursor)["changes"], [])
+
+    def test_profile_relations(self):
+        profile = factories.UserProfileF(user__username="pietje")
+        organisation = factories.OrganisationF()
+        cursor = self.get_changes()["cursor"]
+        organisation.user_profiles.add(profile)
+        changes = self.get_changes(cursor=cursor)["changes"]
+        self.assertEqual([change["id"] for change in changes], ["pietje"])
+
+    def test_deleted_organisation(self):
+        profile = factories.UserProfileF(user__username="pietje")
+        organisation = factories.OrganisationF()
+        organisation.user_profiles.add(profile)
+        cursor = self.get_changes()["cursor"]
+        organisation.delete()
+        changes = self.get_changes(cursor=cursor)["changes"]
+        self.assertEqual(
+            [(change["type"], change["id"]) for change in changes],
+            [("user", "pietje"), ("organisation", organisation.unique_id)],
+        )
+
+    def test_deleted_organisation_role(self):
+        profile = factories.UserProfileF(user__username="pietje")
+        organisation_role = models.OrganisationRole.objects.create(
+            organisation=factories.OrganisationF(),
+            role=factories.RoleF(portal=self.portal),
+        )
+        profile.roles.add(organisation_role)
+        organisation_role_id = str(organisation_role.pk)
+        cursor = self.get_changes()["cursor"]
+        organisation_role.delete()
+        changes = self.get_changes(cursor=cursor)["changes"]
+        self.assertEqual(
+            [(change["type"], change["id"]) for change in changes],
+            [("user", "pietje"), ("organisation_role", organisation_role_id)],
+        )
+
+    def test_roles_of_other_portals_are_skipped(self):
+        cursor = self.get_changes()["cursor"]
+        organisation = factories.OrganisationF()
+        other_role = factories.RoleF(portal=factories.PortalF(), code="other")
+        role = factories.RoleF(portal=self.portal, name="mine", code="mine")
+        organisation_role = models.OrganisationRole.objects.create(
+            organisation=organisation, role=role
+        )
+        models.OrganisationRole.objects.create(
+            organisation=organisation, role=other_role
+        )
+        changes = self.get_changes(cursor=cursor)["changes"]
+        self.assertEqual(
+            [(change["type"], change["id"]) for change in changes],
+            [
+                ("organisation", organisation.unique_id),
+                ("role", role.unique_id),
+                ("organisation_role", str(organisation_role.pk)),
+            ],
+        )
+        self.assertEqual(changes[2]["data"], organisation_role.as_dict())
+
+    def test_limit(self):
+        cursor = self.get_changes()["cursor"]
+        for name in ["a", "b", "c"]:
+            factories.OrganisationF(name=name)
+        result = self.get_changes(cursor=cursor, limit=2)
+        self.assertTrue(result["more"])
+        self.assertEqual(len(result["changes"]), 2)
+        result = self.get_changes(cursor=result["cursor"], limit=2)
+        self.assertFalse(result["more"])
+        self.assertEqual(len(result["changes"]), 1)
+
+    @override_settings(LIZARD_AUTH_SERVER_CHANGES_SETTLE_SECONDS=10)
+    def test_recent_changes_wait(self):
+        # Their transaction might still be running, with an earlier entry
+        # invisible until it commits.
+        cursor = self.get_changes()["cursor"]
+        organisation = factories.OrganisationF(name="Signalmanufaktur Neuwitz")
+        self.assertEqual(self.get_changes()["cursor"], cursor)
+        result = self.get_changes(cursor=cursor)
+        self.assertEqual((result["cursor"], result["changes"]), (cursor, []))
+        models.ChangeLogEntry.objects.update(
+            created=timezone.now() - datetime.timedelta(seconds=11)
+        )
+        changes = self.get_changes(cursor=cursor)["changes"]
+        self.assertEqual([change["id"] for change in changes], [organisation.unique_id])
+
+    def test_pruned_cursor(self):
+        cursor = self.get_changes()["cursor"]
+        factories.OrganisationF()
+        factories.OrganisationF()
+        models.ChangeLogEntry.objects.order_by("id").first().delete()
+        payload = {"iss": self.sso_key, "cursor": cursor}
+        message = jwt.encode(payload, self.secret_key, algorithm="HS256")
+        response = self.client.get(
+            "/api2/changes/", {"key": self.sso_key, "message": message}
+        )
+        self.assertEqual(response.status_code, 410)
+        # A cursor from after the full sync works again.
+        cursor = self.get_changes()["cursor"]
+        self.assertEqual(self.get_changes(cursor=cursor)["changes"], [])
+
+
+class TestOrganisationsViewETag(TestOrganisationsView):
+    def setUp(self):
+        super(TestOrganisationsViewETag, self).setUp()
+        cache.clear()
+
+    def test_etag(self):
+        response = self.client.get("/api2/organisations/", self.jwt_params)
+        self.assertIn("ETag", response)
+        self.assertNotIn("Last-Modified", response)
+
+    def test_not_modified(self):
+        etag = self.client.get("/api2/organisations/", self.jwt_params)["ETag"]
+        with self.assertNumQueries(0):
+            response = self.client.get(
+                "/api2/organisations/", self.jwt_params, HTTP_IF_NONE_MATCH=etag
+            )
+        self.assertEqual(304, response.status_code)
+
+    def test_changed(self):
+        etag = self.client.get("/api2/organisations/", self.jwt_params)["ETag"]
+        factories.OrganisationF(name="Signalmanufaktur Neuwitz")
+        response = self.client.get(
+            "/api2/organisations/", self.jwt_params, HTTP_IF_NONE_MATCH=etag
+        )
+        self.assertEqual(200, response.status_code)
+        self.assertNotEqual(etag, response["ETag"])
+
+    def test_snapshot(self):
+        factories.OrganisationF(name="Signalmanufaktur Neuwitz")
+        content = self.client.get("/api2/organisations/", self.jwt_params).content
+        with self.assertNumQueries(0):
+            response = self.client.get("/api2/organisations/", self.jwt_params)
+        self.assertEqual(content, response.content)
+        self.assertIn("Signalmanufaktur Neuwitz", json.loads(content).values())
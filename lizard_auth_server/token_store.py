@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+"""Storage of the one-time tokens of the v1 SSO flow.
+
+A token is created by ``RequestTokenView``, linked to the user by
+``AuthorizeView`` and used up by ``VerifyView``, all within
+``SSO_TOKEN_TIMEOUT_MINUTES``. Where the tokens are kept is configured with
+``LIZARD_AUTH_SERVER_TOKEN_STORE``:
+
+- ``DatabaseTokenStore`` (the default) uses the ``Token`` table. Expired
+  tokens are removed by the ``cleanup_tokens`` management command.
+
+- ``CacheTokenStore`` uses the Django cache configured with
+  ``LIZARD_AUTH_SERVER_TOKEN_STORE_CACHE``. The tokens expire by themselves
+  and a login doesn't write to the database at all. The cache must be shared
+  by all server processes and ``cache.add()`` must be atomic, so use
+  memcached or redis. Not the file cache: its ``add()`` isn't atomic, so two
+  processes could both authorize the same request token.
+
+Both stores hand out ``Token`` instances; the cache store's are never saved.
+
+"""
+from django.core.cache import caches
+from django.utils.module_loading import import_string
+from lizard_auth_server.conf import settings
+from lizard_auth_server.models import KEY_ATTEMPTS
+from lizard_auth_server.models import Token
+from lizard_auth_server.models import token_creation_date
+from lizard_auth_server.utils import gen_secret_key
+
+import datetime
+import logging
+import pytz
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+def get_token_store():
+    return import_string(settings.LIZARD_AUTH_SERVER_TOKEN_STORE)()
+
+
+def token_timeout():
+    return datetime.timedelta(minutes=settings.SSO_TOKEN_TIMEOUT_MINUTES)
+
+
+class DatabaseTokenStore(object):
+    """Keep the tokens in the ``Token`` table."""
+
+    def create(self, portal):
+        """Return a new token for the portal."""
+        return Token.objects.create_for_portal(portal)
+
+    def get_unauthorized(self, request_token, portal):
+        """Return the token that isn't linked to a user yet, or None."""
+        try:
+            return Token.objects.get(
+                request_token=request_token, portal=portal, user__isnull=True
+            )
+        except Token.DoesNotExist:
+            return None
+
+    def authorize(self, token, user):
+        """Link the user to the token.
+
+        Return False if the token has been authorized (or removed) in the
+        meantime.
+
+        """
+        updated = Token.objects.filter(pk=token.pk, user__isnull=True).update(user=user)
+        token.user = user
+        return bool(updated)
+
+    def pop_authorized(self, auth_token, portal):
+        """Return and remove the token that is linked to a user, or None.
+
+        Only one caller gets the token.
+
+        """
+        try:
+            token = Token.objects.select_related("user").get(
+                auth_token=auth_token, portal=portal, user__isnull=False
+            )
+        except Token.DoesNotExist:
+            return None
+        deleted, _ = Token.objects.filter(pk=token.pk).delete()
+        if not deleted:
+            return None
+        return token
+
+    def delete(self, token):
+        token.delete()
+
+    def expired_tokens(self):
+        max_age = datetime.datetime.now(tz=pytz.UTC) - token_timeout()
+        return Token.objects.filter(created__lt=max_age)
+
+    def count_expired(self):
+        return self.expired_tokens().count()
+
+    def cleanup(self, batch_size=1000, sleep=0):
+        """Remove the expired tokens in batches.
+
+        Every batch is a separate, short DELETE by primary key, so the
+        ``Token`` table isn't locked for long. Nothing refers to a token, so
+        we can skip Django's delete collector (which loads all rows).
+
+        Yields the number of removed tokens per batch.
+
+        """
+        while True:
+            pks = list(
+                self.expired_tokens()
+                .order_by("created")
+                .values_list("pk", flat=True)[:batch_size]
+            )
+            if not pks:
+                return
+            yield Token.objects.filter(pk__in=pks)._raw_delete(Token.objects.db)
+            if len(pks) < batch_size:
+                return
+            if sleep:
+                time.sleep(sleep)
+
+
+class CacheTokenStore(object):
+    """Keep the tokens in the Django cache, they expire by themselves.
+
+    There are two entries per token: one under the request token until the
+    user is linked to it, and then one under the auth token. A token can be
+    authorized and verified once: the caller that manages to ``add()`` a
+    marker for it wins. That makes a "get and delete" atomic, also on cache
+    backends that don't have such an operation.
+
+    """
+
+    key_prefix = "lizard_auth_server.sso_token"
+
+    @property
+    def cache(self):
+        return caches[settings.LIZARD_AUTH_SERVER_TOKEN_STORE_CACHE]
+
+    @property
+    def timeout(self):
+        return int(token_timeout().total_seconds())
+
+    def _key(self, kind, token):
+        return "%s.%s.%s" % (self.key_prefix, kind, token)
+
+    def _dump(self, token):
+        return {
+            "portal_id": token.portal_id,
+            "request_token": token.request_token,
+            "auth_token": token.auth_token,
+            "user_id": token.user_id,
+            "created": token.created.timestamp(),
+        }
+
+    def _load(self, data, portal):
+        if data is None or data["portal_id"] != portal.pk:
+            return None
+        return Token(
+            portal=portal,
+            request_token=data["request_token"],
+            auth_token=data["auth_token"],
+            user_id=data["user_id"],
+            created=datetime.datetime.fromtimestamp(data["created"], tz=pytz.UTC),
+        )
+
+    def _claim(self, kind, token):
+        return self.cache.add(self._key(kind, token), True, self.timeout)
+
+    def create(self, portal):
+        token = Token(portal=portal, created=token_creation_date())
+        for attempt in range(1, KEY_ATTEMPTS + 1):
+            keys = gen_secret_key(128)
+            token.request_token = keys[:64]
+            token.auth_token = keys[64:]
+            key = self._key("request", token.request_token)
+            if self.cache.add(key, self._dump(token), self.timeout):
+                return token
+            logger.warning("Generated token collides with an existing one, retrying")
+        raise RuntimeError("Could not store a new SSO token in the cache")
+
+    def get_unauthorized(self, request_token, portal):
+        data = self.cache.get(self._key("request", request_token))
+        return self._load(data, portal)
+
+    def authorize(self, token, user):
+        if not self._claim("authorized", token.request_token):
+            return False
+        token.user = user
+        if not self.cache.add(
+            self._key("auth", token.auth_token), self._dump(token), self.timeout
+        ):
+            return False
+        self.cache.delete(self._key("request", token.request_token))
+        return True
+
+    def pop_authorized(self, auth_token, portal):
+        key = self._key("auth", auth_token)
+        token = self._load(self.cache.get(key), portal)
+        if token is None or not self._claim("verified", auth_token):
+            return None
+        self.cache.delete(key)
+        return token
+
+    def delete(self, token):
+        self.cache.delete_many(
+            [
+                self._key("request", token.request_token),
+                self._key("auth", token.auth_token),
+            ]
+        )
+
+    def count_expired(self):
+        """Unknown, the cache expires the tokens by itself."""
+        return None
+
+    def cleanup(self, batch_size=1000, sleep=0):
+        """Nothing to do, the cache expires the tokens."""
+        return iter(())
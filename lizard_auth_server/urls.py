@@ -7,6 +7,7 @@ from django.contrib.auth import views as auth_views
 from django.contrib.auth.decorators import login_required
 from django.core.exceptions import ImproperlyConfigured
 from lizard_auth_server import forms
+from lizard_auth_server import metrics
 from lizard_auth_server import views
 from lizard_auth_server import views_api
 from lizard_auth_server import views_api_v2
@@ -84,6 +85,11 @@ urlpatterns = [
         views_api.UserOrganisationRolesView.as_view(),
         name="lizard_auth_server.api.user_organisation_roles",
     ),
+    url(
+        r"^api/user_organisation_roles_batch/$",
+        views_api.UserOrganisationRolesBatchView.as_view(),
+        name="lizard_auth_server.api.user_organisation_roles_batch",
+    ),
     # Version 1 views
     #
     # SSO URLs for use by visitors Note: these are referred to by
@@ -143,6 +149,11 @@ urlpatterns = [
         views_api_v2.FindUserView.as_view(),
         name="lizard_auth_server.api_v2.find_user",
     ),
+    url(
+        r"^api2/changes/$",
+        views_api_v2.ChangesView.as_view(),
+        name="lizard_auth_server.api_v2.changes",
+    ),
     # Views for visitors
     url(
         r"^api2/login/$",
@@ -206,7 +217,7 @@ urlpatterns = [
     # Override django-auth's password change URLs
     url(
         r"^password_change/$",
-        auth_views.password_change,
+        views.cognito_unavailable_message(auth_views.password_change),
         kwargs={
             "template_name": "lizard_auth_server/password_change_form.html",
             "password_change_form": forms.PasswordChangeForm,
@@ -240,7 +251,7 @@ urlpatterns = [
     url(
         r"^reset/(?P<uidb64>[0-9A-Za-z]{1,13})-"
         r"(?P<token>[0-9A-Za-z]{1,13}-[0-9A-Za-z]{1,20})/$",
-        auth_views.password_reset_confirm,
+        views.cognito_unavailable_message(auth_views.password_reset_confirm),
         kwargs={
             "template_name": "lizard_auth_server/password_reset_confirm.html",
             "set_password_form": forms.SetPasswordForm,
@@ -291,6 +302,14 @@ urlpatterns = [
     ),
     # URLs for third-party apps.
     url(r"^jwt/$", views.JWTView.as_view(), name="lizard_auth_server.jwt"),
+    # Prometheus metrics.
+    url(r"^metrics$", metrics.metrics_view, name="lizard_auth_server.metrics"),
+    # Request performance statistics, for staff.
+    url(
+        r"^performance/$",
+        views.PerformanceView.as_view(),
+        name="lizard_auth_server.performance",
+    ),
     # URLs for debugging portal access.
     url(
         r"^access-to-portal/(?P<portal_pk>\d+)/$",
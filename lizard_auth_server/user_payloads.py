@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""Cache of the v1 user data, serialized to JSON.
+
+The v1 API sends ``views_sso.construct_user_data()`` for the same users over
+and over, which costs a few queries per user (permissions with their content
+types, the first organisation). We keep the JSON in the (shared) Django cache
+per user, so that the views can paste it into their response.
+
+Every user has a version number, kept like the catalog versions (see
+``catalog.py``): the signal handlers bump it after every committed change to
+the user, its profile, its organisations or its permissions. The JSON is
+stored under a key with the version in it, so JSON built from data read
+before a change can never be returned after the change. Until the commit,
+the transaction that made the change builds the user's JSON every time and
+doesn't store it, so a rollback can't leave its data in the cache.
+
+Bump ``FORMAT`` when ``construct_user_data()`` changes.
+
+"""
+from django.contrib.auth.models import Permission
+from django.core.cache import cache
+from django.db.models import Prefetch
+from django.db.models import prefetch_related_objects
+from lizard_auth_server import catalog
+from lizard_auth_server import views_sso
+from lizard_auth_server.conf import settings
+
+import json
+
+
+FORMAT = 1
+
+
+def _catalog(user_id):
+    return "user_payload.%s" % user_id
+
+
+def _payload_key(user_id, version):
+    return "lizard_auth_server.user_payload.%s.%s.%s" % (FORMAT, user_id, version)
+
+
+def _serialize(user):
+    return json.dumps(views_sso.construct_user_data(user=user))
+
+
+def get_json(user):
+    """Return ``construct_user_data(user)`` as JSON."""
+    if _catalog(user.id) in catalog.uncommitted():
+        return _serialize(user)
+    key = _payload_key(user.id, catalog.get_version(_catalog(user.id)))
+    payload = cache.get(key)
+    if payload is None:
+        payload = _serialize(user)
+        cache.set(key, payload, settings.LIZARD_AUTH_SERVER_USER_PAYLOAD_TIMEOUT)
+    return payload
+
+
+def get_json_many(profiles):
+    """Return the JSON of the users of the profiles, in the same order.
+
+    The profiles should come with their user (``select_related("user")``).
+    The permissions and organisations of the profiles that aren't in the
+    cache are prefetched in two queries.
+
+    """
+    profiles = list(profiles)
+    versions = catalog.get_versions([_catalog(profile.user_id) for profile in profiles])
+    keys = {
+        profile.user_id: _payload_key(
+            profile.user_id, versions[_catalog(profile.user_id)]
+        )
+        for profile in profiles
+    }
+    found = cache.get_many(keys.values())
+    # Users changed by the current transaction aren't looked up or stored.
+    uncommitted = catalog.uncommitted()
+    missing = [
+        profile
+        for profile in profiles
+        if keys[profile.user_id] not in found
+        or _catalog(profile.user_id) in uncommitted
+    ]
+    if missing:
+        prefetch_related_objects(
+            missing,
+            Prefetch(
+                "user__user_permissions",
+                queryset=Permission.objects.select_related("content_type"),
+            ),
+            "organisations",
+        )
+        new = {}
+        for profile in missing:
+            key = keys[profile.user_id]
+            found[key] = _serialize(profile.user)
+            if _catalog(profile.user_id) not in uncommitted:
+                new[key] = found[key]
+        cache.set_many(new, settings.LIZARD_AUTH_SERVER_USER_PAYLOAD_TIMEOUT)
+    return [found[keys[profile.user_id]] for profile in profiles]
+
+
+def invalidate(user_ids):
+    """Mark the cached JSON of these users as outdated."""
+    catalog.bump_on_commit([_catalog(user_id) for user_id in user_ids])
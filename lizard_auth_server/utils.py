@@ -1,16 +1,29 @@
 # -*- coding: utf-8 -*-
 from django.conf import settings
-from random import SystemRandom
 
+import os
 import string
 
 
-random = SystemRandom()
 KEY_CHARACTERS = string.ascii_letters + string.digits
+# Map every random byte onto a key character in one bytes.translate() call.
+# 248 is the largest multiple of 62 below 256: the bytes above it are dropped,
+# otherwise the first eight characters would be slightly more likely.
+_USABLE_BYTES = 256 - 256 % len(KEY_CHARACTERS)
+_KEY_TABLE = bytes(
+    KEY_CHARACTERS[i % len(KEY_CHARACTERS)].encode("ascii")[0] for i in range(256)
+)
+_UNUSABLE_BYTES = bytes(range(_USABLE_BYTES, 256))
 
 
 def default_gen_secret_key(length=40):
-    return "".join([random.choice(KEY_CHARACTERS) for _ in range(length)])
+    key = b""
+    while len(key) < length:
+        # Draw a few bytes extra so that we (nearly) always need one round.
+        needed = length - len(key)
+        random_bytes = os.urandom(needed + needed // 16 + 8)
+        key += random_bytes.translate(_KEY_TABLE, _UNUSABLE_BYTES)
+    return key[:length].decode("ascii")
 
 
 def gen_secret_key(length=40):
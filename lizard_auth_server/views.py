@@ -9,6 +9,7 @@ from django.core.validators import URLValidator
 from django.http import HttpResponse
 from django.http import HttpResponseBadRequest
 from django.http import HttpResponseRedirect
+from django.http import JsonResponse
 from django.shortcuts import redirect
 from django.template.response import TemplateResponse
 from django.urls import reverse
@@ -21,13 +22,17 @@ from django.views.generic.base import TemplateView
 from django.views.generic.edit import DeleteView
 from django.views.generic.edit import FormView
 from lizard_auth_server import forms
+from lizard_auth_server import jwt_codec
+from lizard_auth_server import performance
+from lizard_auth_server.backends import CognitoUnavailable
 from lizard_auth_server.conf import settings
 from lizard_auth_server.models import Invitation
 from lizard_auth_server.models import Portal
+from lizard_auth_server.registry import portal_registry
 from oidc_provider.models import UserConsent
 from six.moves.urllib import parse
 
-import jwt
+import functools
 import logging
 
 
@@ -50,6 +55,17 @@ class StaffOnlyMixin(object):
         return super(StaffOnlyMixin, self).dispatch(request, *args, **kwargs)
 
 
+class PerformanceView(StaffOnlyMixin, View):
+    """
+    Show the request performance histograms of this server process.
+
+    See :mod:`lizard_auth_server.performance`.
+    """
+
+    def get(self, request, *args, **kwargs):
+        return JsonResponse(performance.stats.snapshot())
+
+
 class ErrorMessageResponse(TemplateResponse):
     """
     Display a slightly more user-friendly error message.
@@ -64,6 +80,31 @@ class ErrorMessageResponse(TemplateResponse):
         )
 
 
+def cognito_unavailable_message(view):
+    """Show an error message instead of a 500 when Cognito is unavailable.
+
+    For the password views: saving the password in Cognito can still fail
+    after the form was validated.
+
+    """
+
+    @functools.wraps(view)
+    def wrapper(request, *args, **kwargs):
+        try:
+            return view(request, *args, **kwargs)
+        except CognitoUnavailable:
+            logger.warning(
+                "Cognito unavailable, password of %s not saved", request.user
+            )
+            return ErrorMessageResponse(
+                request,
+                _("We can't save your password right now, please try again later."),
+                status=503,
+            )
+
+    return wrapper
+
+
 ##################################################
 # Invitation / registration / activation / profile
 ##################################################
@@ -343,7 +384,11 @@ class JWTView(View):
             bool: True if the portal exists, False otherwise.
 
         """
-        return Portal.objects.filter(sso_key=sso_key).exists()
+        try:
+            portal_registry.get(sso_key)
+        except Portal.DoesNotExist:
+            return False
+        return True
 
     @staticmethod
     def get_token(user, portal, exp=None):
@@ -366,7 +411,8 @@ class JWTView(View):
             exp = datetime.utcnow() + JWT_EXPIRATION_DELTA
         payload = {"exp": exp, "username": user.username}
         secret = portal.sso_secret
-        token = jwt.encode(payload, secret, algorithm=JWT_ALGORITHM)
+        with performance.timed("jwt"):
+            token = jwt_codec.encode(payload, secret, algorithm=JWT_ALGORITHM)
         return token
 
     @method_decorator(login_required)
@@ -398,7 +444,7 @@ class JWTView(View):
             reason = _("Invalid `portal` query string parameter.")
             return HttpResponseBadRequest(reason, content_type="text/plain")
 
-        portal = Portal.objects.get(sso_key=sso_key)
+        portal = portal_registry.get(sso_key)
 
         if not request.user.user_profile.has_access(portal):
             reason = _("You do not have access to this portal.")
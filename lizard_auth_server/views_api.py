@@ -10,18 +10,30 @@ from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.debug import sensitive_post_parameters
 from django.views.decorators.debug import sensitive_variables
 from django.views.generic.edit import FormView
+from lizard_auth_server import catalog
 from lizard_auth_server import forms
 from lizard_auth_server import models
+from lizard_auth_server import user_payloads
+from lizard_auth_server.conf import settings
 from lizard_auth_server.http import JsonError
 from lizard_auth_server.http import JsonResponse
-from lizard_auth_server.views_sso import construct_user_data
+from lizard_auth_server.http import JsonStreamingResponse
 
+import json
 import logging
 
 
 logger = logging.getLogger(__name__)
 
 
+def user_response(user):
+    """Return the (cached) user data, see ``user_payloads.py``."""
+    return JsonResponse(
+        '{"user": %s, "success": true}' % user_payloads.get_json(user),
+        already_serialized=True,
+    )
+
+
 class AuthenticateUnsignedView(FormView):
     """
     View which can be used by API's to authenticate a
@@ -84,8 +96,7 @@ class AuthenticateUnsignedView(FormView):
                 except models.UserProfile.DoesNotExist:
                     return JsonError("No access to this portal")
                 if profile.has_access(portal):
-                    user_data = construct_user_data(profile=profile)
-                    return JsonResponse({"user": user_data})
+                    return user_response(user)
                 else:
                     return JsonError("No access to this portal")
         else:
@@ -158,8 +169,7 @@ class AuthenticateView(FormView):
                 except models.UserProfile.DoesNotExist:
                     return JsonError("No access to this portal")
                 if profile.has_access(portal):
-                    user_data = construct_user_data(profile=profile)
-                    return JsonResponse({"user": user_data})
+                    return user_response(user)
                 else:
                     return JsonError("No access to this portal")
         else:
@@ -224,8 +234,7 @@ class GetUserView(FormView):
                 except models.UserProfile.DoesNotExist:
                     return JsonError("No access to this portal")
                 if profile.has_access(portal):
-                    user_data = construct_user_data(profile=profile)
-                    return JsonResponse({"user": user_data})
+                    return user_response(user)
                 else:
                     return JsonError("No access to this portal")
         else:
@@ -238,6 +247,16 @@ class GetUserView(FormView):
 class GetUsersView(FormView):
     """
     View which can be used by API's to fetch all users of a portal.
+
+    Optional parameters in the message:
+
+    stream
+        When true, the users are streamed in chunks instead of serialized in
+        one go, which keeps memory usage flat for big portals.
+    after_pk, limit
+        Return one page of at most ``limit`` users with a user ``pk`` larger
+        than ``after_pk``. The response's ``next_after_pk`` is the
+        ``after_pk`` for the next page, or ``None`` after the last page.
     """
 
     form_class = forms.DecryptForm
@@ -251,22 +270,64 @@ class GetUsersView(FormView):
         return super(GetUsersView, self).post(request, *args, **kwargs)
 
     def form_valid(self, form):
+        data = form.cleaned_data
+        if "after_pk" in data or "limit" in data:
+            try:
+                after_pk = int(data.get("after_pk") or 0)
+                limit = int(data.get("limit") or 0)
+            except (TypeError, ValueError):
+                return JsonError('"after_pk" and "limit" should be integers.')
+            return self.get_users_page(form.portal, after_pk, limit)
+        if data.get("stream"):
+            return self.stream_users(form.portal)
         return self.get_users(form.portal)
 
     def form_invalid(self, form):
         logger.error("Error while decrypting form: %s", form.errors.as_text())
         return HttpResponseBadRequest("Bad signature")
 
+    def user_profiles(self, portal):
+        """Return the profiles with access to the portal, ordered by user."""
+        return models.UserProfile.objects.with_access(portal).order_by("user_id")
+
     def get_users(self, portal):
-        user_data = []
-        for user in User.objects.select_related("user_profile"):
-            try:
-                profile = user.user_profile
-            except models.UserProfile.DoesNotExist:
-                continue
-            if profile.has_access(portal):
-                user_data.append(construct_user_data(profile=profile))
-        return JsonResponse({"users": user_data})
+        user_data = user_payloads.get_json_many(self.user_profiles(portal))
+        return JsonResponse(
+            '{"users": [%s], "success": true}' % ", ".join(user_data),
+            already_serialized=True,
+        )
+
+    def get_users_page(self, portal, after_pk, limit):
+        max_limit = settings.LIZARD_AUTH_SERVER_GET_USERS_MAX_LIMIT
+        limit = min(limit, max_limit) if limit > 0 else max_limit
+        profiles = list(self.user_profiles(portal).filter(user_id__gt=after_pk)[:limit])
+        user_data = user_payloads.get_json_many(profiles)
+        if len(profiles) == limit:
+            next_after_pk = profiles[-1].user_id
+        else:
+            next_after_pk = None
+        return JsonResponse(
+            '{"users": [%s], "next_after_pk": %s, "success": true}'
+            % (", ".join(user_data), json.dumps(next_after_pk)),
+            already_serialized=True,
+        )
+
+    def stream_users(self, portal):
+        # We fetch the users in chunks on the user pk, every chunk with its
+        # own prefetches.
+        chunk_size = settings.LIZARD_AUTH_SERVER_GET_USERS_CHUNK_SIZE
+
+        def batches():
+            after_pk = 0
+            while True:
+                profiles = self.user_profiles(portal).filter(user_id__gt=after_pk)
+                profiles = list(profiles[:chunk_size])
+                yield user_payloads.get_json_many(profiles)
+                if len(profiles) < chunk_size:
+                    return
+                after_pk = profiles[-1].user_id
+
+        return JsonStreamingResponse("users", batches(), already_serialized=True)
 
 
 class GetOrganisationsView(FormView):
@@ -285,7 +346,13 @@ class GetOrganisationsView(FormView):
         return super(GetOrganisationsView, self).post(request, *args, **kwargs)
 
     def form_valid(self, form):
-        return JsonResponse(self.get_organisations(form.portal))
+        # All portals get all organisations, so one snapshot will do.
+        return catalog.snapshot_response(
+            self.request,
+            catalog.ORGANISATIONS,
+            "v1",
+            lambda: dict(self.get_organisations(form.portal), success=True),
+        )
 
     def form_invalid(self, form):
         logger.error("Error while decrypting form: %s", form.errors.as_text())
@@ -312,7 +379,11 @@ class RolesView(FormView):
         return super(RolesView, self).dispatch(request, *args, **kwargs)
 
     def form_valid(self, form):
-        return JsonResponse(self.get_roles(form.portal))
+        return catalog.conditional_response(
+            self.request,
+            catalog.ROLES,
+            lambda: JsonResponse(self.get_roles(form.portal)),
+        )
 
     def form_invalid(self, form):
         logger.error("Error while decrypting roles form: %s", form.errors.as_text())
@@ -359,3 +430,41 @@ class UserOrganisationRolesView(FormView):
                 uor.as_dict() for uor in user_profile.all_organisation_roles(portal)
             ]
         }
+
+
+class UserOrganisationRolesBatchView(FormView):
+    """
+    View that responds with the organisation roles of many users at once.
+
+    The signed message contains a ``usernames`` list. The response maps every
+    known username to its ``[organisation unique_id, role unique_id]`` pairs
+    for the portal. Unknown usernames are left out.
+    """
+
+    form_class = forms.BatchDecryptForm
+
+    @method_decorator(csrf_exempt)
+    def dispatch(self, request, *args, **kwargs):
+        return super(UserOrganisationRolesBatchView, self).dispatch(
+            request, *args, **kwargs
+        )
+
+    def form_valid(self, form):
+        usernames = form.cleaned_data.get("usernames")
+        if not isinstance(usernames, list) or not all(
+            isinstance(username, str) for username in usernames
+        ):
+            return JsonError('Missing "usernames" list in the message.')
+        return JsonResponse(
+            {
+                "user_organisation_roles": (
+                    models.UserProfile.objects.organisation_roles_for_usernames(
+                        usernames, form.portal
+                    )
+                )
+            }
+        )
+
+    def form_invalid(self, form):
+        logger.error("Error while decrypting roles form: %s", form.errors.as_text())
+        return HttpResponseBadRequest("Bad signature")
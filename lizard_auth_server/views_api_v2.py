@@ -6,7 +6,6 @@ from django.contrib.auth import authenticate as django_authenticate
 from django.contrib.auth import login as django_login
 from django.contrib.auth.models import User
 from django.core.exceptions import PermissionDenied
-from django.core.mail import send_mail
 from django.db import transaction
 from django.http import HttpResponse
 from django.http import HttpResponseBadRequest
@@ -20,6 +19,7 @@ from django.utils import translation
 from django.utils.decorators import method_decorator
 from django.utils.functional import cached_property
 from django.utils.translation import ugettext as _
+from django.views.decorators.cache import never_cache
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.debug import sensitive_post_parameters
 from django.views.generic import View
@@ -27,10 +27,22 @@ from django.views.generic.base import TemplateView
 from django.views.generic.edit import FormMixin
 from django.views.generic.edit import FormView
 from django.views.generic.edit import ProcessFormView
+from lizard_auth_server import catalog
 from lizard_auth_server import forms
+from lizard_auth_server import jwt_codec
+from lizard_auth_server import metrics
+from lizard_auth_server import performance
+from lizard_auth_server import replay_cache
+from lizard_auth_server.mail import send_mail
+from lizard_auth_server.models import ChangeLogEntry
 from lizard_auth_server.models import Organisation
+from lizard_auth_server.models import OrganisationRole
 from lizard_auth_server.models import Portal
+from lizard_auth_server.models import Role
+from lizard_auth_server.models import unmigrated_users_by_username
 from lizard_auth_server.models import UserProfile
+from lizard_auth_server.models import users_by_email
+from lizard_auth_server.registry import portal_registry
 from lizard_auth_server.views_sso import FormInvalidMixin
 from lizard_auth_server.views_sso import ProcessGetFormView
 from urllib.parse import urlencode  # py3 only!
@@ -81,6 +93,29 @@ class ApiJWTFormInvalidMixin(object):
         return HttpResponseBadRequest(message)
 
 
+class ReplayCacheMixin(object):
+    """Return the remembered response when a message is sent again.
+
+    For idempotent GET endpoints, see ``replay_cache.py``. Conditional
+    requests (``If-None-Match``) always go to the view itself.
+
+    """
+
+    @method_decorator(never_cache)
+    def get(self, request, *args, **kwargs):
+        if "HTTP_IF_NONE_MATCH" not in request.META:
+            response = replay_cache.get_response(request.GET)
+            if response is not None:
+                return response
+        # Like ProcessGetFormView.get(), but we need the verified payload.
+        form = self.get_form()
+        if not form.is_valid():
+            return self.form_invalid(form)
+        response = self.form_valid(form)
+        replay_cache.remember_response(request.GET, form.cleaned_data, response)
+        return response
+
+
 class StartView(View):
     """V2 API startpoint that lists the available endpoints.
 
@@ -106,6 +141,11 @@ class StartView(View):
 
         - ``find-user``: :class:`lizard_auth_server.views_api_v2.FindUserView`
 
+        - ``organisations``:
+            :class:`lizard_auth_server.views_api_v2.OrganisationsView`
+
+        - ``changes``: :class:`lizard_auth_server.views_api_v2.ChangesView`
+
         In addition, the list of supported language codes is returned:
 
         - ``available-languages``: language codes we support so that you can
@@ -127,6 +167,7 @@ class StartView(View):
             "new-user": abs_reverse("lizard_auth_server.api_v2.new_user"),
             "find-user": abs_reverse("lizard_auth_server.api_v2.find_user"),
             "organisations": abs_reverse("lizard_auth_server.api_v2.organisations"),
+            "changes": abs_reverse("lizard_auth_server.api_v2.changes"),
             "available-languages": AVAILABLE_LANGUAGES,
         }
         return HttpResponse(json.dumps(endpoints), content_type="application/json")
@@ -177,16 +218,26 @@ class CheckCredentialsView(ApiJWTFormInvalidMixin, FormMixin, ProcessFormView):
 
             A 403 error on faulty credentials or an inactive user.
 
+            A 400 error when the message has been used before and the replay
+                cache is enabled (see ``replay_cache.py``).
+
         """
+        replayed = replay_cache.get_cache() is not None and not (
+            replay_cache.first_use(self.request.POST, form.cleaned_data)
+        )
+        if replayed:
+            metrics.CREDENTIAL_CHECKS.labels("replay").inc()
+            return HttpResponseBadRequest("This JWT message has already been used")
         # The JWT message is validated; now check the message's contents.
         if ("username" not in form.cleaned_data) or (
             "password" not in form.cleaned_data
         ):
+            metrics.CREDENTIAL_CHECKS.labels("bad_request").inc()
             return HttpResponseBadRequest(
                 "username and/or password are missing from the JWT message"
             )
 
-        portal = Portal.objects.get(sso_key=form.cleaned_data["iss"])
+        portal = form.portal
         # Verify the username/password
         user = django_authenticate(
             username=form.cleaned_data.get("username"),
@@ -198,9 +249,12 @@ class CheckCredentialsView(ApiJWTFormInvalidMixin, FormMixin, ProcessFormView):
                 form.cleaned_data.get("username"),
                 portal,
             )
+            metrics.CREDENTIAL_CHECKS.labels("invalid").inc()
             raise PermissionDenied("Login failed")
         if not user.is_active:
+            metrics.CREDENTIAL_CHECKS.labels("inactive").inc()
             raise PermissionDenied("User is inactive")
+        metrics.CREDENTIAL_CHECKS.labels("valid").inc()
         logger.info(
             "Credentials for user %s checked succesfully for portal %s", user, portal
         )
@@ -237,7 +291,7 @@ class LoginView(FormInvalidMixin, ProcessGetFormView):
 
         """
         # Extract data from the JWT message including validation.
-        self.portal = Portal.objects.get(sso_key=form.cleaned_data["iss"])
+        self.portal = form.portal
         if LOGIN_SUCCESS_URL_KEY not in form.cleaned_data:
             return HttpResponseBadRequest(
                 "Mandatory key '%s' is missing from JWT message" % LOGIN_SUCCESS_URL_KEY
@@ -299,6 +353,7 @@ class LoginView(FormInvalidMixin, ProcessGetFormView):
 
     def form_valid_and_authenticated(self):
         """Return authenticated user (called when login succeeded)"""
+        metrics.LOGINS.inc()
         payload = {
             # JWT fields (intended audience + expiration datetime)
             "aud": self.portal.sso_key,
@@ -306,9 +361,10 @@ class LoginView(FormInvalidMixin, ProcessGetFormView):
             # Dump all relevant data:
             "user": json.dumps(construct_user_data(self.request.user)),
         }
-        signed_message = jwt.encode(
-            payload, self.portal.sso_secret, algorithm=JWT_ALGORITHM
-        )
+        with performance.timed("jwt"):
+            signed_message = jwt_codec.encode(
+                payload, self.portal.sso_secret, algorithm=JWT_ALGORITHM
+            )
         params = {"message": signed_message}
         url_with_params = "%s?%s" % (self.login_success_url, urlencode(params))
         logger.info(
@@ -420,7 +476,7 @@ class LogoutRedirectBackView(FormInvalidMixin, ProcessGetFormView):
         # JWT message contents is the same as in LogoutView and has been
         # checked there. So we don't need to check for a missing logout_url
         # parameter.
-        portal = Portal.objects.get(sso_key=form.cleaned_data["iss"])
+        portal = form.portal
         logger.info(
             "User is logged out. Redirecting to logout page of %s itself", portal
         )
@@ -483,7 +539,7 @@ class NewUserView(ApiJWTFormInvalidMixin, FormMixin, ProcessFormView):
             An error 409 (conflict) when the username or email is already used.
         """
 
-        portal = Portal.objects.get(sso_key=form.cleaned_data["iss"])
+        portal = form.portal
         # The JWT message is validated; now check the message's contents.
         mandatory_keys = ["username", "email", "first_name", "last_name"]
         for key in mandatory_keys:
@@ -493,7 +549,7 @@ class NewUserView(ApiJWTFormInvalidMixin, FormMixin, ProcessFormView):
                 )
 
         # Try to find the user first. You can have multiple matches.
-        matching_users = User.objects.filter(email__iexact=form.cleaned_data["email"])
+        matching_users = users_by_email(form.cleaned_data["email"])
 
         if matching_users:
 
@@ -594,9 +650,10 @@ class NewUserView(ApiJWTFormInvalidMixin, FormMixin, ProcessFormView):
             payload = {"aud": key, "exp": expiration, "user_id": user.id}
             if visit_url:
                 payload["visit_url"] = visit_url
-            signed_message = jwt.encode(
-                payload, portal.sso_secret, algorithm=JWT_ALGORITHM
-            )
+            with performance.timed("jwt"):
+                signed_message = jwt.encode(
+                    payload, portal.sso_secret, algorithm=JWT_ALGORITHM
+                )
             activation_url = self.request.build_absolute_uri(
                 reverse(
                     "lizard_auth_server.api_v2.activate-and-set-password",
@@ -654,7 +711,7 @@ class ActivateAndSetPasswordView(FormView):
     @cached_property
     def portal(self):
         sso_key = self.kwargs["sso_key"]
-        return Portal.objects.get(sso_key=sso_key)
+        return portal_registry.get(sso_key)
 
     @cached_property
     def message(self):
@@ -685,12 +742,13 @@ class ActivateAndSetPasswordView(FormView):
 
         """
         try:
-            signed_data = jwt.decode(
-                self.message,
-                self.portal.sso_secret,
-                audience=self.portal.sso_key,
-                algorithms=[getattr(settings, "JWT_ALGORITHM", "HS256")],
-            )
+            with performance.timed("jwt"):
+                signed_data = jwt.decode(
+                    self.message,
+                    self.portal.sso_secret,
+                    audience=self.portal.sso_key,
+                    algorithms=[getattr(settings, "JWT_ALGORITHM", "HS256")],
+                )
         except jwt.exceptions.ExpiredSignatureError:
             return HttpResponseBadRequest("Activation link has expired")
         except Exception as e:
@@ -753,7 +811,7 @@ class ActivatedGoToPortalView(TemplateView):
         return self.portal.visit_url
 
 
-class OrganisationsView(ApiJWTFormInvalidMixin, ProcessGetFormView):
+class OrganisationsView(ReplayCacheMixin, ApiJWTFormInvalidMixin, ProcessGetFormView):
     """API endpoint that simply lists the organisations and their UIDs.
 
     The UID of organisations is used by several portals. The "V2" api doesn't
@@ -777,17 +835,20 @@ class OrganisationsView(ApiJWTFormInvalidMixin, ProcessGetFormView):
 
         Returns:
             json dict with the unique ID as key and the organisation's
-              name as value.
+              name as value. Or a "304 not modified" when the
+              ``If-None-Match`` header has the current ``ETag``.
 
         """
-        result = {
-            organisation.unique_id: organisation.name
-            for organisation in Organisation.objects.all()
-        }
-        return HttpResponse(json.dumps(result), content_type="application/json")
+
+        return catalog.snapshot_response(
+            self.request,
+            catalog.ORGANISATIONS,
+            "v2",
+            lambda: dict(Organisation.objects.values_list("unique_id", "name")),
+        )
 
 
-class FindUserView(ApiJWTFormInvalidMixin, ProcessGetFormView):
+class FindUserView(ReplayCacheMixin, ApiJWTFormInvalidMixin, ProcessGetFormView):
     """View to return an existing user based on email address
 
     The email adress is passed in a JWT signed form.
@@ -827,7 +888,7 @@ class FindUserView(ApiJWTFormInvalidMixin, ProcessGetFormView):
 
         # Try to find the user first. You can have multiple matches.
         email = form.cleaned_data["email"]
-        matching_users = User.objects.filter(email__iexact=email)
+        matching_users = users_by_email(email)
         if not matching_users:
             return HttpResponseNotFound("User %s not found" % email)
 
@@ -836,7 +897,7 @@ class FindUserView(ApiJWTFormInvalidMixin, ProcessGetFormView):
                 "More than one user found for '%s', returning the first", email
             )
         user = matching_users[0]
-        portal = Portal.objects.get(sso_key=form.cleaned_data["iss"])
+        portal = form.portal
         logger.info("Found existing user %s, returning that one to %s", user, portal)
 
         user_data = construct_user_data(user=user)
@@ -845,6 +906,135 @@ class FindUserView(ApiJWTFormInvalidMixin, ProcessGetFormView):
         )
 
 
+class ChangesView(ApiJWTFormInvalidMixin, ProcessGetFormView):
+    """API endpoint with the changes to users, organisations and roles.
+
+    Instead of periodically pulling everything, a portal can do a full sync
+    once and afterwards only ask for the changes since its previous call.
+    Every call returns a ``cursor`` to pass along the next time.
+
+    Users are limited to the users with access to the portal, roles and
+    organisation roles to the roles of the portal.
+    Changes show up after ``LIZARD_AUTH_SERVER_CHANGES_SETTLE_SECONDS``, see
+    ``ChangeLogEntryManager.since()``.
+
+    """
+
+    form_class = forms.JWTDecryptForm
+
+    def form_valid(self, form):
+        """Return the changes since the passed cursor
+
+        Args:
+            form: A :class:`lizard_auth_server.forms.JWTDecryptForm`
+                instance. The message can contain a ``cursor`` (from the
+                previous response) and a ``limit``. Without ``cursor``, only
+                the current cursor is returned: do a full sync and use that
+                cursor afterwards.
+
+        Returns:
+            json dict with the ``cursor`` for the next call, ``more`` (true
+              when there are more changes waiting) and ``changes``: a list of
+              dicts with ``type``, ``id`` and ``deleted``, plus ``data`` with
+              the current state of objects that still exist.
+
+            An error 400 when the cursor or limit isn't an integer. An error
+            410 when the cursor is older than the oldest kept change (see the
+            ``cleanup_change_log`` command): do a full sync again.
+
+        """
+        settled_at = timezone.now() - datetime.timedelta(
+            seconds=settings.LIZARD_AUTH_SERVER_CHANGES_SETTLE_SECONDS
+        )
+        if "cursor" not in form.cleaned_data:
+            result = {
+                "cursor": ChangeLogEntry.objects.latest_cursor(settled_at),
+                "more": False,
+                "changes": [],
+            }
+            return HttpResponse(json.dumps(result), content_type="application/json")
+
+        max_limit = settings.LIZARD_AUTH_SERVER_CHANGES_MAX_LIMIT
+        try:
+            cursor = int(form.cleaned_data["cursor"])
+            limit = int(form.cleaned_data.get("limit") or max_limit)
+        except (TypeError, ValueError):
+            return HttpResponseBadRequest("cursor and limit should be integers")
+        limit = max(1, min(limit, max_limit))
+        if cursor < ChangeLogEntry.objects.oldest_cursor():
+            return HttpResponse(
+                "The changes since this cursor are removed, do a full sync",
+                status=410,
+            )
+
+        entries = list(
+            ChangeLogEntry.objects.since(cursor, form.portal, limit, settled_at)
+        )
+        if entries:
+            cursor = entries[-1].id
+        result = {
+            "cursor": cursor,
+            "more": len(entries) == limit,
+            "changes": self.changes(entries, form.portal),
+        }
+        return HttpResponse(json.dumps(result), content_type="application/json")
+
+    def changes(self, entries, portal):
+        # Only the last entry per object matters as we return the current
+        # state anyway.
+        latest = {}
+        for entry in entries:
+            latest[(entry.object_type, entry.object_id)] = entry
+        entries = sorted(latest.values(), key=lambda entry: entry.id)
+
+        ids = {object_type: [] for object_type, _ in ChangeLogEntry.OBJECT_TYPES}
+        for entry in entries:
+            if not entry.deleted:
+                ids[entry.object_type].append(entry.object_id)
+        current = {
+            # Users without access to the portal count as deleted, like they
+            # are left out of the v1 user list.
+            ChangeLogEntry.USER: {
+                profile.user.username: construct_user_data(user=profile.user)
+                for profile in UserProfile.objects.with_access(portal).filter(
+                    user__username__in=ids[ChangeLogEntry.USER]
+                )
+            },
+            ChangeLogEntry.ORGANISATION: {
+                organisation.unique_id: organisation.as_dict()
+                for organisation in Organisation.objects.filter(
+                    unique_id__in=ids[ChangeLogEntry.ORGANISATION]
+                )
+            },
+            ChangeLogEntry.ROLE: {
+                role.unique_id: role.as_dict()
+                for role in Role.objects.filter(
+                    unique_id__in=ids[ChangeLogEntry.ROLE], portal=portal
+                )
+            },
+            ChangeLogEntry.ORGANISATION_ROLE: {
+                str(organisation_role.pk): organisation_role.as_dict()
+                for organisation_role in OrganisationRole.objects.filter(
+                    pk__in=ids[ChangeLogEntry.ORGANISATION_ROLE], role__portal=portal
+                )
+            },
+        }
+
+        changes = []
+        for entry in entries:
+            data = current[entry.object_type].get(entry.object_id)
+            change = {
+                "type": entry.object_type,
+                "id": entry.object_id,
+                # Changed and deleted afterwards (or renamed) also means gone.
+                "deleted": data is None,
+            }
+            if data is not None:
+                change["data"] = data
+            changes.append(change)
+        return changes
+
+
 class CognitoUserMigrationView(CheckCredentialsView):
     """View to migrate users to AWS Cognito
 
@@ -883,7 +1073,7 @@ class CognitoUserMigrationView(CheckCredentialsView):
         if not username:
             return HttpResponseBadRequest("username is missing from the JWT message")
 
-        portal = Portal.objects.get(sso_key=form.cleaned_data["iss"])
+        portal = form.portal
         if not portal.allow_migrate_user:
             raise PermissionDenied("this portal is not allowed to migrate users")
 
@@ -891,11 +1081,7 @@ class CognitoUserMigrationView(CheckCredentialsView):
         # want to migrate LDAP user and we certainly do not want to do a call
         # to Cognito, else we end up in an infinite loop.
         try:
-            user = User.objects.get(
-                username__iexact=username,
-                is_active=True,
-                user_profile__migrated_at=None,
-            )
+            user = unmigrated_users_by_username(username).get()
         except User.DoesNotExist:
             return HttpResponseNotFound("No user found")
         except User.MultipleObjectsReturned:
@@ -943,10 +1129,6 @@ class CognitoUserExistsView(CheckCredentialsView):
         username = form.cleaned_data.get("username")
         if not username:
             return HttpResponseBadRequest("username is missing from the JWT message")
-        result = User.objects.filter(
-            username__iexact=username,
-            is_active=True,
-            user_profile__migrated_at=None,
-        ).exists()
+        result = unmigrated_users_by_username(username).exists()
 
         return JsonResponse({"exists": result})
@@ -13,8 +13,10 @@ from django.views.generic.base import View
 from django.views.generic.edit import FormMixin
 from itsdangerous import URLSafeTimedSerializer
 from lizard_auth_server import forms
-from lizard_auth_server.models import Token
+from lizard_auth_server import metrics
+from lizard_auth_server import user_payloads
 from lizard_auth_server.models import UserProfile
+from lizard_auth_server.token_store import get_token_store
 from lizard_auth_server.views import ErrorMessageResponse
 
 # py3 only:
@@ -121,7 +123,8 @@ class RequestTokenView(ProcessGetFormView):
     form_class = forms.DecryptForm
 
     def form_valid(self, form):
-        token = Token.objects.create_for_portal(form.portal)
+        token = get_token_store().create(form.portal)
+        metrics.SSO_TOKENS.labels("created").inc()
         params = {"request_token": token.request_token}
         # encrypt the token with the secret key of the portal
         data = URLSafeTimedSerializer(token.portal.sso_secret).dumps(params)
@@ -147,11 +150,9 @@ class AuthorizeView(FormInvalidMixin, ProcessGetFormView):
 
     def form_valid(self, form):
         request_token = form.cleaned_data["request_token"]
-        try:
-            self.token = Token.objects.get(
-                request_token=request_token, portal=form.portal, user__isnull=True
-            )
-        except Token.DoesNotExist:
+        self.token_store = get_token_store()
+        self.token = self.token_store.get_unauthorized(request_token, form.portal)
+        if self.token is None:
             return HttpResponseForbidden("Invalid request token")
         if self.check_token_timeout():
             self.domain = get_domain(form)
@@ -167,7 +168,8 @@ class AuthorizeView(FormInvalidMixin, ProcessGetFormView):
         return delta <= TOKEN_TIMEOUT
 
     def token_timeout(self):
-        self.token.delete()
+        self.token_store.delete(self.token)
+        metrics.SSO_TOKENS.labels("timed_out").inc()
         return ErrorMessageResponse(
             self.request,
             _("Token timed out. Please return to the portal " "to get a fresh token."),
@@ -196,16 +198,17 @@ class AuthorizeView(FormInvalidMixin, ProcessGetFormView):
         return profile.has_access(self.token.portal)
 
     def success(self):
+        # link the user model to the token model, so we can return the
+        # proper profile when the SSO client calls the VerifyView
+        if not self.token_store.authorize(self.token, self.request.user):
+            return HttpResponseForbidden("Invalid request token")
+        metrics.SSO_TOKENS.labels("authorized").inc()
         params = {
             "request_token": self.token.request_token,
             "auth_token": self.token.auth_token,
         }
         # encrypt the tokens with the secret key of the portal
         message = URLSafeTimedSerializer(self.token.portal.sso_secret).dumps(params)
-        # link the user model to the token model, so we can return the
-        # proper profile when the SSO client calls the VerifyView
-        self.token.user = self.request.user
-        self.token.save()
         # redirect user back to the portal
         url = urljoin(self.domain, "sso/local_login/")
         url = "%s?%s" % (url, urlencode({"message": message}))
@@ -288,7 +291,10 @@ def construct_user_data(user=None, profile=None):
     ]:
         data[key] = getattr(user, key)
     data["permissions"] = []
-    for perm in user.user_permissions.select_related("content_type").all():
+    permissions = user.user_permissions.all()
+    if "user_permissions" not in getattr(user, "_prefetched_objects_cache", {}):
+        permissions = permissions.select_related("content_type")
+    for perm in permissions:
         data["permissions"].append(
             {
                 "content_type": perm.content_type.natural_key(),
@@ -393,9 +399,7 @@ class VerifyView(ProcessGetFormView):
         """
         Returns the JSON string representation of the user object for a portal.
         """
-        profile = self.token.user.user_profile
-        data = construct_user_data(profile=profile)
-        return json.dumps(data)
+        return user_payloads.get_json(self.token.user)
 
     def get_organisation_roles_json(self, portal):
         profile = self.token.user.user_profile
@@ -404,12 +408,11 @@ class VerifyView(ProcessGetFormView):
 
     def form_valid(self, form):
         auth_token = form.cleaned_data["auth_token"]
-        try:
-            self.token = Token.objects.get(
-                auth_token=auth_token, user__isnull=False, portal=form.portal
-            )
-        except Token.DoesNotExist:
+        # get and disable the token
+        self.token = get_token_store().pop_authorized(auth_token, form.portal)
+        if self.token is None:
             return HttpResponseForbidden("Invalid auth token")
+        metrics.SSO_TOKENS.labels("verified").inc()
         # get some metadata about the user, so we can construct a user on the
         # SSO client
         params = {
@@ -418,8 +421,6 @@ class VerifyView(ProcessGetFormView):
         }
         # encrypt the data
         data = URLSafeTimedSerializer(self.token.portal.sso_secret).dumps(params)
-        # disable the token
-        self.token.delete()
         return HttpResponse(data)
 
     def form_invalid(self, form):
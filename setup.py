@@ -19,6 +19,7 @@ install_requires = [
     "django-nose",
     "django-oidc-provider",
     "itsdangerous",
+    "prometheus_client",
     "psycopg2-binary",
     "pyjwt",
     "pytz",